@@ -0,0 +1,379 @@
+"""Modo de servicio asyncio (ASGI) para la recepción de trabajos.
+
+Con waitress cada petición ocupa uno de sus hilos mientras dura: una subida
+lenta, un long-poll de /jobs/<id>?wait= o un stream SSE retienen un hilo y,
+con el pool lleno, los demás terminales esperan. En este modo un servidor
+ASGI (uvicorn, paquete opcional) atiende todas las conexiones en un bucle
+asyncio y sirve la misma aplicación Flask:
+
+* El cuerpo se lee de forma asíncrona, con un límite por petición y otro
+  global de bytes en vuelo: la memoria queda acotada aunque haya cientos de
+  conexiones abiertas.
+* La aplicación Flask (decodificación JSON/base64, validación, diario y
+  encolado) se ejecuta en un pool fijo de hilos. Delante hay una cola
+  asyncio (semáforo FIFO): las peticiones que esperan turno no ocupan
+  hilos, y si la cola se llena se responde 503 con Retry-After.
+* El seguimiento de trabajos (long-poll y SSE de /jobs/<id>) se atiende en
+  el propio bucle con los avisos del JobTracker, sin ocupar ningún hilo.
+"""
+import asyncio
+import io
+import json
+import logging
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from job_tracker import FINAL_STATES
+
+try:
+    import uvicorn  # Opcional: modo de servicio asyncio (pip install uvicorn)
+except ImportError:
+    uvicorn = None
+
+logger = logging.getLogger(__name__)
+
+ASGI_AVAILABLE = uvicorn is not None
+JOB_PATH = re.compile(r'^/jobs/([^/]+)$')
+MAX_LONG_POLL = 60
+SSE_HEARTBEAT = 15
+
+
+def wsgi_environ(scope, body: bytes) -> dict:
+    """Entorno WSGI (PEP 3333) de una petición ASGI con el cuerpo ya leído."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name not in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):  # El cuerpo ya va entero
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def call_wsgi(app, environ):
+    """Ejecutar la aplicación WSGI (en un hilo del pool). Devuelve
+    (código, cabeceras, cuerpo)."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    result = app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+class _BodyRejected(Exception):
+    """El cuerpo de la petición no cabe (413) o no hay memoria libre (503)."""
+
+    def __init__(self, too_large: bool):
+        super().__init__()
+        self.too_large = too_large
+
+
+class AsyncJobWatcher:
+    """Espera de cambios de estado de los trabajos dentro del bucle asyncio,
+    con los avisos del JobTracker en lugar de un hilo bloqueado por cliente."""
+
+    def __init__(self, tracker, loop):
+        self.tracker = tracker
+        self.loop = loop
+        self._waiters = {}  # id de trabajo -> futuros pendientes
+        tracker.add_listener(self._on_change)
+
+    def close(self):
+        self.tracker.remove_listener(self._on_change)
+
+    async def wait(self, job_id: str, timeout: float, known_state: str = None):
+        """Como ``JobTracker.wait``: hasta ``timeout`` segundos a que el estado
+        cambie respecto a ``known_state`` (o a que el trabajo termine)."""
+        deadline = self.loop.time() + timeout
+        while True:
+            # Registrar la espera antes de consultar: un cambio entre medias
+            # despierta al futuro y no se pierde
+            future = self.loop.create_future()
+            self._waiters.setdefault(job_id, set()).add(future)
+            try:
+                status = self.tracker.get(job_id)
+                remaining = deadline - self.loop.time()
+                if (status is None or remaining <= 0
+                        or (known_state is not None and status['state'] != known_state)
+                        or (known_state is None and status['state'] in FINAL_STATES)):
+                    return status
+                await asyncio.wait({future}, timeout=remaining)
+            finally:
+                waiters = self._waiters.get(job_id)
+                if waiters is not None:
+                    waiters.discard(future)
+                    if not waiters:
+                        del self._waiters[job_id]
+
+    def watching(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _on_change(self, status):
+        # Hilo de impresión: pasar al bucle solo si alguien espera ese trabajo
+        if status['job_id'] in self._waiters:
+            self.loop.call_soon_threadsafe(self._wake, status['job_id'])
+
+    def _wake(self, job_id):
+        for future in self._waiters.get(job_id, ()):
+            if not future.done():
+                future.set_result(None)
+
+
+class AsgiApp:
+    """Aplicación ASGI delante de la aplicación Flask ``wsgi_app``.
+
+    ``workers`` hilos ejecutan las peticiones; como mucho ``max_pending``
+    peticiones esperan o se ejecutan a la vez y ``max_inflight_bytes`` bytes
+    de cuerpos están en memoria. ``extra_headers()`` añade cabeceras (CORS) a
+    las respuestas que se generan aquí sin pasar por Flask.
+    """
+
+    def __init__(self, wsgi_app, tracker, workers: int = 8, max_pending: int = 512,
+                 max_body_bytes: int = 64 * 1024 * 1024, max_inflight_bytes: int = 128 * 1024 * 1024,
+                 extra_headers=None):
+        self.wsgi_app = wsgi_app
+        self.tracker = tracker
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_body_bytes = max_body_bytes
+        self.max_inflight_bytes = max_inflight_bytes
+        self.extra_headers = extra_headers or (lambda: [])
+        self._executor = None
+        self._slots = None
+        self._watcher = None
+        self._pending = 0
+        self._inflight_bytes = 0
+        self.requests = 0
+        self.rejected = 0
+        self.watch_requests = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        self._start()
+        self.requests += 1
+
+        match = JOB_PATH.match(scope['path'])
+        if scope['method'] == 'GET' and match and self._is_job_watch(scope):
+            await self._job_watch(scope, receive, send, match.group(1))
+            return
+
+        length = self._content_length(scope)
+        if length > self.max_body_bytes:
+            await self._send_too_large(send)
+            return
+        if self._pending >= self.max_pending or self._inflight_bytes + length > self.max_inflight_bytes:
+            await self._send_busy(send)
+            return
+
+        self._pending += 1
+        self._inflight_bytes += length
+        charged = [length]  # Bytes contados en _inflight_bytes (crece si no había Content-Length)
+        try:
+            body = await self._read_body(receive, charged)
+            if body is None:
+                return  # Cliente desconectado: no se ejecuta una petición incompleta
+            # Cola asyncio delante del pool: esperar turno no ocupa un hilo
+            async with self._slots:
+                status, headers, data = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, call_wsgi, self.wsgi_app, wsgi_environ(scope, body))
+            await self._send_response(send, status, headers, data)
+        except _BodyRejected as e:
+            await (self._send_too_large(send) if e.too_large else self._send_busy(send))
+        except Exception as e:
+            logger.exception("Error atendiendo %s %s: %s", scope['method'], scope['path'], e)
+            await self._send_json(send, 500, {'status': 'error', 'message': str(e)})
+        finally:
+            self._pending -= 1
+            self._inflight_bytes -= charged[0]
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'pending': self._pending,
+            'max_pending': self.max_pending,
+            'inflight_bytes': self._inflight_bytes,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'watch_requests': self.watch_requests,
+            'watching': self._watcher.watching() if self._watcher else 0,
+        }
+
+    # --- Implementación ---
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='asgi')
+            self._slots = asyncio.Semaphore(self.workers)
+            self._watcher = AsyncJobWatcher(self.tracker, asyncio.get_running_loop())
+
+    def _stop(self):
+        if self._watcher is not None:
+            self._watcher.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = self._slots = self._watcher = None
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _content_length(scope) -> int:
+        for name, value in scope.get('headers', []):
+            if name == b'content-length':
+                try:
+                    return max(0, int(value))
+                except ValueError:
+                    return 0
+        return 0
+
+    async def _read_body(self, receive, charged):
+        """Cuerpo completo, o None si el cliente se desconecta antes. Los bytes
+        que exceden lo reservado (``charged[0]``, p. ej. cuerpos chunked sin
+        Content-Length) se cuentan según llegan; lanza _BodyRejected si se
+        supera ``max_body_bytes`` o ``max_inflight_bytes``."""
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_bytes:
+                raise _BodyRejected(too_large=True)
+            if size > charged[0]:
+                if self._inflight_bytes + size - charged[0] > self.max_inflight_bytes:
+                    raise _BodyRejected(too_large=False)
+                self._inflight_bytes += size - charged[0]
+                charged[0] = size
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    def _is_job_watch(scope) -> bool:
+        """Peticiones de /jobs/<id> que esperan (long-poll o SSE)."""
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        if query.get('stream', [''])[0] or query.get('wait', [''])[0] not in ('', '0'):
+            return True
+        accept = dict(scope.get('headers', [])).get(b'accept', b'')
+        return accept.startswith(b'text/event-stream')
+
+    async def _job_watch(self, scope, receive, send, job_id):
+        """/jobs/<id>?wait=N y ?stream=1 (ver printServer.job_status_endpoint)
+        atendidos en el bucle."""
+        self.watch_requests += 1
+        status = self.tracker.get(job_id)
+        if status is None:
+            await self._send_json(send, 404, {'status': 'error', 'message': 'Trabajo no encontrado'})
+            return
+
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        accept = dict(scope.get('headers', [])).get(b'accept', b'')
+        if query.get('stream', [''])[0] or accept.startswith(b'text/event-stream'):
+            await self._job_event_stream(receive, send, job_id, status)
+            return
+
+        try:
+            wait = min(max(float(query.get('wait', ['0'])[0]), 0), MAX_LONG_POLL)
+        except ValueError:
+            wait = 0
+        status = await self._watcher.wait(job_id, wait, query.get('state', [None])[0]) or status
+        await self._send_json(send, 200, status)
+
+    async def _job_event_stream(self, receive, send, job_id, status):
+        headers = [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache'),
+                   ('X-Accel-Buffering', 'no')] + list(self.extra_headers())
+        await send({'type': 'http.response.start', 'status': 200, 'headers': self._encode_headers(headers)})
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        known = None
+        try:
+            while status is not None and not disconnected.done():
+                if status['state'] == known:
+                    event = ": keepalive\n\n"
+                else:
+                    known = status['state']
+                    event = f"event: {known}\ndata: {json.dumps(status)}\n\n"
+                await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+                if known in FINAL_STATES:
+                    break
+                status = await self._watcher.wait(job_id, SSE_HEARTBEAT, known)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    def _encode_headers(headers):
+        return [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers]
+
+    async def _send_response(self, send, status, headers, body):
+        await send({'type': 'http.response.start', 'status': status, 'headers': self._encode_headers(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _send_too_large(self, send):
+        await self._send_json(send, 413, {'status': 'error', 'message': 'Petición demasiado grande'})
+
+    async def _send_busy(self, send):
+        self.rejected += 1
+        await self._send_json(send, 503, {'status': 'error', 'message': 'Servidor ocupado, reintente más tarde',
+                                          'retry_after': 1}, [('Retry-After', '1')])
+
+    async def _send_json(self, send, status, payload, headers=()):
+        headers = [('Content-Type', 'application/json')] + list(headers) + list(self.extra_headers())
+        await self._send_response(send, status, headers, json.dumps(payload).encode('utf-8'))
+
+
+def serve_asgi(app, host: str, port: int, backlog: int = 2048):
+    """Servir ``app`` con uvicorn hasta Ctrl+C. Los logs de uvicorn van al
+    logging del servidor."""
+    config = uvicorn.Config(app, host=host, port=port, lifespan='on', log_config=None,
+                            access_log=False, backlog=backlog, server_header=False)
+    uvicorn.Server(config).run()
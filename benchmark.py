@@ -0,0 +1,422 @@
+"""Benchmarks del servidor de impresión.
+
+Mide las rutas principales (construcción ESC/POS de tickets, codificación,
+raster de QR, PDFs de 1/5/20 páginas y el recorrido completo HTTP -> bytes a
+través de waitress y, si uvicorn está instalado, del modo asyncio) contra una
+impresora 'loopback', así que funciona en Linux sin win32print. Para cada caso
+informa de operaciones por segundo, latencia p50/p99 y pico de memoria, y
+puede compararse con una referencia guardada.
+
+Uso:
+    python benchmark.py                         # ejecutar todos los casos
+    python benchmark.py -k qr -k pdf            # solo los que contienen 'qr' o 'pdf'
+    python benchmark.py --save-baseline         # guardar los resultados como referencia
+    python benchmark.py --compare               # comparar con la referencia guardada
+    python benchmark.py -k concurrent           # cientos de clientes esperando su trabajo
+"""
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import fitz
+from PIL import Image
+
+import printServer as ps
+
+BENCH_PRINTER = 'bench'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+# --- Datos de prueba ---
+
+def make_ticket(lines: int) -> str:
+    """Ticket de restaurante con ``lines`` líneas de artículos (con acentos)."""
+    rng = random.Random(lines)
+    dishes = ['Café con leche', 'Tostada con jamón', 'Ración de calamares', 'Caña', 'Agua mineral',
+              'Croquetas caseras', 'Ensalada césar', 'Solomillo al Pedro Ximénez', 'Crème brûlée']
+    rows = ["=" * 42, "        RESTAURANTE EL ÑANDÚ", "   Calle Mayor 1 - CIF: B12345678", "=" * 42]
+    for _ in range(lines):
+        qty, price = rng.randint(1, 4), rng.randint(150, 2400) / 100
+        rows.append(f"{rng.choice(dishes)[:24]:<24} x{qty:<3} {price:>6.2f} {qty * price:>7.2f}")
+    rows += ["-" * 42, f"{'TOTAL:':>34} {rng.randint(10, 500):>7.2f} €", "¡Gracias por su visita!"]
+    return '\n'.join(rows)
+
+
+def make_order(lines: int) -> dict:
+    """Datos de pedido para /print_order con ``lines`` líneas de artículos."""
+    rng = random.Random(lines)
+    dishes = ['Café con leche', 'Tostada con jamón', 'Ración de calamares', 'Caña', 'Agua mineral',
+              'Croquetas caseras', 'Ensalada césar', 'Solomillo al Pedro Ximénez', 'Crème brûlée']
+    items = [{'name': rng.choice(dishes), 'qty': rng.randint(1, 4), 'price': rng.randint(150, 2400) / 100,
+              'vat': rng.choice([10, 10, 21])} for _ in range(lines)]
+    return {'business': 'RESTAURANTE EL ÑANDÚ', 'tax_id': 'B12345678', 'number': f'T{lines:05d}', 'items': items}
+
+
+def make_qr_png(pixels: int) -> str:
+    """PNG en base64 de un QR aleatorio (29x29 módulos) de ``pixels`` de lado."""
+    rng = random.Random(pixels)
+    modules = Image.new('L', (29, 29), 255)
+    modules.putdata([0 if rng.random() < 0.5 else 255 for _ in range(29 * 29)])
+    buffer = io.BytesIO()
+    modules.resize((pixels, pixels), Image.Resampling.NEAREST).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def make_pdf(pages: int) -> bytes:
+    """PDF de ``pages`` páginas del ancho de un ticket (80 mm) con texto."""
+    doc = fitz.open()
+    for p in range(pages):
+        page = doc.new_page(width=226, height=600)
+        text = make_ticket(30 + p).replace('€', 'EUR')
+        page.insert_textbox(fitz.Rect(8, 8, 218, 592), text, fontsize=7, fontname='cour')
+    return doc.tobytes()
+
+
+# --- Medición ---
+
+def measure(func, min_time=1.0, min_ops=5, max_ops=100000):
+    """Ejecutar ``func`` repetidamente (tras un calentamiento) y devolver las
+    latencias en segundos."""
+    func()
+    latencies = []
+    deadline = time.perf_counter() + min_time
+    while len(latencies) < max_ops and (len(latencies) < min_ops or time.perf_counter() < deadline):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def peak_memory(func) -> int:
+    """Pico de memoria (bytes) asignada durante una ejecución de ``func``."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(latencies, ops=None, elapsed=None, peak=None):
+    ops = ops if ops is not None else len(latencies)
+    elapsed = elapsed if elapsed is not None else sum(latencies)
+    return {
+        'ops': ops,
+        'ops_s': round(ops / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'peak_kb': round(peak / 1024, 1) if peak is not None else None,
+    }
+
+
+# --- Casos ---
+
+def bench_function(func, min_time):
+    return summarize(measure(func, min_time), peak=peak_memory(func))
+
+
+def start_http_server(mode, threads):
+    """Arrancar el servidor HTTP ('waitress' o 'asgi') en un puerto libre.
+    Devuelve (puerto, función para detenerlo)."""
+    if mode == 'asgi':
+        import uvicorn
+
+        ps.ASGI_WORKERS = threads
+        config = uvicorn.Config(ps.create_asgi_app(), host='127.0.0.1', port=0, lifespan='on',
+                                log_config=None, access_log=False, backlog=2048)
+        server = uvicorn.Server(config)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.01)
+
+        def stop():
+            server.should_exit = True
+            thread.join(10)
+        return server.servers[0].sockets[0].getsockname()[1], stop
+
+    from waitress import create_server
+
+    server = create_server(ps.app, host='127.0.0.1', port=0, threads=threads)
+    threading.Thread(target=server.run, daemon=True).start()
+    return server.effective_port, server.close
+
+
+def bench_http(path, body_factory, jobs, clients=4, server='waitress'):
+    """Enviar ``jobs`` peticiones a ``path`` a través del servidor HTTP y
+    esperar a que todos los trabajos lleguen a la impresora. La latencia es
+    la de cada trabajo de extremo a extremo (recibido -> enviado a la impresora)."""
+    port, stop = start_http_server(server, clients * 2)
+    job_ids, errors = [], []
+    lock = threading.Lock()
+
+    def client(count):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        for _ in range(count):
+            content_type, body = body_factory()
+            conn.request('POST', path, body=body, headers={'Content-Type': content_type})
+            response = conn.getresponse()
+            payload = json.loads(response.read() or b'{}')
+            with lock:
+                if response.status == 200 and payload.get('job_id'):
+                    job_ids.append(payload['job_id'])
+                elif response.status == 200 and payload.get('job_ids'):
+                    job_ids.extend(payload['job_ids'])  # /print_batch
+                else:
+                    errors.append(response.status)
+        conn.close()
+
+    try:
+        started = time.perf_counter()
+        workers = [threading.Thread(target=client, args=(jobs // clients,)) for _ in range(clients)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        statuses = [ps.job_tracker.wait(job_id, 120) for job_id in job_ids]
+        elapsed = time.perf_counter() - started
+    finally:
+        stop()
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} peticiones fallidas a {path}: {sorted(set(errors))}")
+    latencies = [s['timestamps'].get('done', s['timestamps'].get('failed')) - s['timestamps']['queued']
+                 for s in statuses]
+    return summarize(latencies, ops=len(statuses), elapsed=elapsed)
+
+
+def bench_concurrent(body, connections, server):
+    """``connections`` clientes a la vez, cada uno con su conexión: envía un
+    ticket y espera su resultado con long-poll (/jobs/<id>?wait=), como un
+    TPV. La latencia es la de cada cliente (envío -> respuesta con el trabajo
+    terminado). Cada servidor usa los hilos con los que arranca por defecto."""
+    threads = ps.ASGI_WORKERS if server == 'asgi' else ps.WAITRESS_THREADS + ps.MAX_JOB_WATCHERS
+    port, stop = start_http_server(server, threads)
+    latencies, errors = [], []
+    lock = threading.Lock()
+    start = threading.Barrier(connections + 1)
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            start.wait()
+            started = time.perf_counter()
+            conn.request('POST', '/print_text', body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            payload = json.loads(response.read() or b'{}')
+            if response.status != 200:
+                raise RuntimeError(response.status)
+            # Sin hueco para esperar, el servidor devuelve el estado actual
+            status = {'state': 'queued'}
+            while status.get('state') not in ps.FINAL_STATES:
+                conn.request('GET', f"/jobs/{payload['job_id']}?wait=30")
+                response = conn.getresponse()
+                status = json.loads(response.read())
+                if status.get('state') not in ps.FINAL_STATES:
+                    time.sleep(0.01)
+            if status['state'] != 'done':
+                raise RuntimeError(status['state'])
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+        finally:
+            conn.close()
+
+    clients = [threading.Thread(target=client) for _ in range(connections)]
+    try:
+        for thread in clients:
+            thread.start()
+        start.wait()
+        started = time.perf_counter()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        stop()
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} clientes fallidos ({server}): {sorted(set(errors))}")
+    return summarize(latencies, elapsed=elapsed)
+
+
+def build_cases(min_time, http_jobs, connections):
+    """Lista de (nombre, función que devuelve el resultado)."""
+    small, large = make_ticket(8), make_ticket(400)
+    small_order, large_order = make_order(8), make_order(400)
+    cases = [
+        ('escpos_text[small]', lambda: bench_function(lambda: ps.build_escpos_from_text(small), min_time)),
+        ('escpos_text[large]', lambda: bench_function(lambda: ps.build_escpos_from_text(large), min_time)),
+        ('escpos_text[qr_text]', lambda: bench_function(
+            lambda: ps.build_escpos_from_text(small, qr_text='https://example.com/v?id=12345'), min_time)),
+        ('escpos_order[small]', lambda: bench_function(lambda: ps.build_escpos_from_order(small_order), min_time)),
+        ('escpos_order[large]', lambda: bench_function(lambda: ps.build_escpos_from_order(large_order), min_time)),
+        ('safe_encode_text[small]', lambda: bench_function(lambda: ps.safe_encode_text(small), min_time)),
+        ('safe_encode_text[large]', lambda: bench_function(lambda: ps.safe_encode_text(large), min_time)),
+    ]
+    for pixels in (128, 256, 512, 1024):
+        qr = make_qr_png(pixels)
+        # Sin caché (conversión completa) y con la caché de rasters caliente
+        cases.append((f'qr_raster[{pixels}px]',
+                      lambda qr=qr: bench_function(lambda: ps._build_qr_raster_data(qr), min_time)))
+    qr = make_qr_png(256)
+    cases.append(('qr_raster[256px,cached]',
+                  lambda: bench_function(lambda: ps.create_qr_raster_data(qr), min_time)))
+
+    for pages in (1, 5, 20):
+        pdf = make_pdf(pages)
+        cases.append((f'print_pdf_file[{pages}p]',
+                      lambda pdf=pdf: bench_function(lambda: ps.print_pdf_file(pdf, BENCH_PRINTER), min_time)))
+
+    text_body = json.dumps({'text': small, 'printer': BENCH_PRINTER}).encode('utf-8')
+    order_body = json.dumps({'order': small_order, 'printer': BENCH_PRINTER}).encode('utf-8')
+    # Cierre de mesa: comanda, ticket, cajón y corte en una sola petición
+    batch_body = json.dumps({'printer': BENCH_PRINTER, 'contiguous': True, 'jobs': [
+        {'type': 'text', 'text': small}, {'type': 'order', 'order': small_order},
+        {'type': 'drawer'}, {'type': 'cut'}]}).encode('utf-8')
+    pdf_body = make_pdf(1)
+    cases += [
+        ('http_print_text', lambda: bench_http(
+            '/print_text', lambda: ('application/json', text_body), http_jobs)),
+        ('http_print_order', lambda: bench_http(
+            '/print_order', lambda: ('application/json', order_body), http_jobs)),
+        ('http_print_batch[4 jobs]', lambda: bench_http(
+            '/print_batch', lambda: ('application/json', batch_body), max(4, http_jobs // 4))),
+        ('http_print_pdf[1p]', lambda: bench_http(
+            f'/print?printer={BENCH_PRINTER}', lambda: ('application/pdf', pdf_body), max(4, http_jobs // 10))),
+        (f'http_concurrent[{connections} conns]', lambda: bench_concurrent(text_body, connections, 'waitress')),
+    ]
+    if ps.ASGI_AVAILABLE:
+        cases += [
+            ('http_print_text[asgi]', lambda: bench_http(
+                '/print_text', lambda: ('application/json', text_body), http_jobs, server='asgi')),
+            ('http_print_pdf[1p,asgi]', lambda: bench_http(
+                f'/print?printer={BENCH_PRINTER}', lambda: ('application/pdf', pdf_body), max(4, http_jobs // 10),
+                server='asgi')),
+            (f'http_concurrent[{connections} conns,asgi]', lambda: bench_concurrent(
+                text_body, connections, 'asgi')),
+        ]
+    return cases
+
+
+def configure_server(pdf_render):
+    """Servidor con una impresora loopback, sin diario, archivo ni límites."""
+    ps.set_logging('WARNING', '')
+    ps.configure_printers([f'{BENCH_PRINTER}=loopback'])
+    ps.set_job_journal('')
+    ps.set_pdf_archive('', 0, 0)
+    ps.set_templates_dir('')
+    ps.set_admission_limits(0, 0, 0, 1)
+    ps.set_pdf_render_options(pdf_render, ps.PAPER_WIDTH_MM, ps.DOTS_PER_MM, False)
+    ps.start_print_worker()
+
+
+# --- Informe ---
+
+def compare(results, baseline, threshold):
+    """Tabla comparada con la referencia. Devuelve los casos que empeoran
+    más de ``threshold`` (fracción) en ops/s."""
+    regressions = []
+    print(f"\n{'caso':<28} {'ops/s':>10} {'ref':>10} {'Δ':>8} {'p50 ms':>9} {'ref':>9}")
+    for name, result in results.items():
+        ref = baseline.get(name)
+        if not ref:
+            print(f"{name:<28} {result['ops_s']:>10.1f} {'-':>10} {'':>8} {result['p50_ms']:>9.3f} {'-':>9}")
+            continue
+        delta = (result['ops_s'] - ref['ops_s']) / ref['ops_s'] if ref['ops_s'] else 0.0
+        flag = ' ⚠️' if delta < -threshold else ''
+        print(f"{name:<28} {result['ops_s']:>10.1f} {ref['ops_s']:>10.1f} {delta:>+8.1%} "
+              f"{result['p50_ms']:>9.3f} {ref['p50_ms']:>9.3f}{flag}")
+        if delta < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks del servidor de impresión')
+    parser.add_argument('-k', dest='filters', action='append', default=[],
+                        help='Ejecutar solo los casos cuyo nombre contenga este texto (repetible)')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='Segundos mínimos de medición por caso (default: %(default)s)')
+    parser.add_argument('--http-jobs', type=int, default=400,
+                        help='Trabajos enviados en las pruebas HTTP (default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=200,
+                        help='Clientes simultáneos en las pruebas http_concurrent (default: %(default)s)')
+    parser.add_argument('--pdf-render', choices=['zoom', 'fit'], default=ps.PDF_RENDER_MODE,
+                        help='Modo de renderizado de PDFs (default: %(default)s)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Fichero JSON de referencia (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Guardar los resultados como nueva referencia')
+    parser.add_argument('--compare', action='store_true',
+                        help='Comparar con la referencia y salir con error si algo empeora')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Porcentaje de caída de ops/s considerado regresión (default: %(default)s)')
+    parser.add_argument('--json', dest='json_output',
+                        help='Guardar también los resultados en este fichero JSON')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    configure_server(args.pdf_render)
+
+    results = {}
+    print(f"{'caso':<28} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'pico KB':>9}")
+    for name, run in build_cases(args.min_time, args.http_jobs, args.connections):
+        if args.filters and not any(f in name for f in args.filters):
+            continue
+        result = results[name] = run()
+        peak = f"{result['peak_kb']:>9.1f}" if result['peak_kb'] is not None else f"{'-':>9}"
+        print(f"{name:<28} {result['ops_s']:>10.1f} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {peak}")
+
+    if args.json_output:
+        with open(args.json_output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    status = 0
+    if args.compare:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f"\n✗ No hay referencia en {args.baseline} (use --save-baseline)")
+            return 1
+        regressions = compare(results, baseline, args.threshold / 100)
+        if regressions:
+            print(f"\n✗ {len(regressions)} casos más lentos que la referencia: {', '.join(regressions)}")
+            status = 1
+        else:
+            print("\n✓ Sin regresiones respecto a la referencia")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\n✓ Referencia guardada en {args.baseline}")
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""Codificación de imágenes a raster ESC/POS (GS v 0).
+
+Empaqueta los píxeles con operaciones en bloque de PIL (``point`` + ``tobytes``)
+o NumPy (``packbits``) en lugar de recorrer la imagen píxel a píxel en Python.
+Formato de salida: cada byte = 8 píxeles horizontales (MSB primero),
+1 = punto negro, 0 = blanco; filas rellenadas a la derecha con blanco.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+GS = b'\x1D'
+DEFAULT_THRESHOLD = 128
+
+
+def raster_header(width_bytes: int, height: int, mode: int = 0) -> bytes:
+    """Cabecera ESC/POS raster: GS v 0 m xL xH yL yH."""
+    return GS + b'v' + b'0' + bytes([
+        mode,
+        width_bytes & 0xFF, (width_bytes >> 8) & 0xFF,
+        height & 0xFF, (height >> 8) & 0xFF,
+    ])
+
+
+def _pack_numpy(array, threshold: int):
+    import numpy as np  # Opcional: solo si el llamante ya trabaja con NumPy
+
+    if array.ndim != 2:
+        raise ValueError(f"Se esperaba un array 2D, recibido {array.ndim}D")
+    # Booleano: True = negro. Numérico: niveles de gris, oscuro = negro.
+    dots = array if array.dtype == bool else array < threshold
+    packed = np.packbits(dots, axis=1)  # Relleno de fila con ceros (blanco)
+    h, width_bytes = packed.shape
+    return width_bytes, h, packed.tobytes()
+
+
+def pack_image(img, threshold: int = DEFAULT_THRESHOLD):
+    """Empaquetar una imagen PIL o array NumPy en bits raster ESC/POS.
+
+    Devuelve ``(width_bytes, height, data)``.
+    """
+    if not isinstance(img, Image.Image):
+        return _pack_numpy(img, threshold)
+
+    gray = img if img.mode == 'L' else img.convert('L')
+    # Invertimos durante el binarizado: en modo '1' el bit 1 es "blanco" para
+    # PIL, pero para ESC/POS 1 = negro, así tobytes() ya da los bytes finales.
+    dots = gray.point(lambda x: 255 if x < threshold else 0, '1')
+    w, h = dots.size
+    return (w + 7) // 8, h, dots.tobytes()
+
+
+def image_to_raster(img, threshold: int = DEFAULT_THRESHOLD) -> bytes:
+    """Convertir una imagen PIL/NumPy en un comando GS v 0 completo."""
+    width_bytes, h, data = pack_image(img, threshold)
+    return raster_header(width_bytes, h) + data
+
+
+def feed_command(dots: int, units_per_dot: float = 1.0) -> bytes:
+    """Avance de papel de ``dots`` puntos con ESC J n (n <= 255 por comando).
+    ``units_per_dot``: unidades de movimiento vertical de la impresora por punto
+    (1 si la unidad es 1/203", la habitual; 360/203 en modelos a 1/360")."""
+    units = round(dots * units_per_dot)
+    out = bytearray()
+    while units > 0:
+        n = min(units, 255)
+        out += b'\x1BJ' + bytes([n])
+        units -= n
+    return bytes(out)
+
+
+class RasterOptimizer:
+    """Reduce los bytes raster de una página que se envía por bandas.
+
+    * Las series de al menos ``min_blank_rows`` filas en blanco no se envían:
+      se sustituyen por un avance de papel (ESC J n).
+    * Cada bloque se recorta por la derecha a las columnas con algún punto
+      (el raster va alineado a la izquierda, así que no cambia la posición).
+    * El blanco pendiente al final se acumula con la banda siguiente y se
+      descarta al terminar la página (``finish``).
+
+    Si ``units_per_dot`` no es entero, el redondeo se arrastra de un avance
+    al siguiente para que el total no se desvíe a lo largo de la página.
+    """
+
+    def __init__(self, min_blank_rows: int = 8, units_per_dot: float = 1.0, trim_right: bool = True):
+        self.min_blank_rows = max(1, min_blank_rows)
+        self.units_per_dot = units_per_dot
+        self.trim_right = trim_right
+        self._pending_blank = 0
+        self._feed_error = 0.0  # Unidades pedidas y no avanzadas por el redondeo
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, img, threshold: int = DEFAULT_THRESHOLD) -> bytes:
+        """Comandos ESC/POS de una banda (imagen PIL/NumPy)."""
+        width_bytes, h, data = pack_image(img, threshold)
+        return self.add_packed(width_bytes, h, data)
+
+    def add_packed(self, width_bytes: int, height: int, data: bytes) -> bytes:
+        self.bytes_in += len(raster_header(width_bytes, height)) + len(data)
+        out = bytearray()
+        block_start = None  # primera fila del bloque con contenido en curso
+        block_width = 0
+        blank = 0
+        for row in range(height):
+            used = len(data[row * width_bytes:(row + 1) * width_bytes].rstrip(b'\x00'))
+            if not used:
+                blank += 1
+                continue
+            if blank:
+                if block_start is None or blank >= self.min_blank_rows:
+                    # Cerrar el bloque anterior y avanzar el papel en su lugar
+                    if block_start is not None:
+                        out += self._block(data, width_bytes, block_start, row - blank, block_width)
+                        block_start = None
+                    self._pending_blank += blank
+                blank = 0
+            if block_start is None:
+                out += self._feed(self._pending_blank)
+                self._pending_blank = 0
+                block_start, block_width = row, 0
+            block_width = max(block_width, used)
+
+        if block_start is not None:
+            out += self._block(data, width_bytes, block_start, height - blank, block_width)
+        self._pending_blank += blank
+        self.bytes_out += len(out)
+        return bytes(out)
+
+    def finish(self, keep_trailing: bool = False) -> bytes:
+        """Fin de página: el blanco final se descarta (o se avanza si
+        ``keep_trailing``)."""
+        pending, self._pending_blank = self._pending_blank, 0
+        out = self._feed(pending) if keep_trailing else b''
+        self.bytes_out += len(out)
+        return out
+
+    def _feed(self, dots: int) -> bytes:
+        exact = dots * self.units_per_dot + self._feed_error
+        units = round(exact)
+        self._feed_error = exact - units
+        return feed_command(units)
+
+    def _block(self, data, width_bytes, start, end, used_width):
+        width = used_width if self.trim_right else width_bytes
+        if width == width_bytes:
+            rows = data[start * width_bytes:end * width_bytes]
+        else:
+            rows = b''.join(data[r * width_bytes:r * width_bytes + width] for r in range(start, end))
+        return raster_header(width, end - start) + rows
+
+
+class RasterCache:
+    """Caché LRU de bloques ESC/POS ya generados (QR, logos, cabeceras).
+
+    La clave es un hash del contenido de origen y de los parámetros, así una
+    reimpresión no vuelve a decodificar, redimensionar ni empaquetar la imagen.
+    Está limitada tanto en número de entradas como en bytes totales.
+    """
+
+    def __init__(self, max_entries: int = 128, max_bytes: int = 8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part if isinstance(part, bytes) else str(part).encode('utf-8')
+            digest.update(len(data).to_bytes(8, 'big'))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def get_or_create(self, key_parts, builder) -> bytes:
+        """Devolver el bloque cacheado o generarlo con ``builder()``.
+        Los resultados vacíos (errores) no se guardan."""
+        key = self.make_key(*key_parts)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+
+        data = builder()
+        if data and len(data) <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = data
+                    self._bytes += len(data)
+                    while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                        _, evicted = self._entries.popitem(last=False)
+                        self._bytes -= len(evicted)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,137 @@
+"""Control de flujo adaptativo hacia la impresora.
+
+Sustituye a las pausas fijas del hilo de impresión y a la consulta del
+spooler antes de cada trabajo:
+
+* La profundidad del spooler se consulta como mucho cada ``status_ttl``
+  segundos (el valor se reutiliza entre trabajos).
+* Se estima la velocidad real de vaciado de la impresora a partir de las
+  escrituras grandes (cuando la impresora no da abasto, la escritura se
+  bloquea) y se retienen los envíos si hay más de ``max_backlog_seconds``
+  de datos pendientes.
+* Tras un fallo se espera con backoff exponencial acotado, sin vaciar la cola.
+"""
+import threading
+import time
+
+
+class FlowController:
+    """Ritmo de envío de una impresora según lo que realmente puede absorber."""
+
+    def __init__(self, backend, max_spooler_jobs: int = 5, status_ttl: float = 2.0,
+                 max_backlog_seconds: float = 2.0, backoff_base: float = 0.1,
+                 backoff_max: float = 5.0, max_wait: float = 30.0):
+        self.backend = backend
+        self.max_spooler_jobs = max_spooler_jobs
+        self.status_ttl = status_ttl
+        self.max_backlog_seconds = max_backlog_seconds
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._depth_checked = 0.0
+        self.drain_rate = None  # bytes/s estimados; None = aún sin medir
+        self._backlog = 0.0     # bytes que se estima que la impresora aún no ha impreso
+        self._backlog_at = time.monotonic()
+        self.failures = 0
+        self.throttled_seconds = 0.0
+
+    # --- Antes de enviar ---
+
+    def wait_ready(self, should_stop=lambda: False):
+        """Esperar lo necesario antes del siguiente envío: backoff tras fallos,
+        spooler saturado o datos pendientes en la impresora."""
+        started = time.monotonic()
+        delay = self.backoff_delay()
+        if delay:
+            self._sleep(delay, should_stop)
+
+        while not should_stop() and time.monotonic() - started < self.max_wait:
+            wait = max(self._backlog_wait(), self._spooler_wait())
+            if wait <= 0:
+                break
+            self._sleep(wait, should_stop)
+
+    def backoff_delay(self) -> float:
+        if not self.failures:
+            return 0.0
+        return min(self.backoff_max, self.backoff_base * (2 ** (self.failures - 1)))
+
+    def spooler_depth(self, refresh: bool = False) -> int:
+        """Trabajos en el spooler, reutilizando la última consulta reciente."""
+        now = time.monotonic()
+        if refresh or now - self._depth_checked >= self.status_ttl:
+            depth = self.backend.pending_jobs()
+            with self._lock:
+                self._depth = max(depth, 0)
+                self._depth_checked = now
+        return self._depth
+
+    # --- Después de enviar ---
+
+    def record_write(self, nbytes: int, seconds: float):
+        """Anotar una escritura para estimar la velocidad de vaciado.
+        Solo las escrituras grandes y lentas reflejan el ritmo de la impresora."""
+        with self._lock:
+            self._decay_backlog()
+            self._backlog += nbytes
+            if nbytes >= 16 * 1024 and seconds >= 0.05:
+                sample = nbytes / seconds
+                self.drain_rate = sample if self.drain_rate is None else 0.7 * self.drain_rate + 0.3 * sample
+                # La propia escritura bloqueante ya ha vaciado lo que ha tardado
+                self._backlog = max(0.0, self._backlog - sample * seconds)
+            # Cada envío deja (al menos) un documento más en el spooler
+            self._depth += 1
+
+    def record_result(self, success: bool):
+        with self._lock:
+            self.failures = 0 if success else self.failures + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._decay_backlog()
+            return {
+                'spooler_depth': self._depth,
+                'drain_rate_bps': round(self.drain_rate) if self.drain_rate else None,
+                'backlog_bytes': round(self._backlog),
+                'failures': self.failures,
+                'backoff_s': self.backoff_delay(),
+                'throttled_s': round(self.throttled_seconds, 3),
+            }
+
+    # --- Implementación ---
+
+    def _decay_backlog(self):
+        now = time.monotonic()
+        if self.drain_rate:
+            self._backlog = max(0.0, self._backlog - self.drain_rate * (now - self._backlog_at))
+        else:
+            self._backlog = 0.0
+        self._backlog_at = now
+
+    def _backlog_wait(self) -> float:
+        with self._lock:
+            self._decay_backlog()
+            if not self.drain_rate:
+                return 0.0
+            return self._backlog / self.drain_rate - self.max_backlog_seconds
+
+    def _spooler_wait(self) -> float:
+        if self.max_spooler_jobs <= 0:
+            return 0.0
+        if self.spooler_depth() < self.max_spooler_jobs:
+            return 0.0
+        # Saturado: volver a consultar tras un intervalo corto
+        self.spooler_depth(refresh=True)
+        return min(self.status_ttl, 0.5) if self._depth >= self.max_spooler_jobs else 0.0
+
+    def _sleep(self, seconds, should_stop):
+        end = time.monotonic() + seconds
+        while not should_stop():
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.25))
+        self.throttled_seconds += seconds
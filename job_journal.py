@@ -0,0 +1,276 @@
+"""Diario persistente de trabajos de impresión (SQLite en modo WAL).
+
+Un hilo escritor agrupa todas las operaciones que llegan en una ventana
+corta y las confirma en una única transacción (group commit), de modo que el
+fsync se paga una vez por lote y no por trabajo. ``append`` espera a que el
+lote con sus registros esté en disco: un trabajo confirmado al cliente
+sobrevive a una caída. Al arrancar, los trabajos que quedaron sin terminar
+se devuelven para volver a encolarlos.
+
+Las claves de idempotencia (``IdempotencyKeys``, independientes del diario)
+permiten que un cliente reintente una petición sin que el ticket se imprima
+dos veces.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    idempotency_key TEXT,
+    printer TEXT,
+    created REAL NOT NULL,
+    finished REAL,
+    state TEXT NOT NULL,
+    job TEXT NOT NULL,
+    payload BLOB
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, created);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs(idempotency_key);
+"""
+
+# Campos binarios del trabajo que se guardan en la columna 'payload'
+BINARY_FIELD = 'pdf_bytes'
+
+
+class JournalError(RuntimeError):
+    """Los registros no se pudieron confirmar en disco."""
+
+
+class IdempotencyKeys:
+    """Claves de idempotencia recientes (``key_ttl`` segundos) -> id del trabajo."""
+
+    def __init__(self, key_ttl: float = 86400, max_keys: int = 10000):
+        self.key_ttl = key_ttl
+        self.max_keys = max_keys
+        self._keys = {}  # idempotency_key -> (job_id, creado)
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str, job_id: str):
+        """Asociar una clave de idempotencia a un trabajo nuevo.
+        Devuelve el id del trabajo ya existente si la clave se usó antes."""
+        now = time.time()
+        with self._lock:
+            existing = self._keys.get(key)
+            if existing and now - existing[1] < self.key_ttl:
+                return existing[0]
+            self._keys[key] = (job_id, now)
+            if len(self._keys) > self.max_keys:
+                self._expire(now)
+        return None
+
+    def release(self, key: str, job_id: str):
+        """Liberar una clave reservada si el trabajo no llegó a encolarse."""
+        with self._lock:
+            if self._keys.get(key, (None,))[0] == job_id:
+                del self._keys[key]
+
+    def load(self, entries):
+        """Añadir claves (clave, id, creado) recuperadas del diario."""
+        with self._lock:
+            for key, job_id, created in entries:
+                self._keys[key] = (job_id, created)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _expire(self, now):
+        expired = [k for k, (_, created) in self._keys.items() if now - created >= self.key_ttl]
+        for k in expired:
+            del self._keys[k]
+
+
+class _PendingCommit:
+    """Registros de un ``append`` a la espera de su lote (solo los toca el
+    hilo escritor hasta que ``done`` se activa)."""
+
+    __slots__ = ('remaining', 'error', 'done')
+
+    def __init__(self, ops: int):
+        self.remaining = ops
+        self.error = None
+        self.done = threading.Event()
+
+    def op_done(self, error):
+        self.error = self.error or error
+        self.remaining -= 1
+        if not self.remaining:
+            self.done.set()
+
+
+class JobJournal:
+    """Diario de trabajos con confirmación agrupada y recuperación tras caídas."""
+
+    def __init__(self, path: str, commit_interval: float = 0.005, max_batch: int = 256,
+                 retention_days: float = 7, commit_timeout: float = 10):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.retention_days = retention_days
+        self.commit_timeout = commit_timeout
+        self._ops = queue.Queue()
+        self._idle = threading.Condition()
+        self._unflushed = 0
+        self.commits = 0
+        self.batched_ops = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(SCHEMA)
+
+        self._thread = threading.Thread(target=self._run, name="job-journal", daemon=True)
+        self._thread.start()
+
+    # --- API pública ---
+
+    def append(self, jobs):
+        """Registrar trabajos nuevos y esperar a que el lote que los contiene
+        esté confirmado en disco. Lanza JournalError si falla o tarda más de
+        ``commit_timeout``."""
+        pending = _PendingCommit(len(jobs))
+        for job in jobs:
+            record = {k: v for k, v in job.items() if k != BINARY_FIELD}
+            self._submit(('insert', (
+                job['id'], job.get('idempotency_key'), job.get('printer'), job.get('created', time.time()),
+                'queued', json.dumps(record), job.get(BINARY_FIELD),
+            )), pending)
+        if not jobs:
+            return
+        if not pending.done.wait(self.commit_timeout):
+            raise JournalError(f"El diario no confirmó los trabajos en {self.commit_timeout:g}s")
+        if pending.error is not None:
+            raise JournalError(f"Error escribiendo el diario: {pending.error}")
+
+    def finish(self, job_id: str, success: bool, rejected: bool = False):
+        """Marcar un trabajo como terminado para que no se vuelva a imprimir
+        (asíncrono: si se pierde, el trabajo se reimprime al recuperar).
+        ``rejected`` indica que no llegó a aceptarse: su clave de idempotencia
+        no se recupera al arrancar y el cliente puede reintentar con ella."""
+        state = 'rejected' if rejected else ('done' if success else 'failed')
+        self._submit(('finish', (state, time.time(), job_id)))
+
+    def recent_keys(self, key_ttl: float):
+        """Claves de idempotencia de los últimos ``key_ttl`` segundos:
+        (clave, id, creado). Las de trabajos rechazados no cuentan."""
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT idempotency_key, id, created FROM jobs "
+                "WHERE idempotency_key IS NOT NULL AND state != 'rejected' AND created >= ?",
+                (time.time() - key_ttl,)
+            ).fetchall()
+
+    def flush(self, timeout: float = 5) -> bool:
+        """Esperar a que todo lo encolado esté confirmado en disco."""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._unflushed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def recover(self):
+        """Trabajos registrados que no llegaron a terminar, en orden de llegada."""
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT job, payload FROM jobs WHERE state = 'queued' ORDER BY created"
+            ).fetchall()
+        jobs = []
+        for record, payload in rows:
+            job = json.loads(record)
+            if payload is not None:
+                job[BINARY_FIELD] = bytes(payload)
+            jobs.append(job)
+        return jobs
+
+    def stats(self) -> dict:
+        return {
+            'path': self.path,
+            'commits': self.commits,
+            'ops': self.batched_ops,
+            'pending_ops': self._ops.qsize(),
+        }
+
+    # --- Implementación ---
+
+    def _submit(self, op, pending=None):
+        with self._idle:
+            self._unflushed += 1
+        self._ops.put((op, pending))
+
+    def _run(self):
+        last_prune = 0.0
+        while True:
+            batch = [self._ops.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._ops.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            error = None
+            try:
+                self._commit([op for op, _ in batch])
+            except Exception as e:
+                error = e
+                logger.error("✗ Error escribiendo el diario de trabajos: %s", e)
+            for _, pending in batch:
+                if pending is not None:
+                    pending.op_done(error)
+
+            with self._idle:
+                self._unflushed -= len(batch)
+                if not self._unflushed:
+                    self._idle.notify_all()
+
+            if time.monotonic() - last_prune > 3600:
+                last_prune = time.monotonic()
+                self._prune()
+
+    def _commit(self, batch):
+        with self._db_lock:
+            self._commit_locked(batch)
+        self.commits += 1
+        self.batched_ops += len(batch)
+
+    def _commit_locked(self, batch):
+        cur = self._conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            for kind, params in batch:
+                if kind == 'insert':
+                    cur.execute(
+                        "INSERT OR IGNORE INTO jobs (id, idempotency_key, printer, created, state, job, payload) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", params)
+                else:
+                    cur.execute("UPDATE jobs SET state = ?, finished = ?, payload = NULL WHERE id = ?", params)
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+    def _prune(self):
+        if not self.retention_days:
+            return
+        try:
+            cutoff = time.time() - self.retention_days * 86400
+            with self._db_lock:
+                self._conn.execute("DELETE FROM jobs WHERE state != 'queued' AND created < ?", (cutoff,))
+        except Exception as e:
+            logger.error("✗ Error podando el diario de trabajos: %s", e)
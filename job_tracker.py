@@ -0,0 +1,105 @@
+"""Seguimiento del estado de los trabajos de impresión.
+
+Cada trabajo pasa por queued -> rendering -> sending -> done/failed y se
+guarda la hora de cada etapa. Los clientes pueden esperar un cambio de
+estado (long-poll o server-sent events) en lugar de sondear, y los oyentes
+(``add_listener``) reciben cada cambio de estado (canal WebSocket, modo asyncio).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+STATES = ('queued', 'rendering', 'sending', 'done', 'failed')
+FINAL_STATES = ('done', 'failed')
+
+
+class JobTracker:
+    """Estados de los trabajos en memoria, con espera eficiente de cambios.
+    Se conservan como mucho ``max_jobs`` trabajos (los más antiguos se olvidan)."""
+
+    def __init__(self, max_jobs: int = 5000):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._changed = threading.Condition()
+        self._listeners = []
+
+    def create(self, job: dict):
+        status = {
+            'job_id': job['id'],
+            'type': job.get('type'),
+            'printer': job.get('printer'),
+            'state': 'queued',
+            'timestamps': {'queued': job.get('created', time.time())},
+            'error': None,
+        }
+        with self._changed:
+            self._jobs[job['id']] = status
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+            self._changed.notify_all()
+
+    def update(self, job_id: str, state: str, error: str = None):
+        with self._changed:
+            status = self._jobs.get(job_id)
+            if status is None or status['state'] in FINAL_STATES:
+                return
+            status['state'] = state
+            status['timestamps'][state] = time.time()
+            if error:
+                status['error'] = error
+            self._changed.notify_all()
+            if not self._listeners:
+                return
+            changed, listeners = self._copy(status), list(self._listeners)
+        # Fuera del lock: un oyente lento no frena al hilo de impresión
+        for listener in listeners:
+            listener(changed)
+
+    def add_listener(self, listener):
+        """Llamar a ``listener(estado)`` en cada cambio de estado de un trabajo
+        (en el hilo que lo cambia: debe volver enseguida)."""
+        with self._changed:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._changed:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def get(self, job_id: str):
+        with self._changed:
+            status = self._jobs.get(job_id)
+            return self._copy(status) if status else None
+
+    def wait(self, job_id: str, timeout: float, known_state: str = None):
+        """Esperar hasta ``timeout`` segundos a que el estado cambie respecto a
+        ``known_state`` (o, si no se indica, a que el trabajo termine).
+        Devuelve el estado actual, o None si el trabajo no existe."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                status = self._jobs.get(job_id)
+                if status is None:
+                    return None
+                if known_state is not None and status['state'] != known_state:
+                    break
+                if known_state is None and status['state'] in FINAL_STATES:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return self._copy(status)
+
+    def counts(self) -> dict:
+        with self._changed:
+            counts = dict.fromkeys(STATES, 0)
+            for status in self._jobs.values():
+                counts[status['state']] += 1
+            return counts
+
+    @staticmethod
+    def _copy(status):
+        copy = dict(status)
+        copy['timestamps'] = dict(status['timestamps'])
+        return copy
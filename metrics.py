@@ -0,0 +1,154 @@
+"""Métricas del servidor en el formato de texto de Prometheus.
+
+Implementación mínima sin dependencias: contadores e histogramas con
+etiquetas, y métricas calculadas en el momento de la consulta (profundidad
+de colas, etc.) mediante funciones. ``MetricsRegistry.render`` genera el
+texto que sirve el endpoint ``/metrics``.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Límites de los histogramas de latencia (segundos)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador acumulado por combinación de etiquetas."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, key, (), value
+
+
+class Histogram:
+    """Histograma acumulado (buckets, suma y número de observaciones)."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # etiquetas -> [cuentas por bucket..., suma, n]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Medir la duración del bloque ``with``."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, **labels):
+        """Decorador que mide la duración de cada llamada a la función."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                yield self.name + '_bucket', key, (('le', _format_value(float(bound))),), cumulative
+            yield self.name + '_bucket', key, (('le', '+Inf'),), values[-1]
+            yield self.name + '_sum', key, (), values[-2]
+            yield self.name + '_count', key, (), values[-1]
+
+
+class CallbackMetric:
+    """Métrica cuyo valor se calcula al consultarla: ``func`` devuelve un
+    diccionario {tupla de valores de etiquetas: valor}."""
+
+    def __init__(self, name, help, kind, labels, func):
+        self.name, self.help, self.kind, self.labels = name, help, kind, tuple(labels)
+        self.func = func
+
+    def samples(self):
+        for key, value in sorted(self.func().items()):
+            yield self.name, tuple(str(v) for v in key), (), value
+
+
+class MetricsRegistry:
+    """Conjunto de métricas expuestas en /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, func, labels=(), kind='gauge'):
+        return self._register(CallbackMetric(name, help, kind, labels, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, key, extra, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(metric.labels, key, extra)} {_format_value(value)}")
+            except Exception as e:
+                lines.append(f"# Error calculando {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
@@ -0,0 +1,173 @@
+"""Registro de gráficos guardados en la memoria NV de las impresoras.
+
+En lugar de enviar el raster del logo en cada ticket, la primera vez se
+define en la impresora con GS ( L fn 67 (gráfico NV en formato raster,
+identificado por dos códigos kc1 kc2) y después se imprime con GS ( L fn 69,
+unos pocos bytes por ticket.
+
+La impresora no informa de lo que tiene guardado (el envío es en un solo
+sentido), así que el registro recuerda, por impresora, qué gráficos subió y
+a qué dispositivo. Se vuelven a subir si cambia el dispositivo (impresora
+sustituida), si falla un trabajo que los usaba, si se pide explícitamente
+(``forget``) o cuando pasan ``refresh_seconds`` desde la última subida. La
+memoria NV admite un número limitado de escrituras: las subidas se
+minimizan y el estado se guarda en disco para sobrevivir a reinicios.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+GS = b'\x1D'
+# Tamaño máximo de un gráfico NV raster (GS ( L fn 67), en puntos
+MAX_GRAPHIC_WIDTH = 8192
+MAX_GRAPHIC_HEIGHT = 2304
+KEY_CHARS = [chr(c) for c in range(ord('A'), ord('Z') + 1)] + [chr(c) for c in range(ord('0'), ord('9') + 1)]
+
+
+class GraphicTooLargeError(ValueError):
+    """El gráfico no cabe en la memoria NV de la impresora."""
+
+
+def raster_size(raster: bytes):
+    """(ancho en puntos, alto) de un bloque GS v 0."""
+    return (raster[4] | raster[5] << 8) * 8, raster[6] | raster[7] << 8
+
+
+def define_graphic_command(key: str, width_bytes: int, height: int, data: bytes) -> bytes:
+    """GS ( L / GS 8 L fn 67: definir un gráfico NV raster de un color."""
+    params = bytes([48, 67, 48, ord(key[0]), ord(key[1]), 1,
+                    (width_bytes * 8) & 0xFF, (width_bytes * 8) >> 8, height & 0xFF, height >> 8, 49])
+    size = len(params) + len(data)
+    if size <= 0xFFFF:
+        return GS + b'(L' + bytes([size & 0xFF, size >> 8]) + params + data
+    return GS + b'8L' + size.to_bytes(4, 'little') + params + data
+
+
+def delete_graphic_command(key: str) -> bytes:
+    """GS ( L fn 66: borrar el gráfico NV con esa clave."""
+    return GS + b'(L' + bytes([4, 0, 48, 66, ord(key[0]), ord(key[1])])
+
+
+def print_graphic_command(key: str, scale_x: int = 1, scale_y: int = 1) -> bytes:
+    """GS ( L fn 69: imprimir el gráfico NV con esa clave."""
+    return GS + b'(L' + bytes([6, 0, 48, 69, ord(key[0]), ord(key[1]), scale_x, scale_y])
+
+
+class NvGraphicsRegistry:
+    """Gráficos residentes en la memoria NV de cada impresora.
+
+    ``command`` devuelve los bytes para imprimir un gráfico, precedidos de su
+    definición solo si la impresora aún no lo tiene. Como mucho se guardan
+    ``max_graphics`` por impresora (se reutiliza la clave del más antiguo).
+    """
+
+    def __init__(self, path: str = None, max_graphics: int = 8, refresh_seconds: float = 86400,
+                 max_height: int = MAX_GRAPHIC_HEIGHT):
+        self.path = path
+        self.max_graphics = max_graphics
+        self.refresh_seconds = refresh_seconds
+        self.max_height = min(max_height, MAX_GRAPHIC_HEIGHT)
+        self._lock = threading.Lock()
+        self._printers = {}  # impresora -> {'device': str, 'graphics': {huella: {'key', 'uploaded'}}}
+        self.uploads = 0
+        self.hits = 0
+        self._load()
+
+    def check(self, raster: bytes):
+        """Lanzar GraphicTooLargeError si el gráfico (bloque GS v 0) no cabe
+        como gráfico NV."""
+        width, height = raster_size(raster)
+        if width > MAX_GRAPHIC_WIDTH or height > self.max_height:
+            raise GraphicTooLargeError(
+                f"Logo de {width}x{height} puntos: la memoria NV admite como mucho "
+                f"{MAX_GRAPHIC_WIDTH}x{self.max_height}")
+
+    def command(self, printer: str, device: str, digest: str, raster: bytes) -> bytes:
+        """Bytes ESC/POS para imprimir el gráfico ``digest`` en ``printer``.
+        ``raster`` es el bloque GS v 0 del gráfico (cabecera incluida). Lanza
+        GraphicTooLargeError si no cabe en la memoria NV."""
+        self.check(raster)
+        now = time.time()
+        with self._lock:
+            state = self._printers.get(printer)
+            if state is None or state['device'] != device:
+                if state is not None:
+                    logger.info("🔁 Impresora '%s' cambiada (%s -> %s): se volverán a subir sus gráficos NV",
+                                printer, state['device'], device)
+                state = self._printers[printer] = {'device': device, 'graphics': {}}
+
+            entry = state['graphics'].get(digest)
+            if entry and now - entry['uploaded'] < self.refresh_seconds:
+                self.hits += 1
+                return print_graphic_command(entry['key'])
+
+            key = entry['key'] if entry else self._allocate_key(state['graphics'])
+            state['graphics'][digest] = {'key': key, 'uploaded': now}
+            self.uploads += 1
+            self._save()
+
+        width, height = raster_size(raster)
+        logger.info("⬆️ Gráfico NV '%s' subido a '%s' (%s bytes)", key, printer, len(raster) - 8)
+        return (delete_graphic_command(key)
+                + define_graphic_command(key, width // 8, height, raster[8:])
+                + print_graphic_command(key))
+
+    def forget(self, printer: str = None):
+        """Olvidar lo que tiene una impresora (o todas): se volverá a subir."""
+        with self._lock:
+            if printer is None:
+                self._printers.clear()
+            else:
+                self._printers.pop(printer, None)
+            self._save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'path': self.path,
+                'uploads': self.uploads,
+                'hits': self.hits,
+                'printers': {name: {'device': state['device'], 'graphics': len(state['graphics'])}
+                             for name, state in self._printers.items()},
+            }
+
+    # --- Implementación ---
+
+    def _allocate_key(self, graphics):
+        used = {entry['key'] for entry in graphics.values()}
+        if len(graphics) >= self.max_graphics:
+            # Reutilizar la clave del gráfico subido hace más tiempo
+            oldest = min(graphics, key=lambda d: graphics[d]['uploaded'])
+            return graphics.pop(oldest)['key']
+        for first in KEY_CHARS:
+            for second in KEY_CHARS:
+                key = first + second
+                if key not in used:
+                    return key
+        raise RuntimeError("Sin claves libres para gráficos NV")
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self._printers = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("⚠️ No se pudo leer el registro de gráficos NV %s: %s", self.path, e)
+            self._printers = {}
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self._printers, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("⚠️ No se pudo guardar el registro de gráficos NV %s: %s", self.path, e)
@@ -0,0 +1,103 @@
+"""Archivo opcional en disco de los PDFs recibidos.
+
+La escritura se hace en un hilo en segundo plano para no retrasar la
+petición HTTP ni la impresión, y el directorio se poda según antigüedad
+y número máximo de ficheros.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PdfArchiver:
+    """Guarda copias de los PDFs en ``directory`` desde un hilo propio."""
+
+    def __init__(self, directory: str, max_age_days: float = 30, max_files: int = 1000,
+                 max_pending: int = 32, prune_interval: float = 3600):
+        self.directory = directory
+        self.max_age_days = max_age_days
+        self.max_files = max_files
+        self.prune_interval = prune_interval
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._last_prune = 0.0
+        self._counter = 0
+        self.archived = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="pdf-archive", daemon=True)
+            self._thread.start()
+
+    def submit(self, pdf_bytes: bytes) -> bool:
+        """Encolar un PDF para archivarlo. Nunca bloquea: si hay demasiados
+        pendientes se descarta la copia (la impresión no se ve afectada)."""
+        self.start()
+        try:
+            self._pending.put_nowait((time.time(), pdf_bytes))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("⚠️ Archivo de PDFs saturado: copia descartada")
+            return False
+
+    def _run(self):
+        while True:
+            timestamp, pdf_bytes = self._pending.get()
+            try:
+                self._write(timestamp, pdf_bytes)
+                self.archived += 1
+                if time.monotonic() - self._last_prune > self.prune_interval:
+                    self.prune()
+            except Exception as e:
+                logger.error("✗ Error archivando PDF: %s", e)
+            finally:
+                self._pending.task_done()
+
+    def _write(self, timestamp, pdf_bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        self._counter = (self._counter + 1) % 1000
+        timestamp_str = time.strftime("%Y%m%d_%H%M%S", time.localtime(timestamp))
+        path = os.path.join(self.directory, f"ticket_{timestamp_str}_{self._counter:03d}.pdf")
+        with open(path, 'wb') as f:
+            f.write(pdf_bytes)
+
+    def prune(self):
+        """Borrar los PDFs más antiguos que ``max_age_days`` y los que excedan
+        ``max_files`` (empezando por los más viejos)."""
+        self._last_prune = time.monotonic()
+        try:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.startswith('ticket_') and entry.name.endswith('.pdf'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            return 0
+
+        entries.sort()
+        cutoff = time.time() - self.max_age_days * 86400 if self.max_age_days else None
+        excess = len(entries) - self.max_files if self.max_files else 0
+        removed = 0
+        for i, (mtime, path) in enumerate(entries):
+            if i < excess or (cutoff is not None and mtime < cutoff):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    logger.error("✗ No se pudo borrar %s: %s", path, e)
+        if removed:
+            logger.info("🧹 Archivo de PDFs: %s ficheros antiguos eliminados", removed)
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            'directory': self.directory,
+            'archived': self.archived,
+            'dropped': self.dropped,
+            'pending': self._pending.qsize(),
+        }
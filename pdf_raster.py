@@ -0,0 +1,186 @@
+"""Rasterizado de páginas PDF a ESC/POS (GS v 0), en el propio proceso o en
+un pool de procesos.
+
+Las funciones no dependen de la configuración global del servidor (reciben
+un ``RenderOptions``), así que pueden ejecutarse en procesos hijos. Con
+``PdfRenderPool`` las páginas de un PDF largo se renderizan en paralelo y se
+devuelven en orden, cada una en cuanto ella y las anteriores están listas.
+El PDF se copia una sola vez a memoria compartida; cada tarea lleva solo la
+clave del documento y el número de página.
+"""
+import time
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from escpos_raster import RasterOptimizer, image_to_raster, pack_image, raster_header
+
+# mode: 'zoom' (x2.5 en color, como siempre) o 'fit' (ancho del cabezal en grises).
+# min_blank_rows: series de filas en blanco sustituidas por avance de papel
+# (0 = enviar todas las filas); feed_units_per_dot: unidades de ESC J por punto.
+RenderOptions = namedtuple('RenderOptions',
+                           'mode width_dots crop band_height threshold min_blank_rows feed_units_per_dot')
+
+
+def find_content_area(page, margin: float = 2):
+    """Rectángulo (en puntos de la página) que contiene todo lo no blanco.
+    Se calcula sobre una miniatura en grises a 72 DPI."""
+    pix = page.get_pixmap(colorspace=fitz.csGRAY, alpha=False)
+    img = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+    bbox = img.point(lambda x: 255 if x < 250 else 0).getbbox()
+    if not bbox:
+        return page.rect  # Página en blanco: no recortar
+    x0, y0, x1, y1 = bbox
+    area = fitz.Rect(pix.x + x0 - margin, pix.y + y0 - margin,
+                     pix.x + x1 + margin, pix.y + y1 + margin)
+    return area & page.rect
+
+
+def page_render_params(page, options: RenderOptions):
+    """Calcular (matriz, área, espacio de color, ancho máximo) para una página
+    según el modo de renderizado."""
+    if options.mode != 'fit':
+        # Zoom >1 para mayor resolución; ajustar si la calidad es baja/alta
+        return fitz.Matrix(2.5, 2.5), page.rect, fitz.csRGB, None
+
+    area = find_content_area(page) if options.crop else page.rect
+    zoom = options.width_dots / area.width
+    return fitz.Matrix(zoom, zoom), area, fitz.csGRAY, options.width_dots
+
+
+def render_page_bands(page, matrix, band_height: int, area=None,
+                      colorspace=None, max_width=None):
+    """Renderizar una página del PDF (o el área indicada) en bandas horizontales
+    de como mucho ``band_height`` filas, usando rectángulos de recorte de fitz."""
+    area = area or page.rect
+    colorspace = colorspace or fitz.csRGB
+    bounds = (area * matrix).irect
+    if band_height <= 0:
+        band_height = bounds.height
+    for y0 in range(bounds.y0, bounds.y1, band_height):
+        y1 = min(y0 + band_height, bounds.y1)
+        # Recortar con un punto de margen y ajustar después a las filas exactas,
+        # para que el redondeo de fitz no duplique ni pierda filas entre bandas
+        clip = fitz.Rect(area.x0, (y0 - 1) / matrix.d,
+                         area.x1, (y1 + 1) / matrix.d) & area
+        pix = page.get_pixmap(matrix=matrix, clip=clip, colorspace=colorspace, alpha=False)
+        mode = "L" if pix.n == 1 else "RGB"
+        img = Image.frombytes(mode, [pix.width, pix.height], pix.samples)
+        width = min(pix.width, max_width) if max_width else pix.width
+        yield img.crop((0, y0 - pix.y, width, y1 - pix.y))
+
+
+def page_packer(options: RenderOptions):
+    """Función banda -> (bytes ESC/POS, bytes raster sin optimizar) y función
+    de fin de página, según las opciones."""
+    if not options.min_blank_rows:
+        def pack(band):
+            raster = image_to_raster(band, threshold=options.threshold)
+            return raster, len(raster)
+        return pack, lambda: b''
+
+    optimizer = RasterOptimizer(options.min_blank_rows, options.feed_units_per_dot)
+
+    def pack(band):
+        width_bytes, height, data = pack_image(band, options.threshold)
+        raw = len(raster_header(width_bytes, height)) + len(data)
+        return optimizer.add_packed(width_bytes, height, data), raw
+    return pack, optimizer.finish
+
+
+def render_page(doc, page_number: int, options: RenderOptions):
+    """Rasterizar una página completa. Devuelve (bloques ESC/POS por banda,
+    segundos de renderizado, segundos de empaquetado, bytes raster sin optimizar)."""
+    page = doc.load_page(page_number)
+    matrix, area, colorspace, max_width = page_render_params(page, options)
+    pack, finish = page_packer(options)
+    chunks, render_seconds, pack_seconds, raw_bytes = [], 0.0, 0.0, 0
+    bands = render_page_bands(page, matrix, options.band_height, area, colorspace, max_width)
+    while True:
+        started = time.perf_counter()
+        band = next(bands, None)
+        render_seconds += time.perf_counter() - started
+        if band is None:
+            break
+        started = time.perf_counter()
+        chunk, raw = pack(band)
+        pack_seconds += time.perf_counter() - started
+        raw_bytes += raw
+        if chunk:
+            chunks.append(chunk)
+    tail = finish()
+    if tail:
+        chunks.append(tail)
+    return chunks, render_seconds, pack_seconds, raw_bytes
+
+
+# --- Pool de procesos ---
+
+_worker_doc = (None, None)  # (memoria compartida del PDF, documento abierto) en cada proceso hijo
+
+
+def _render_page_task(shm_name: str, size: int, page_number: int, options: RenderOptions):
+    """Tarea del proceso hijo: abre el PDF de la memoria compartida
+    ``shm_name`` la primera vez (y lo reutiliza para las demás páginas del
+    mismo documento) y rasteriza una página."""
+    global _worker_doc
+    if _worker_doc[0] != shm_name:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            pdf_bytes = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+        _worker_doc = (shm_name, fitz.open(stream=pdf_bytes, filetype='pdf'))
+    return render_page(_worker_doc[1], page_number, options)
+
+
+class PdfRenderPool:
+    """Pool de procesos para rasterizar páginas en paralelo. Se arranca al
+    primer uso; ``lookahead`` limita las páginas en vuelo (memoria)."""
+
+    def __init__(self, processes: int, lookahead: int = None):
+        self.processes = processes
+        self.lookahead = lookahead or processes * 2
+        self._executor = None
+        self.pages_rendered = 0
+
+    def iter_pages(self, pdf_bytes: bytes, page_count: int, options: RenderOptions):
+        """Generar el resultado de ``render_page`` de cada página, en orden."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes)
+        # Nombre único por documento: los procesos hijos lo usan como clave
+        shm = shared_memory.SharedMemory(name=f'pdf_{uuid.uuid4().hex[:16]}', create=True,
+                                         size=max(1, len(pdf_bytes)))
+        shm.buf[:len(pdf_bytes)] = pdf_bytes
+        pending = deque()
+        next_page = 0
+        try:
+            while next_page < page_count or pending:
+                while next_page < page_count and len(pending) < self.lookahead:
+                    pending.append(self._executor.submit(
+                        _render_page_task, shm.name, len(pdf_bytes), next_page, options))
+                    next_page += 1
+                result = pending.popleft().result()
+                self.pages_rendered += 1
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            # Esperar a las tareas ya en marcha antes de liberar la memoria
+            for future in pending:
+                if not future.cancelled():
+                    try:
+                        future.result()
+                    except Exception:
+                        pass
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -1,20 +1,44 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import os
 import base64
-import win32print
-import win32api
 import time
 import json
 import threading
 import queue
 import argparse
 import sys
+import uuid
+import math
+import logging
 
 import fitz  # PyMuPDF (pip install pymupdf)
 from PIL import Image
 import io
 
+try:
+    import qrcode  # Opcional: generación local del QR (pip install qrcode)
+except ImportError:
+    qrcode = None
+
+from asgi_server import ASGI_AVAILABLE, AsgiApp, serve_asgi
+from escpos_raster import RasterCache, image_to_raster, pack_image, raster_header
+from flow_control import FlowController
+from job_journal import IdempotencyKeys, JobJournal, JournalError
+from job_tracker import FINAL_STATES, JobTracker
+from metrics import MetricsRegistry
+from nv_graphics import GraphicTooLargeError, NvGraphicsRegistry
+from pdf_archive import PdfArchiver
+from pdf_raster import PdfRenderPool, RenderOptions, page_packer, page_render_params, render_page_bands
+from print_scheduler import PriorityJobQueue
+from printer_backends import create_backend
+from rate_limit import RateLimiter
+from server_logging import setup_logging, stop_logging
+from text_encoder import CODE_PAGES, TextEncoder
+from ticket_templates import TemplateLibrary
+from ws_channel import WEBSOCKETS_AVAILABLE, WebSocketChannel
+
 app = Flask(__name__)
+logger = logging.getLogger('printserver')
 #python servidor_impresion.py --origin https://testapp.zapeat.es --port 5000
 
 # Variable global para la URL permitida en CORS
@@ -24,18 +48,171 @@ ALLOWED_ORIGIN = 'https://app.zapeat.es'  # Valor por defecto
 CUT_PAPER_COMMAND = b'\x1D\x56\x00'  # Corte parcial
 OPEN_DRAWER_COMMAND = b'\x1B\x70\x00\x19\xFA'  # Abrir cajón
 
-# Cola y sincronización
-print_queue = queue.Queue()
-print_thread_running = False
-print_lock = threading.Lock()
+# QR a partir del texto (URL VERI*FACTU): 'native' = lo genera la impresora
+# con GS ( k (modelo 2); 'raster' = se genera aquí y se envía como imagen.
+QR_MODE = 'native'
+QR_MODULE_SIZE = 6  # Puntos por módulo (~35mm para una URL VERI*FACTU)
+QR_ERROR_CORRECTION = 'M'
+QR_TARGET_PIXELS = 280  # 35mm * 8 dots/mm
+
+# Archivo en disco de los PDFs recibidos (en segundo plano, con retención).
+# None = no archivar.
+PDF_ARCHIVE_DIR = os.path.join(os.path.expanduser("~"), "PrintedPDFs")
+PDF_ARCHIVE_MAX_AGE_DAYS = 30
+PDF_ARCHIVE_MAX_FILES = 1000
+pdf_archiver = None
+
+# Caché LRU de bloques raster ya generados (QR, logos): las reimpresiones y
+# copias no repiten la decodificación/redimensionado/empaquetado
+raster_cache = RasterCache(max_entries=128, max_bytes=8 * 1024 * 1024)
+
+# Logos guardados en la memoria NV de la impresora (ver nv_graphics): se
+# suben una vez y cada ticket solo envía la orden de imprimirlos.
+# None = enviar el raster del logo en cada ticket.
+NV_GRAPHICS_PATH = os.path.join(os.path.expanduser("~"), "PrintServer", "nv_graphics.json")
+nv_graphics = None
+
+# Codificación de texto: None = modo clásico (sin acentos); una página de
+# códigos (cp850, cp858...) la selecciona con ESC t n e imprime los acentos.
+CODE_PAGE = None
+text_encoder = TextEncoder(CODE_PAGE)
+
+# Plantillas de ticket (ver ticket_templates): /print_order recibe solo los
+# datos del pedido y el ticket se compone con fragmentos ESC/POS precompilados
+TEMPLATES_DIR = os.path.join(os.path.expanduser("~"), "PrintServer", "templates")
+template_library = TemplateLibrary(TEMPLATES_DIR)
+
+# Impresoras con nombre -> especificación del backend (ver printer_backends):
+# win32, win32:Nombre, tcp://host:9100, file:ruta o loopback.
+PRINTER_SPECS = {'default': 'win32'}
+DEFAULT_PRINTER = 'default'
+printer_backends = {}
+
+# Impresión de PDFs por bandas: altura máxima (en puntos) de cada bloque
+# GS v 0. Muchas impresoras ESC/POS limitan la altura por comando. 0 = página
+# completa en un solo bloque y un documento de spooler por página.
+PDF_BAND_HEIGHT = 256
+PDF_PIPELINE_DEPTH = 2  # Bandas renderizadas por adelantado mientras se envían
+
+# Renderizado de PDFs: 'zoom' = zoom fijo 2.5 en RGB (modo clásico);
+# 'fit' = zoom calculado para el ancho útil del cabezal, directamente en grises.
+PDF_RENDER_MODE = 'zoom'
+PAPER_WIDTH_MM = 72  # Ancho imprimible (papel de 80mm -> 72mm útiles)
+DOTS_PER_MM = 8      # ~203 DPI, la densidad habitual de las impresoras térmicas
+PDF_CROP_MARGINS = False  # Recortar márgenes/espacio en blanco de la página
+
+# Rasterizado en paralelo de PDFs largos (ver pdf_raster): procesos del pool
+# (0/1 = en el hilo de impresión) y páginas mínimas para usarlo
+PDF_RENDER_PROCESSES = min(4, max(0, (os.cpu_count() or 1) - 1))
+PDF_PARALLEL_MIN_PAGES = 3
+pdf_render_pool = None
+
+# Optimización del raster de PDFs (ver escpos_raster.RasterOptimizer): las
+# series de al menos estas filas en blanco se sustituyen por ESC J n (0 = no
+# optimizar). RASTER_FEED_DPI = unidades por pulgada de ESC J en la impresora;
+# None = la misma resolución que el cabezal (1 unidad por punto, lo habitual;
+# algunos modelos Epson usan 360).
+PDF_RASTER_MIN_BLANK_ROWS = 8
+RASTER_FEED_DPI = None
+
+# Colas de impresión: una cola y un hilo por impresora
+print_workers = {}
+
+# Diario persistente de trabajos (SQLite WAL): los trabajos encolados
+# sobreviven a un reinicio del servicio. None = sin diario.
+JOURNAL_PATH = os.path.join(os.path.expanduser("~"), "PrintServer", "print_jobs.db")
+
+# Logs (ver server_logging): nivel de la consola/fichero y fichero rotativo
+# con un registro JSON por línea. DEBUG muestra el detalle de cada trabajo.
+LOG_LEVEL = 'INFO'
+LOG_FILE = os.path.join(os.path.expanduser("~"), "PrintServer", "printserver.log")
+job_journal = None
+idempotency_keys = IdempotencyKeys()
+
+# Estado de cada trabajo (queued, rendering, sending, done, failed) para
+# /jobs/<id>; el hilo de impresión anota aquí los trabajos que está procesando
+job_tracker = JobTracker(max_jobs=5000)
+_current_jobs = threading.local()
+
+# Agrupación de trabajos pequeños seguidos (ticket + cajón + corte) en un solo
+# documento: ventana de espera tras el primero y máximo de trabajos por envío.
+COALESCE_WINDOW = 0.02  # segundos; 0 = desactivado
+COALESCE_MAX_JOBS = 16
+COALESCABLE_JOB_TYPES = ('text', 'order', 'drawer', 'cut')
+
+# Planificación por prioridades (cajón > ticket > PDF, ver print_scheduler):
+# segundos de espera que equivalen a subir un nivel de prioridad
+PRIORITY_AGING = 10.0
+# Control de flujo (ver flow_control): máximo de documentos en el spooler
+# antes de retener envíos y cada cuánto se consulta su estado (segundos)
+MAX_SPOOLER_JOBS = 5
+SPOOLER_STATUS_TTL = 2.0
+
+# Admisión de trabajos: límites de cada cola de impresora (trabajos y bytes
+# encolados) y de peticiones por cliente (trabajos/s sostenidos y ráfaga).
+# Al superarlos se responde 429 con Retry-After en vez de encolar sin límite.
+MAX_QUEUE_JOBS = 200
+MAX_QUEUE_BYTES = 64 * 1024 * 1024
+rate_limiter = RateLimiter(rate=20.0, burst=40)
+
+# Endpoints que encolan trabajos y consumen del límite por cliente
+RATE_LIMITED_ENDPOINTS = {'open_cash_drawer', 'print_text_ticket_endpoint', 'print_order_endpoint', 'print_ticket',
+                          'print_batch_endpoint', 'test_print_endpoint'}
+
+# Trabajos por petición a /print_batch (cada uno cuenta para el límite de ritmo)
+MAX_BATCH_JOBS = 50
+
+# Esperas simultáneas en /jobs/<id> (long-poll y SSE). Con waitress cada una
+# ocupa un hilo, así que se arranca con WAITRESS_THREADS hilos más uno por
+# espera: el resto de endpoints siempre tiene hilos libres. Sin hueco, el
+# long-poll devuelve el estado actual y el SSE responde 429.
+MAX_JOB_WATCHERS = 16
+WAITRESS_THREADS = 4
+job_watch_slots = threading.BoundedSemaphore(MAX_JOB_WATCHERS)
+
+# Canal WebSocket (ver ws_channel): una conexión persistente por cliente del
+# TPV, sin preflight CORS por trabajo; el resultado de cada trabajo se envía
+# por la misma conexión. Puerto 0 = desactivado.
+WS_PORT = 0
+WS_TOKEN = None
+ws_channel = None
+
+# Servidor HTTP: 'waitress' (un hilo por petición) o 'asgi' (uvicorn, ver
+# asgi_server): cientos de conexiones en un bucle asyncio, con la aplicación
+# Flask en ASGI_WORKERS hilos y como mucho ASGI_MAX_PENDING peticiones en curso.
+SERVER_MODE = 'waitress'
+ASGI_WORKERS = 8
+ASGI_MAX_PENDING = 512
+asgi_app = None
+
+# Métricas expuestas en /metrics (formato Prometheus, ver metrics.py)
+metrics = MetricsRegistry()
+stage_latency = metrics.histogram(
+    'printserver_stage_seconds', 'Duración de cada etapa del proceso de impresión', ['stage'])
+printer_bytes_sent = metrics.counter(
+    'printserver_printer_bytes_total', 'Bytes enviados a cada impresora', ['printer'])
+raster_bytes = metrics.counter(
+    'printserver_pdf_raster_bytes_total', 'Bytes raster de PDFs antes (raw) y después (sent) de optimizar', ['stage'])
+job_outcomes = metrics.counter(
+    'printserver_jobs_total', 'Trabajos terminados por tipo y resultado (done, failed, rejected)', ['type', 'outcome'])
+
+# Trabajos que no sacan papel y pueden colarse entre bandas/páginas de un PDF
+PREEMPTING_JOB_TYPES = ('drawer',)
+
+
+def cors_headers():
+    return [
+        ('Access-Control-Allow-Origin', ALLOWED_ORIGIN),
+        ('Access-Control-Allow-Headers', 'Content-Type,Authorization'),
+        ('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS'),
+        # NUEVO: Header requerido para peticiones a redes privadas
+        ('Access-Control-Allow-Private-Network', 'true'),
+    ]
 
 
 def add_cors_headers(response):
-    response.headers.add('Access-Control-Allow-Origin', ALLOWED_ORIGIN)
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-    # NUEVO: Header requerido para peticiones a redes privadas
-    response.headers.add('Access-Control-Allow-Private-Network', 'true')
+    for name, value in cors_headers():
+        response.headers.add(name, value)
     return response
 
 # También agregar el manejo explícito de OPTIONS
@@ -49,101 +226,188 @@ def handle_preflight(path=''):
 def after_request(response):
     return add_cors_headers(response)
 
+
+class JobRejectedError(Exception):
+    """Trabajo rechazado por sobrecarga (cola llena o límite de peticiones)."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def rejected_response(error):
+    """Respuesta 429 con Retry-After para un trabajo rechazado."""
+    response = jsonify({'status': 'error', 'message': str(error), 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+
+def request_client():
+    """Clave del cliente para el límite de ritmo: su dirección IP (el Origin
+    lo elige el cliente y no sirve para identificarlo)."""
+    return request.remote_addr or '-'
+
+
+@app.before_request
+def limit_client_rate():
+    """Rechazar con 429, antes de leer el cuerpo, a los clientes que superan
+    su límite de trabajos por segundo."""
+    if request.method != 'POST' or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    wait = rate_limiter.acquire(request_client())
+    if wait:
+        return rejected_response(JobRejectedError('Demasiadas peticiones, reintente más tarde', wait))
+    return None
+
 # --- Utilidades de impresión en RAW (ESC/POS) ---
 
-def get_default_printer_name():
+class UnknownPrinterError(ValueError):
+    """Se pidió imprimir en una impresora que no está configurada."""
+
+
+def resolve_printer(printer=None):
+    """Nombre de impresora configurada (la de por defecto si no se indica)."""
+    name = printer or DEFAULT_PRINTER
+    if name not in PRINTER_SPECS:
+        raise UnknownPrinterError(f"Impresora no configurada: {name}")
+    return name
+
+
+def get_printer_backend(printer=None):
+    """Backend de la impresora (se crea la primera vez que se usa)."""
+    name = resolve_printer(printer)
+    backend = printer_backends.get(name)
+    if backend is None:
+        backend = printer_backends[name] = create_backend(PRINTER_SPECS[name])
+    return backend
+
+
+def get_printer_name(printer=None):
     try:
-        return win32print.GetDefaultPrinter()
+        return get_printer_backend(printer).describe()
     except Exception as e:
-        print(f"Error obteniendo impresora por defecto: {e}")
+        logger.error("Error obteniendo impresora: %s", e)
         return None
 
 
-def print_raw(data: bytes) -> bool:
-    """Enviar bytes RAW directamente a la impresora por defecto usando Win32 API.
-    Esto evita que Windows reinterprete el documento y agrega márgenes de página.
+def mark_current_jobs(state):
+    """Anotar una nueva etapa en los trabajos que procesa este hilo."""
+    for job_id in getattr(_current_jobs, 'ids', ()):
+        job_tracker.update(job_id, state)
+
+
+def record_printer_write(printer, nbytes, seconds):
+    """Pasar al control de flujo de la impresora el tamaño y la duración de una
+    escritura, para estimar su velocidad real, y anotarla en las métricas."""
+    stage_latency.observe(seconds, stage='printer_write')
+    printer_bytes_sent.inc(nbytes, printer=printer or DEFAULT_PRINTER)
+    worker = print_workers.get(printer or DEFAULT_PRINTER)
+    if worker is not None:
+        worker.flow.record_write(nbytes, seconds)
+
+
+def print_raw(data: bytes, printer=None) -> bool:
+    """Enviar bytes RAW directamente a la impresora a través de su backend.
+    Con el spooler de Windows esto evita que reinterprete el documento y agregue
+    márgenes de página. La conexión se reutiliza entre trabajos.
     """
     try:
-        default_printer = get_default_printer_name()
-        if not default_printer:
-            print("✗ No hay impresora por defecto configurada")
-            return False
+        backend = get_printer_backend(printer)
+        mark_current_jobs('sending')
+        started = time.monotonic()
+        backend.write(data)
+        record_printer_write(printer, len(data), time.monotonic() - started)
+        logger.debug("✓ Enviados %s bytes RAW a '%s'", len(data), backend.describe())
+        return True
+    except Exception as e:
+        logger.error("✗ Error enviando RAW a la impresora: %s", e)
+        return False
 
-        hPrinter = win32print.OpenPrinter(default_printer)
-        try:
-            # El tercer parámetro especifica que enviaremos datos en RAW
-            hJob = win32print.StartDocPrinter(hPrinter, 1, ("Python RAW Print", None, "RAW"))
-            win32print.StartPagePrinter(hPrinter)
-            win32print.WritePrinter(hPrinter, data)
-            win32print.EndPagePrinter(hPrinter)
-            win32print.EndDocPrinter(hPrinter)
-            print(f"✓ Enviados {len(data)} bytes RAW a '{default_printer}'")
-            return True
-        finally:
-            win32print.ClosePrinter(hPrinter)
+
+def print_raw_stream(chunks, printer=None) -> bool:
+    """Enviar una secuencia de bloques RAW como un único documento.
+    Cada bloque se escribe en cuanto está disponible, sin esperar al resto.
+    """
+    try:
+        backend = get_printer_backend(printer)
+        mark_current_jobs('sending')
+        started = time.monotonic()
+        total = backend.write_stream(chunks)
+        record_printer_write(printer, total, time.monotonic() - started)
+        logger.debug("✓ Enviados %s bytes RAW (streaming) a '%s'", total, backend.describe())
+        return True
     except Exception as e:
-        print(f"✗ Error enviando RAW a la impresora: {e}")
+        logger.error("✗ Error enviando RAW (streaming) a la impresora: %s", e)
         return False
 
 
-def safe_encode_text(text: str) -> bytes:
-    """Codificar texto de manera segura para impresoras térmicas.
-    Intenta múltiples codificaciones y reemplaza caracteres problemáticos.
+def pipelined(items, depth: int = PDF_PIPELINE_DEPTH):
+    """Consumir un iterable producido en un hilo aparte (productor/consumidor).
+    Mientras el consumidor envía un elemento, el productor ya prepara el siguiente.
+    Las excepciones del productor se relanzan en el consumidor.
     """
-    if text is None:
-        text = ""
-    
-    # Reemplazar caracteres problemáticos comunes
-    char_replacements = {
-        'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
-        'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
-        'ñ': 'n', 'Ñ': 'N',
-        'ü': 'u', 'Ü': 'U',
-        '€': 'EUR',
-        '°': 'º',
-        '¿': '?',
-        '¡': '!',
-        '"': '"', '"': '"',
-        ''': "'", ''': "'",
-        '–': '-', '—': '-',
-        '…': '...',
-    }
-    
-    # Aplicar reemplazos
-    for original, replacement in char_replacements.items():
-        text = text.replace(original, replacement)
-    
-    # Lista de codificaciones a probar en orden de preferencia
-    encodings_to_try = [
-        'cp850',    # Code page 850 (Latin-1 con caracteres de caja)
-        'cp437',    # Code page 437 (ASCII extendido)
-        'iso-8859-1',  # Latin-1
-        'cp1252',   # Windows-1252
-        'ascii',    # ASCII puro (último recurso)
-    ]
-    
-    for encoding in encodings_to_try:
+    buffer = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
         try:
-            encoded = text.encode(encoding, errors='replace')
-            print(f"✓ Texto codificado exitosamente con {encoding}")
-            return encoded
+            for item in items:
+                if not put(('item', item)):
+                    return
+            put(('done', None))
         except Exception as e:
-            print(f"✗ Fallo codificación {encoding}: {e}")
-            continue
-    
-    # Si todas las codificaciones fallan, usar ASCII con reemplazo agresivo
-    print("⚠️ Usando codificación ASCII con reemplazo de caracteres")
-    return text.encode('ascii', errors='replace')
+            put(('error', e))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = buffer.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+    finally:
+        # Si el consumidor se detiene antes de tiempo, liberar al productor
+        stop.set()
+        thread.join()
+
+
+def safe_encode_text(text: str) -> bytes:
+    """Codificar texto de manera segura para impresoras térmicas.
+    Una sola pasada con la tabla de sustituciones precompilada (ver text_encoder).
+    """
+    return text_encoder.encode(text)
 
 
+@stage_latency.timed(stage='qr_raster')
 def create_qr_raster_data(qr_base64: str, target_width_mm: int = 35) -> bytes:
-    """Convertir imagen QR en base64 a datos raster ESC/POS con tamaño exacto de 35mm x 35mm."""
+    """Convertir imagen QR en base64 a datos raster ESC/POS con tamaño exacto de 35mm x 35mm.
+    El resultado se guarda en la caché de rasters, indexado por el contenido."""
+    return raster_cache.get_or_create(
+        ('qr-image', qr_base64, QR_TARGET_PIXELS),
+        lambda: _build_qr_raster_data(qr_base64)
+    )
+
+
+def _build_qr_raster_data(qr_base64: str) -> bytes:
     try:
         # Decodificar imagen base64
-        qr_bytes = base64.b64decode(qr_base64)
+        with stage_latency.time(stage='base64_decode'):
+            qr_bytes = base64.b64decode(qr_base64)
         qr_img = Image.open(io.BytesIO(qr_bytes))
         
-        print(f"QR original: {qr_img.size[0]}x{qr_img.size[1]} pixels")
+        logger.debug("QR original: %sx%s pixels", qr_img.size[0], qr_img.size[1])
         
         # Convertir a escala de grises
         gray = qr_img.convert('L')
@@ -152,74 +416,148 @@ def create_qr_raster_data(qr_base64: str, target_width_mm: int = 35) -> bytes:
         # La mayoría de impresoras térmicas POS tienen ~203 DPI (8 dots per mm)
         # 35mm = 35 * 8 = 280 pixels aproximadamente
         # Usar múltiplo de 8 para facilitar el procesamiento raster
-        target_pixels = 280  # 35mm * 8 dots/mm = exactamente 35mm
+        target_pixels = QR_TARGET_PIXELS  # 35mm * 8 dots/mm = exactamente 35mm
         
-        print(f"Redimensionando QR a {target_pixels}x{target_pixels} pixels (35mm x 35mm)")
+        logger.debug("Redimensionando QR a %sx%s pixels (35mm x 35mm)", target_pixels, target_pixels)
         
         # Redimensionar manteniendo aspecto cuadrado y usando NEAREST para mantener definición
         gray = gray.resize((target_pixels, target_pixels), Image.Resampling.NEAREST)
         
-        # Binarizar con threshold optimizado para QR
-        threshold = 128
-        bw = gray.point(lambda x: 0 if x < threshold else 255, '1')
-        
-        # Verificar que el ancho sea múltiplo de 8 (requisito ESC/POS)
-        w, h = bw.size
-        width_bytes = (w + 7) // 8
-        padded_w = width_bytes * 8
-        
-        print(f"Dimensiones finales: {w}x{h} pixels, {width_bytes} bytes por línea")
-        
-        if padded_w != w:
-            print(f"Añadiendo padding: {padded_w - w} pixels")
-            new = Image.new('1', (padded_w, h), 1)  # fondo blanco
-            new.paste(bw, (0, 0))
-            bw = new
-            w = padded_w
-        
-        # Convertir a datos raster ESC/POS
-        pixels = bw.load()
-        raster_data = bytearray()
-        
-        for y in range(h):
-            for xb in range(width_bytes):
-                byte = 0
-                for bit in range(8):
-                    x = xb * 8 + bit
-                    if x < w:
-                        pixel = pixels[x, y]
-                        # En modo '1', pixel == 0 => negro, pixel == 255 => blanco
-                        # Para ESC/POS: 1 = negro, 0 = blanco
-                        bit_val = 1 if pixel == 0 else 0
-                    else:
-                        bit_val = 0  # padding blanco
-                    byte = (byte << 1) | bit_val
-                raster_data.append(byte)
-        
-        # Crear comando ESC/POS raster: GS v 0 m xL xH yL yH
-        GS = b'\x1D'
-        m = 0  # modo normal
-        xL = width_bytes & 0xFF
-        xH = (width_bytes >> 8) & 0xFF
-        yL = h & 0xFF
-        yH = (h >> 8) & 0xFF
-        
-        header = GS + b'v' + b'0' + bytes([m, xL, xH, yL, yH])
-        
-        print(f"Header ESC/POS: GS v 0 {m} {xL} {xH} {yL} {yH}")
-        print(f"Datos raster generados: {len(raster_data)} bytes")
-        
+        # Binarizar y empaquetar en bloque (threshold optimizado para QR)
+        width_bytes, h, raster_data = pack_image(gray, threshold=128)
+        header = raster_header(width_bytes, h)
+
+        logger.debug("Dimensiones finales: %sx%s pixels, %s bytes por línea", gray.size[0], h, width_bytes)
+        logger.debug("Datos raster generados: %s bytes", len(raster_data))
+
         return header + raster_data
     
     except Exception as e:
-        print(f"✗ Error procesando QR: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("✗ Error procesando QR: %s", e)
+        return b''
+
+
+def create_image_raster_data(image_base64: str, max_width: int = None) -> bytes:
+    """Convertir una imagen en base64 (logo, cabecera) a raster GS v 0, reducida
+    si hace falta al ancho del cabezal. Cacheado por contenido y ancho."""
+    max_width = max_width or printer_width_dots()
+    return raster_cache.get_or_create(
+        ('image', image_base64, max_width),
+        lambda: _build_image_raster_data(image_base64, max_width)
+    )
+
+
+def _build_image_raster_data(image_base64: str, max_width: int) -> bytes:
+    try:
+        with stage_latency.time(stage='base64_decode'):
+            image_bytes = base64.b64decode(image_base64)
+        img = Image.open(io.BytesIO(image_bytes))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # Las zonas transparentes se imprimen como papel en blanco
+            img = img.convert('RGBA')
+            background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+            img = Image.alpha_composite(background, img)
+        gray = img.convert('L')
+        if gray.width > max_width:
+            height = max(1, round(gray.height * max_width / gray.width))
+            gray = gray.resize((max_width, height), Image.Resampling.LANCZOS)
+        logger.debug("Imagen convertida a raster: %sx%s pixels", gray.width, gray.height)
+        return image_to_raster(gray, threshold=128)
+    except Exception as e:
+        logger.error("✗ Error procesando imagen: %s", e)
         return b''
 
 
-def build_escpos_from_text(text: str, cut_after: bool = True, qr_base64: str = '') -> bytes:
-    """Construir bytes ESC/POS a partir de texto plano con codificación segura y QR opcional."""
+def create_qr_native_command(qr_text: str) -> bytes:
+    """Comandos ESC/POS GS ( k para que la impresora genere e imprima el QR
+    (modelo 2) a partir del texto, sin enviar ninguna imagen."""
+    GS = b'\x1D'
+    data = qr_text.encode('utf-8')
+    store_len = len(data) + 3
+    ec_level = {'L': 48, 'M': 49, 'Q': 50, 'H': 51}[QR_ERROR_CORRECTION]
+    return b''.join([
+        GS + b'(k' + bytes([4, 0, 49, 65, 50, 0]),               # Modelo 2
+        GS + b'(k' + bytes([3, 0, 49, 67, QR_MODULE_SIZE]),       # Tamaño de módulo
+        GS + b'(k' + bytes([3, 0, 49, 69, ec_level]),             # Corrección de errores
+        GS + b'(k' + bytes([store_len & 0xFF, store_len >> 8, 49, 80, 48]) + data,  # Guardar datos
+        GS + b'(k' + bytes([3, 0, 49, 81, 48]),                   # Imprimir
+    ])
+
+
+@stage_latency.timed(stage='qr_raster')
+def create_qr_raster_from_text(qr_text: str) -> bytes:
+    """Generar el QR localmente y convertirlo a raster GS v 0 de 35mm.
+    El resultado se cachea: las reimpresiones no repiten el proceso."""
+    return raster_cache.get_or_create(
+        ('qr-text', qr_text, QR_ERROR_CORRECTION, QR_TARGET_PIXELS),
+        lambda: _build_qr_raster_from_text(qr_text)
+    )
+
+
+def _build_qr_raster_from_text(qr_text: str) -> bytes:
+    ec_level = {
+        'L': qrcode.constants.ERROR_CORRECT_L, 'M': qrcode.constants.ERROR_CORRECT_M,
+        'Q': qrcode.constants.ERROR_CORRECT_Q, 'H': qrcode.constants.ERROR_CORRECT_H,
+    }[QR_ERROR_CORRECTION]
+    qr = qrcode.QRCode(error_correction=ec_level, box_size=1, border=2)
+    qr.add_data(qr_text)
+    qr.make(fit=True)
+    # Módulos de un número entero de puntos (un escalado no entero los deja
+    # desiguales y cuesta leerlos a 203 dpi); el sobrante se rellena de blanco
+    qr.box_size = max(1, QR_TARGET_PIXELS // (qr.modules_count + 2 * qr.border))
+    code = qr.make_image().get_image().convert('L')
+    size = max(QR_TARGET_PIXELS, code.size[0])
+    img = Image.new('L', (size, size), 255)
+    offset = (size - code.size[0]) // 2
+    img.paste(code, (offset, offset))
+    return image_to_raster(img, threshold=128)
+
+
+def create_qr_from_text(qr_text: str) -> bytes:
+    """Bytes ESC/POS del QR a partir de su texto, según QR_MODE."""
+    try:
+        if QR_MODE == 'raster' and qrcode is not None:
+            return create_qr_raster_from_text(qr_text)
+        return create_qr_native_command(qr_text)
+    except Exception as e:
+        logger.error("✗ Error generando QR desde texto: %s", e)
+        return b''
+
+
+def create_logo_command(logo_base64: str, printer=None) -> bytes:
+    """Bytes ESC/POS de un logo: su raster GS v 0 o, con la memoria NV activa,
+    la orden de imprimir el gráfico guardado (subiéndolo antes si la impresora
+    aún no lo tiene)."""
+    raster = create_image_raster_data(logo_base64)
+    if not raster or nv_graphics is None or printer is None:
+        return raster
+    name = resolve_printer(printer)
+    digest = RasterCache.make_key('image', logo_base64, printer_width_dots())
+    try:
+        return nv_graphics.command(name, get_printer_name(name), digest, raster)
+    except GraphicTooLargeError as e:
+        # Trabajos admitidos antes de validar (p. ej. recuperados del diario)
+        logger.warning("⚠️ %s: se envía como raster", e)
+        return raster
+
+
+def validate_logo(logo_base64: str):
+    """Con la memoria NV activa, comprobar antes de encolar que el logo cabe
+    en ella. Lanza GraphicTooLargeError (400)."""
+    if not logo_base64 or nv_graphics is None:
+        return
+    raster = create_image_raster_data(logo_base64)  # Cacheado: no se repite al imprimir
+    if raster:
+        nv_graphics.check(raster)
+
+
+@stage_latency.timed(stage='escpos_text')
+def build_escpos_from_text(text: str, cut_after: bool = True, qr_base64: str = '', qr_text: str = '',
+                           logo_base64: str = '', printer=None) -> bytes:
+    """Construir bytes ESC/POS a partir de texto plano con codificación segura y QR opcional.
+    El QR puede llegar como imagen PNG en base64 o como el texto a codificar.
+    Opcionalmente se imprime un logo centrado al principio del ticket (desde la
+    memoria NV de ``printer`` si está activa)."""
     
     # Normalizar saltos de línea y eliminar espacios iniciales/finales
     if text is None:
@@ -255,17 +593,27 @@ def build_escpos_from_text(text: str, cut_after: bool = True, qr_base64: str = '
     out = bytearray()
     out += init
     out += set_line_spacing
+    # Seleccionar la página de códigos (ESC @ la restablece, por eso va después)
+    out += text_encoder.select_command
+
+    # Logo o imagen de cabecera centrado
+    if logo_base64:
+        logo_raster = create_logo_command(logo_base64, printer)
+        if logo_raster:
+            out += center_align
+            out += logo_raster
+            out += left_align
 
     # Si hay QR, imprimirlo primero centrado
-    if qr_base64:
-        qr_raster = create_qr_raster_data(qr_base64)
+    if qr_text or qr_base64:
+        qr_raster = create_qr_from_text(qr_text) if qr_text else create_qr_raster_data(qr_base64)
         if qr_raster:
             # Centrar y imprimir QR
             out += center_align
-            out += safe_encode_text("QR Tributario:\n")
+            out += text_encoder.encode_constant("QR Tributario:\n")
             out += ESC + b'd' + bytes([1])  
             out += qr_raster
-            out += safe_encode_text("\nVERI*FACTU\n")
+            out += text_encoder.encode_constant("\nVERI*FACTU\n")
             out += ESC + b'd' + bytes([3])  # Espaciado después del QR
             # Volver a alineación izquierda
             out += left_align
@@ -278,7 +626,7 @@ def build_escpos_from_text(text: str, cut_after: bool = True, qr_base64: str = '
     try:
         body_bytes = safe_encode_text(body_text)
     except Exception as e:
-        print(f"✗ Error en codificación segura: {e}")
+        logger.error("✗ Error en codificación segura: %s", e)
         body_bytes = body_text.encode('ascii', errors='replace')
 
     out += body_bytes
@@ -294,218 +642,658 @@ def build_escpos_from_text(text: str, cut_after: bool = True, qr_base64: str = '
 
 # --- Función de impresión de texto que evita márgenes ---
 
-def print_text_ticket(text: str, cut_after: bool = True, qr_base64: str = '') -> bool:
+def print_text_ticket(text: str, cut_after: bool = True, qr_base64: str = '', printer=None,
+                      qr_text: str = '', logo_base64: str = '') -> bool:
     """Construir y enviar un ticket de texto a la impresora en RAW (ESC/POS) con QR opcional."""
     try:
-        print(f"📝 Preparando impresión de texto ({len(text)} caracteres)")
+        logger.debug("📝 Preparando impresión de texto (%s caracteres)", len(text))
         if qr_base64:
-            print(f"🖼️ Incluyendo QR ({len(qr_base64)} caracteres base64)")
-        
-        data = build_escpos_from_text(text, cut_after=cut_after, qr_base64=qr_base64)
-        print(f"📤 Enviando {len(data)} bytes a impresora")
-        return print_raw(data)
+            logger.debug("🖼️ Incluyendo QR (%s caracteres base64)", len(qr_base64))
+        elif qr_text:
+            logger.debug("🔳 Incluyendo QR desde texto (%s caracteres, modo %s)", len(qr_text), QR_MODE)
+
+        data = build_escpos_from_text(text, cut_after=cut_after, qr_base64=qr_base64, qr_text=qr_text,
+                                      logo_base64=logo_base64, printer=printer)
+        logger.debug("📤 Enviando %s bytes a impresora", len(data))
+        return print_raw(data, printer)
     except Exception as e:
-        print(f"✗ Error en print_text_ticket: {e}")
+        logger.error("✗ Error en print_text_ticket: %s", e)
         return False
 
 
-# --- Mantengo las funciones de cajón y corte usando RAW también ---
+@stage_latency.timed(stage='escpos_order')
+def build_escpos_from_order(order: dict, template: str = 'default', cut_after: bool = True, qr_base64: str = '',
+                            qr_text: str = '', logo_base64: str = '', printer=None) -> bytes:
+    """Construir bytes ESC/POS de un pedido con una plantilla precompilada.
+    Logo y QR se generan igual que en los tickets de texto."""
+    logo = create_logo_command(logo_base64, printer) if logo_base64 else b''
+    qr = b''
+    if qr_text or qr_base64:
+        qr = create_qr_from_text(qr_text) if qr_text else create_qr_raster_data(qr_base64)
+    data = template_library.render(template, order, text_encoder, logo, qr)
+    return data + CUT_PAPER_COMMAND if cut_after else data
+
 
-def open_drawer():
+def print_order_ticket(job, printer=None) -> bool:
+    """Componer un pedido con su plantilla y enviarlo a la impresora en RAW."""
     try:
-        print(f"Abriendo cajón en impresora: {get_default_printer_name()}")
-        return print_raw(OPEN_DRAWER_COMMAND)
+        data = build_order_payload(job)
+        logger.debug("📤 Enviando %s bytes a impresora (plantilla '%s')", len(data), job.get('template'))
+        return print_raw(data, printer)
     except Exception as e:
-        print(f"✗ Error al abrir cajón: {e}")
+        logger.error("✗ Error en print_order_ticket: %s", e)
         return False
 
 
-def cut_paper():
+def build_order_payload(job) -> bytes:
+    return build_escpos_from_order(
+        job['order'],
+        job.get('template', 'default'),
+        cut_after=job.get('cut_after', True),
+        qr_base64=job.get('qr_data', ''),
+        qr_text=job.get('qr_text', ''),
+        logo_base64=job.get('logo_data', ''),
+        printer=job.get('printer')
+    )
+
+
+# --- Mantengo las funciones de cajón y corte usando RAW también ---
+
+def open_drawer(printer=None):
     try:
-        print(f"Enviando comando de corte a: {get_default_printer_name()}")
-        return print_raw(CUT_PAPER_COMMAND)
+        logger.debug("Abriendo cajón en impresora: %s", get_printer_name(printer))
+        return print_raw(OPEN_DRAWER_COMMAND, printer)
     except Exception as e:
-        print(f"✗ Error al cortar papel: {e}")
+        logger.error("✗ Error al abrir cajón: %s", e)
         return False
 
 
-def print_pdf_file(pdf_path: str) -> bool:
-    """Convertir cada página del PDF a imagen y enviarla como ESC/POS raster (GS v 0)."""
+def cut_paper(printer=None):
     try:
-        doc = fitz.open(pdf_path)
+        logger.debug("Enviando comando de corte a: %s", get_printer_name(printer))
+        return print_raw(CUT_PAPER_COMMAND, printer)
+    except Exception as e:
+        logger.error("✗ Error al cortar papel: %s", e)
+        return False
+
+
+def printer_width_dots() -> int:
+    """Ancho útil del cabezal en puntos, redondeado a múltiplo de 8."""
+    return max(8, int(PAPER_WIDTH_MM * DOTS_PER_MM) // 8 * 8)
+
+
+def pdf_render_options(band_height: int = PDF_BAND_HEIGHT) -> RenderOptions:
+    """Opciones de renderizado de PDFs según la configuración actual."""
+    return RenderOptions(PDF_RENDER_MODE, printer_width_dots(), PDF_CROP_MARGINS, band_height, 128,
+                         PDF_RASTER_MIN_BLANK_ROWS, raster_feed_units_per_dot())
+
+
+def raster_feed_units_per_dot() -> float:
+    """Unidades de ESC J por punto del raster (exactamente 1 si el avance
+    tiene la resolución del cabezal)."""
+    return RASTER_FEED_DPI / (DOTS_PER_MM * 25.4) if RASTER_FEED_DPI else 1.0
+
+
+def get_pdf_render_pool(page_count: int):
+    """Pool de procesos para un PDF de ``page_count`` páginas, o None si no
+    compensa (pocas páginas) o está desactivado."""
+    global pdf_render_pool
+    if PDF_RENDER_PROCESSES <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+        return None
+    if pdf_render_pool is None:
+        pdf_render_pool = PdfRenderPool(PDF_RENDER_PROCESSES)
+    return pdf_render_pool
+
+
+def iter_page_bands(doc, page_number: int, options: RenderOptions):
+    """Bloques ESC/POS de una página, banda a banda, en este mismo hilo."""
+    page = doc.load_page(page_number)
+    mat, area, colorspace, max_width = page_render_params(page, options)
+    pack, finish = page_packer(options)
+    bands = render_page_bands(page, mat, options.band_height, area, colorspace, max_width)
+    while True:
+        with stage_latency.time(stage='pdf_render'):
+            band = next(bands, None)
+        if band is None:
+            break
+        with stage_latency.time(stage='raster_pack'):
+            chunk, raw = pack(band)
+        raster_bytes.inc(raw, stage='raw')
+        raster_bytes.inc(len(chunk), stage='sent')
+        if chunk:
+            yield chunk
+    tail = finish()
+    raster_bytes.inc(len(tail), stage='sent')
+    if tail:
+        yield tail
+
+
+def iter_pdf_pages(doc, options: RenderOptions, pdf_bytes: bytes = None):
+    """Generar, por cada página y en orden, sus bloques GS v 0. Si el PDF es
+    largo y se tienen sus bytes, las páginas se rasterizan en paralelo en el
+    pool de procesos y cada una se entrega en cuanto está lista."""
+    pool = get_pdf_render_pool(len(doc)) if pdf_bytes is not None else None
+    if pool is None:
         for p in range(len(doc)):
-            page = doc.load_page(p)
-            # Zoom >1 para mayor resolución; ajustar si la calidad es baja/alta
-            mat = fitz.Matrix(2.5, 2.5)
-            pix = page.get_pixmap(matrix=mat, alpha=False)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-            # Convertir a escala de grises y binarizar (threshold)
-            gray = img.convert('L')
-            threshold = 128
-            bw = gray.point(lambda x: 0 if x < threshold else 255, '1')
-
-            # Asegurar que el ancho sea múltiplo de 8 (padding a la derecha)
-            w, h = bw.size
-            width_bytes = (w + 7) // 8
-            padded_w = width_bytes * 8
-            if padded_w != w:
-                new = Image.new('1', (padded_w, h), 1)  # fondo blanco
-                new.paste(bw, (0, 0))
-                bw = new
-                w = padded_w
-
-            # Construir los bytes raster: cada byte = 8 píxeles horizontales (MSB primero)
-            pixels = bw.load()
-            data = bytearray()
-            for y in range(h):
-                for xb in range(width_bytes):
-                    byte = 0
-                    for bit in range(8):
-                        x = xb * 8 + bit
-                        pixel = pixels[x, y]
-                        # En modo '1', pixel == 0 => negro, pixel == 255 => blanco
-                        bit_val = 1 if pixel == 0 else 0
-                        byte = (byte << 1) | bit_val
-                    data.append(byte)
-
-            # Cabecera ESC/POS raster: GS v 0 m xL xH yL yH
-            ESC = b'\x1B'
-            GS = b'\x1D'
-            m = 0
-            xL = width_bytes & 0xFF
-            xH = (width_bytes >> 8) & 0xFF
-            yL = h & 0xFF
-            yH = (h >> 8) & 0xFF
-            header = GS + b'v' + b'0' + bytes([m, xL, xH, yL, yH])
+            yield iter_page_bands(doc, p, options)
+        return
+    for chunks, render_seconds, pack_seconds, raw in pool.iter_pages(pdf_bytes, len(doc), options):
+        stage_latency.observe(render_seconds, stage='pdf_render')
+        stage_latency.observe(pack_seconds, stage='raster_pack')
+        raster_bytes.inc(raw, stage='raw')
+        raster_bytes.inc(sum(len(chunk) for chunk in chunks), stage='sent')
+        yield chunks
+
+
+def iter_pdf_raster(doc, band_height: int = PDF_BAND_HEIGHT, pdf_bytes: bytes = None):
+    """Generar los bloques ESC/POS de un PDF banda a banda (GS v 0 por banda)."""
+    ESC = b'\x1B'
+    for p, chunks in enumerate(iter_pdf_pages(doc, pdf_render_options(band_height), pdf_bytes)):
+        yield from chunks
+
+        tail = ESC + b'd' + bytes([6])
+        if p == len(doc) - 1:
+            tail += CUT_PAPER_COMMAND
+        yield tail
+
+
+def open_pdf(source):
+    """Abrir un PDF desde su ruta o directamente desde sus bytes en memoria."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype='pdf')
+    return fitz.open(source)
+
+
+def take_preempting_jobs():
+    """Sacar de la cola los trabajos urgentes (cajón) del hilo actual para
+    atenderlos entre bandas o páginas de un PDF largo."""
+    worker = getattr(_current_jobs, 'worker', None)
+    if worker is None or not getattr(_current_jobs, 'preempt', True):
+        return []
+    # Los de un lote contiguo esperan a su turno para salir en orden
+    return worker.queue.take_matching(
+        lambda job: job.get('type') in PREEMPTING_JOB_TYPES and not job.get('group'))
+
+
+def finish_preempting_jobs(jobs, success):
+    """Cerrar los trabajos urgentes atendidos en mitad de un PDF."""
+    worker = getattr(_current_jobs, 'worker', None)
+    for job in jobs:
+        record_job_result(job, success)
+        logger.info("%s Trabajo %s atendido durante un PDF", '✓' if success else '✗', job.get('type'),
+                    extra={'job_id': job.get('id')})
+        if worker is not None:
+            worker.queue.task_done()
+
+
+def interleave_preempting_jobs(chunks, served):
+    """Intercalar en el flujo del PDF los comandos de los trabajos urgentes que
+    lleguen mientras se imprime; se anotan en ``served``."""
+    for chunk in chunks:
+        yield chunk
+        for job in take_preempting_jobs():
+            job_tracker.update(job['id'], 'sending')
+            served.append(job)
+            yield build_job_payload(job)
+
+
+def print_pdf_file(source, printer=None) -> bool:
+    """Convertir cada página del PDF (ruta o bytes) a imagen y enviarla como
+    ESC/POS raster (GS v 0)."""
+    try:
+        doc = open_pdf(source)
+        pdf_bytes = bytes(source) if isinstance(source, (bytes, bytearray, memoryview)) else None
+        if PDF_BAND_HEIGHT > 0:
+            # Modo streaming: renderizar la siguiente banda mientras se envía la
+            # actual; los cajones que lleguen se cuelan entre bandas
+            served = []
+            chunks = pipelined(iter_pdf_raster(doc, PDF_BAND_HEIGHT, pdf_bytes))
+            ok = print_raw_stream(interleave_preempting_jobs(chunks, served), printer)
+            finish_preempting_jobs(served, ok)
+            if not ok:
+                logger.error("✗ Error enviando el PDF como ESC/POS raster por bandas")
+            return ok
 
+        for p, chunks in enumerate(iter_pdf_pages(doc, pdf_render_options(0), pdf_bytes)):
+            # Página completa en un bloque: cabecera GS v 0 + bytes raster
+            ESC = b'\x1B'
             escpos = bytearray()
-            escpos += header
-            escpos += data
+            for chunk in chunks:
+                escpos += chunk
 
             # MEJORA: Añadir más avance y cortar al final con mejor espaciado
             escpos += ESC + b'd' + bytes([6])  # Aumentado el avance para PDFs también
             if p == len(doc) - 1:
                 escpos += CUT_PAPER_COMMAND
 
-            ok = print_raw(bytes(escpos))
+            ok = print_raw(bytes(escpos), printer)
             if not ok:
-                print(f"✗ Error enviando página {p} del PDF como ESC/POS raster")
+                logger.error("✗ Error enviando página %s del PDF como ESC/POS raster", p)
                 return False
 
+            # Entre páginas, atender los trabajos urgentes que hayan llegado
+            for job in take_preempting_jobs():
+                finish_preempting_jobs([job], execute_print_job(job, printer))
+
         return True
     except Exception as e:
-        print(f"✗ Error en print_pdf_file (raster): {e}")
+        logger.error("✗ Error en print_pdf_file (raster): %s", e)
         return False
 
 # --- Endpoints ---
+
+def request_idempotency_key(fields=None):
+    """Clave de idempotencia del cliente: cabecera Idempotency-Key o campo
+    'idempotency_key'. Un reintento con la misma clave no se imprime dos veces."""
+    key = request.headers.get('Idempotency-Key') or (fields or {}).get('idempotency_key')
+    return str(key)[:200] if key else None
+
 @app.route('/open_drawer', methods=['POST'])
 def open_cash_drawer():
     try:
-        job_success = add_print_job({'type': 'drawer'})
-        if job_success:
-            return jsonify({'status': 'success', 'message': 'Comando de cajón añadido a cola'}), 200
+        data = request.get_json(silent=True) or {}
+        job_id = add_print_job({
+            'type': 'drawer',
+            'printer': data.get('printer'),
+            'idempotency_key': request_idempotency_key(data)
+        })
+        if job_id:
+            return jsonify({'status': 'success', 'message': 'Comando de cajón añadido a cola', 'job_id': job_id}), 200
         else:
             return jsonify({'status': 'error', 'message': 'Error al añadir comando a cola'}), 500
+    except UnknownPrinterError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except JobRejectedError as e:
+        return rejected_response(e)
     except Exception as e:
-        print(f"Error en /open_drawer: {e}")
+        logger.error("Error en /open_drawer: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
 @app.route('/cut_paper', methods=['POST'])
 def cut_paper_endpoint():
     try:
-        success = cut_paper()
+        data = request.get_json(silent=True) or {}
+        success = cut_paper(resolve_printer(data.get('printer')))
         if success:
             return jsonify({'status': 'success', 'message': 'Papel cortado correctamente'}), 200
         else:
             return jsonify({'status': 'error', 'message': 'Error al cortar el papel'}), 500
+    except UnknownPrinterError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
-        print(f"Error en /cut_paper: {e}")
+        logger.error("Error en /cut_paper: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
 @app.route('/print_text', methods=['POST'])
 def print_text_ticket_endpoint():
     try:
-        data = request.get_json()
-        if not data or 'text' not in data:
+        with stage_latency.time(stage='request_parse'):
+            data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('text'), str):
             return jsonify({'error': 'No se encontró el texto a imprimir'}), 400
 
-        print(f"📥 Recibida petición de impresión de texto")
-        print(f"📝 Longitud del texto: {len(data['text'])} caracteres")
+        logger.debug("📥 Recibida petición de impresión de texto")
+        logger.debug("📝 Longitud del texto: %s caracteres", len(data['text']))
         
-        # Obtener QR si está presente
-        qr_base64 = data.get('qr_data', '')
-        if qr_base64:
-            print(f"🖼️ QR recibido ({len(qr_base64)} caracteres)")
+        # Misma validación que los trabajos de /print_batch y del canal WebSocket
+        job = job_from_request(dict(data, type='text'))
+        job['idempotency_key'] = request_idempotency_key(data)
+        if job['qr_data']:
+            logger.debug("🖼️ QR recibido (%s caracteres)", len(job['qr_data']))
+        # Alternativa: texto/URL del QR, generado en la impresora o en local
+        if job['qr_text']:
+            logger.debug("🔳 Texto de QR recibido (%s caracteres)", len(job['qr_text']))
         
         # Debug: mostrar primeras líneas del texto
-        lines = data['text'].split('\n')[:5]
-        for i, line in enumerate(lines):
-            print(f"   Línea {i+1}: '{line}'")
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, line in enumerate(data['text'].split('\n')[:5]):
+                logger.debug("   Línea %d: '%s'", i + 1, line)
 
-        job_success = add_print_job({
-            'type': 'text',
-            'text': data['text'],
-            'cut_after': data.get('cut_after', True),
-            'qr_data': qr_base64
-        })
+        job_id = add_print_job(job)
 
-        if job_success:
-            return jsonify({'status': 'success', 'message': 'Texto añadido a cola de impresión'}), 200
+        if job_id:
+            return jsonify({'status': 'success', 'message': 'Texto añadido a cola de impresión', 'job_id': job_id}), 200
         else:
             return jsonify({'status': 'error', 'message': 'Error al añadir texto a cola'}), 500
+    except ValueError as e:  # Impresora desconocida, logo demasiado grande...
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except JobRejectedError as e:
+        return rejected_response(e)
     except Exception as e:
-        print(f"Error en /print_text: {e}")
+        logger.error("Error en /print_text: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
-@app.route('/print', methods=['POST'])
-def print_ticket():
-    """Endpoint para recibir y (opcionalmente) imprimir PDFs."""
+@app.route('/print_order', methods=['POST'])
+def print_order_endpoint():
+    """Imprimir un pedido con una plantilla: el cliente envía solo los datos
+    ('order' con items, precios e IVA) y el nombre de la plantilla."""
     try:
-        data = request.get_json()
-        if not data or 'pdf_data' not in data:
-            return jsonify({'error': 'No se encontraron datos PDF'}), 400
+        with stage_latency.time(stage='request_parse'):
+            data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('order'), dict):
+            return jsonify({'error': 'No se encontraron los datos del pedido'}), 400
+        # Validar plantilla, pedido y logo antes de encolar (errores -> 400)
+        job = job_from_request(dict(data, type='order'))
+        job['idempotency_key'] = request_idempotency_key(data)
+
+        job_id = add_print_job(job)
+
+        if job_id:
+            return jsonify({'status': 'success', 'message': 'Pedido añadido a cola de impresión', 'job_id': job_id}), 200
+        else:
+            return jsonify({'status': 'error', 'message': 'Error al añadir pedido a cola'}), 500
+    except ValueError as e:  # Impresora o plantilla desconocida, pedido no válido...
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except JobRejectedError as e:
+        return rejected_response(e)
+    except Exception as e:
+        logger.error("Error en /print_order: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
-        base64_pdf = data['pdf_data']
 
-        # Guardar PDF temporalmente
-        output_dir = os.path.join(os.path.expanduser("~"), "PrintedPDFs")
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+class InvalidJobError(ValueError):
+    """Trabajo de un lote mal formado (``index``: posición en el lote)."""
+
+    def __init__(self, message, index=None):
+        super().__init__(message)
+        self.index = index
+
+
+def job_from_request(spec, printer=None):
+    """Trabajo de la cola a partir de un elemento de /print_batch. Admite los
+    mismos campos que /print_text, /print_order, /print (PDF en 'pdf_data',
+    base64), /open_drawer y /cut_paper, más 'type'. Lanza ValueError
+    (InvalidJobError, UnknownPrinterError, TemplateError...) si no es válido."""
+    if not isinstance(spec, dict):
+        raise InvalidJobError("cada trabajo debe ser un objeto JSON")
+    job_type = spec.get('type')
+    job = {'type': job_type, 'printer': resolve_printer(spec.get('printer') or printer)}
+    if job_type == 'text':
+        if not isinstance(spec.get('text'), str):
+            raise InvalidJobError("no se encontró el texto a imprimir")
+        job['text'] = spec['text']
+    elif job_type == 'order':
+        if not isinstance(spec.get('order'), dict):
+            raise InvalidJobError("no se encontraron los datos del pedido")
+        job['template'] = spec.get('template') or 'default'
+        job['order'] = spec['order']
+        template_library.get(job['template'], text_encoder).validate(job['order'])
+    elif job_type == 'pdf':
+        if not spec.get('pdf_data'):
+            raise InvalidJobError("no se encontraron datos PDF")
+        with stage_latency.time(stage='base64_decode'):
+            job['pdf_bytes'] = base64.b64decode(spec['pdf_data'], validate=True)
+        if b'%PDF' not in job['pdf_bytes'][:1024]:
+            raise InvalidJobError("los datos recibidos no son un PDF")
+    elif job_type not in ('drawer', 'cut'):
+        raise InvalidJobError(f"tipo de trabajo desconocido: {job_type!r}")
+
+    if job_type in ('text', 'order'):
+        job.update(cut_after=spec.get('cut_after', True), qr_data=spec.get('qr_data', ''),
+                   qr_text=spec.get('qr_text', ''), logo_data=spec.get('logo_data', ''))
+        validate_logo(job['logo_data'])
+    if spec.get('idempotency_key'):
+        job['idempotency_key'] = str(spec['idempotency_key'])[:200]
+    return job
+
+
+def submit_job_specs(specs, printer=None, contiguous=False, idempotency_key=None):
+    """Validar y encolar los trabajos de un lote (/print_batch y canal
+    WebSocket). Devuelve sus ids, en orden. Lanza InvalidJobError si alguno
+    no es válido (no se encola ninguno) y JobRejectedError si no caben."""
+    if not isinstance(specs, list) or not specs:
+        raise InvalidJobError('No se encontraron trabajos en el lote')
+    if len(specs) > MAX_BATCH_JOBS:
+        raise InvalidJobError(f'Como máximo {MAX_BATCH_JOBS} trabajos por lote')
+
+    jobs = []
+    for i, spec in enumerate(specs):
+        try:
+            jobs.append(job_from_request(spec, printer))
+        except ValueError as e:
+            raise InvalidJobError(f'Trabajo {i + 1}: {e}', i) from None
+
+    if idempotency_key:
+        for i, job in enumerate(jobs):
+            job.setdefault('idempotency_key', f'{idempotency_key}#{i}')
+
+    job_ids = add_print_jobs(jobs, contiguous=contiguous)
+    for job in jobs:
+        if job['type'] == 'pdf' and job['id'] in job_ids:
+            archive_pdf(job['pdf_bytes'])
+    logger.debug("📥 Lote de %s trabajos encolado%s", len(jobs), ' (contiguo)' if contiguous else '')
+    return job_ids
+
+
+@app.route('/print_batch', methods=['POST'])
+def print_batch_endpoint():
+    """Varios trabajos (texto, pedido, PDF, cajón, corte) en una sola petición,
+    p. ej. al cerrar una mesa. Se validan todos antes de encolar y se admiten
+    todos o ninguno. Con 'contiguous' los de cada impresora salen seguidos y
+    en el orden enviado; si no, cada uno sigue su prioridad habitual."""
+    try:
+        with stage_latency.time(stage='request_parse'):
+            data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'No se encontraron trabajos en el lote'}), 400
+        specs = data.get('jobs')
+
+        # Cada trabajo cuenta para el límite de ritmo (la petición ya consumió uno)
+        if isinstance(specs, list) and len(specs) > 1:
+            wait = rate_limiter.acquire(request_client(), min(len(specs) - 1, rate_limiter.burst))
+            if wait:
+                return rejected_response(JobRejectedError('Demasiadas peticiones, reintente más tarde', wait))
+
+        job_ids = submit_job_specs(specs, data.get('printer'), bool(data.get('contiguous')),
+                                   request_idempotency_key(data))
+        return jsonify({'status': 'success', 'message': f'{len(job_ids)} trabajos añadidos a cola de impresión',
+                        'job_ids': job_ids}), 200
+    except InvalidJobError as e:
+        body = {'status': 'error', 'message': str(e)}
+        if e.index is not None:
+            body['index'] = e.index
+        return jsonify(body), 400
+    except JobRejectedError as e:
+        return rejected_response(e)
+    except Exception as e:
+        logger.error("Error en /print_batch: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
-        timestamp_str = time.strftime("%Y%m%d_%H%M%S")
-        pdf_path = os.path.join(output_dir, f"ticket_{timestamp_str}.pdf")
 
-        pdf_bytes = base64.b64decode(base64_pdf)
-        with open(pdf_path, 'wb') as f:
-            f.write(pdf_bytes)
+def handle_channel_message(message, client):
+    """Atender una operación de trabajos del canal WebSocket: 'print' (un
+    trabajo en 'job') o 'batch' (como /print_batch). Se ejecuta en un hilo
+    del pool del canal y devuelve la respuesta para el cliente."""
+    op = message.get('op')
+    if op == 'print':
+        specs = [message.get('job')]
+    elif op == 'batch':
+        specs = message.get('jobs')
+    else:
+        return {'op': 'error', 'message': f'Operación desconocida: {op!r}'}
+    try:
+        wait = rate_limiter.acquire(client, min(len(specs) if isinstance(specs, list) else 1, rate_limiter.burst))
+        if wait:
+            raise JobRejectedError('Demasiadas peticiones, reintente más tarde', wait)
+        key = message.get('idempotency_key')
+        job_ids = submit_job_specs(specs, message.get('printer'), bool(message.get('contiguous')),
+                                   str(key)[:200] if key else None)
+        return {'op': 'accepted', 'job_ids': job_ids}
+    except InvalidJobError as e:
+        return {'op': 'error', 'message': str(e), 'index': e.index}
+    except JobRejectedError as e:
+        return {'op': 'rejected', 'message': str(e), 'retry_after': e.retry_after}
+
+
+@app.route('/templates', methods=['GET'])
+def list_templates_endpoint():
+    """Plantillas de ticket disponibles para /print_order."""
+    try:
+        return jsonify({'status': 'success', 'templates': template_library.names()}), 200
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+def read_pdf_upload():
+    """Obtener (bytes del PDF, campos) de la petición a /print.
+
+    Admite el cuerpo binario directo (Content-Type: application/pdf, campos en
+    la query string), multipart/form-data (fichero 'file' o 'pdf') y el JSON
+    clásico con 'pdf_data' en base64. Devuelve (None, campos) si no hay PDF.
+    """
+    with stage_latency.time(stage='request_parse'):
+        if request.mimetype in ('application/pdf', 'application/octet-stream'):
+            return request.get_data(cache=False), request.args
+
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('file') or request.files.get('pdf')
+            return (upload.read() if upload else None), request.form
+
+        data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('pdf_data'), str):
+        return None, data if isinstance(data, dict) else {}
+    with stage_latency.time(stage='base64_decode'):
+        return base64.b64decode(data['pdf_data']), data
+
+
+def archive_pdf(pdf_bytes: bytes):
+    """Guardar una copia del PDF en segundo plano si el archivo está activo."""
+    global pdf_archiver
+    if not PDF_ARCHIVE_DIR:
+        return
+    if pdf_archiver is None:
+        pdf_archiver = PdfArchiver(PDF_ARCHIVE_DIR, PDF_ARCHIVE_MAX_AGE_DAYS, PDF_ARCHIVE_MAX_FILES)
+    pdf_archiver.submit(pdf_bytes)
+
+
+@app.route('/print', methods=['POST'])
+def print_ticket():
+    """Endpoint para recibir y (opcionalmente) imprimir PDFs.
+    El PDF pasa en memoria al rasterizador, sin escribirlo antes a disco."""
+    try:
+        pdf_bytes, fields = read_pdf_upload()
+        if not pdf_bytes:
+            return jsonify({'error': 'No se encontraron datos PDF'}), 400
+        if b'%PDF' not in pdf_bytes[:1024]:
+            return jsonify({'error': 'Los datos recibidos no son un PDF'}), 400
+
+        printer = resolve_printer(fields.get('printer'))
 
         # Añadir a cola de impresión (fallback PDF)
-        job_success = add_print_job({
+        job = {
             'type': 'pdf',
-            'path': pdf_path
-        })
-
-        if job_success:
-            return jsonify({'status': 'success', 'message': 'PDF añadido a cola de impresión (fallback)'}), 200
+            'pdf_bytes': pdf_bytes,
+            'printer': printer,
+            'idempotency_key': request_idempotency_key(fields)
+        }
+        job_id = add_print_job(job)
+        if job_id == job['id']:  # Ni rechazado ni reintento ya registrado
+            archive_pdf(pdf_bytes)
+
+        if job_id:
+            return jsonify({'status': 'success', 'message': 'PDF añadido a cola de impresión (fallback)', 'job_id': job_id}), 200
         else:
             return jsonify({'status': 'error', 'message': 'Error al añadir PDF a cola'}), 500
 
+    except ValueError as e:  # Impresora desconocida, base64 no válido
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except JobRejectedError as e:
+        return rejected_response(e)
     except Exception as e:
-        print(f"Error en /print: {e}")
+        logger.error("Error en /print: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_endpoint(job_id):
+    """Estado de un trabajo con marcas de tiempo por etapa.
+
+    ?wait=N       long-poll: espera hasta N segundos (máx. 60) a que el trabajo
+                  termine, o a que cambie de estado si se indica ?state=actual.
+    ?stream=1     server-sent events (o cabecera Accept: text/event-stream):
+                  un evento por cada cambio de estado hasta que termina.
+    """
+    status = job_tracker.get(job_id)
+    if status is None:
+        return jsonify({'status': 'error', 'message': 'Trabajo no encontrado'}), 404
+
+    streaming = request.args.get('stream') or request.accept_mimetypes.best == 'text/event-stream'
+    wait = min(max(request.args.get('wait', 0, type=float), 0), 60)
+    if not streaming and not wait:
+        return jsonify(status), 200
+    if not job_watch_slots.acquire(blocking=False):
+        if streaming:
+            response = jsonify({'status': 'error', 'message': 'Demasiados clientes esperando trabajos',
+                                'retry_after': 1})
+            response.headers['Retry-After'] = '1'
+            return response, 429
+        return jsonify(status), 200
+
+    if streaming:
+        response = Response(job_event_stream(job_id), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(job_watch_slots.release)
+        return response
+    try:
+        status = job_tracker.wait(job_id, wait, request.args.get('state')) or status
+    finally:
+        job_watch_slots.release()
+    return jsonify(status), 200
+
+
+def job_event_stream(job_id, heartbeat=15):
+    """Generador SSE: emite el estado actual y cada cambio hasta el final."""
+    status, known = job_tracker.get(job_id), None
+    while True:
+        if status is None:
+            return
+        if status['state'] == known:
+            yield ": keepalive\n\n"
+            status = job_tracker.wait(job_id, heartbeat, known)
+            continue
+        known = status['state']
+        yield f"event: {known}\ndata: {json.dumps(status)}\n\n"
+        if known in FINAL_STATES:
+            return
+        status = job_tracker.wait(job_id, heartbeat, known)
+
+
 @app.route('/status', methods=['GET'])
 def server_status():
     try:
-        default_printer = get_default_printer_name()
+        default_printer = get_printer_name()
+        printers = {
+            name: {
+                'device': get_printer_name(name),
+                'backend': get_printer_backend(name).kind,
+                'queued': print_workers[name].queue.qsize() if name in print_workers else 0,
+                'scheduler': print_workers[name].queue.stats() if name in print_workers else None,
+                'flow': print_workers[name].flow.stats() if name in print_workers else None,
+            }
+            for name in PRINTER_SPECS
+        }
         return jsonify({
             'status': 'online',
             'default_printer': default_printer,
+            'printers': printers,
+            'raster_cache': raster_cache.stats(),
+            'pdf_render_pool': {
+                'processes': PDF_RENDER_PROCESSES if PDF_RENDER_PROCESSES > 1 else 0,
+                'min_pages': PDF_PARALLEL_MIN_PAGES,
+                'pages_rendered': pdf_render_pool.pages_rendered if pdf_render_pool else 0,
+            },
+            'pdf_archive': pdf_archiver.stats() if pdf_archiver else None,
+            'nv_graphics': nv_graphics.stats() if nv_graphics else None,
+            'templates': template_library.stats(),
+            'journal': job_journal.stats() if job_journal else None,
+            'idempotency_keys': len(idempotency_keys),
+            'websocket': ws_channel.stats() if ws_channel else None,
+            'asgi': asgi_app.stats() if asgi_app else None,
+            'jobs': job_tracker.counts(),
+            'rate_limit': rate_limiter.stats(),
             'allowed_origin': ALLOWED_ORIGIN,
             'message': 'Servidor de impresión funcionando correctamente (modo RAW para tickets)'
         }), 200
@@ -513,14 +1301,64 @@ def server_status():
         return jsonify({'status': 'error', 'message': f'Error: {str(e)}'}), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas en formato de texto de Prometheus (latencia por etapa, bytes
+    por impresora, trabajos por tipo y resultado, profundidad de colas)."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def worker_metric(func):
+    """Valores por impresora de una métrica calculada a partir de su worker."""
+    return lambda: {(name,): func(worker) for name, worker in list(print_workers.items())}
+
+
+metrics.callback('printserver_queue_depth', 'Trabajos en la cola de cada impresora',
+                 worker_metric(lambda w: w.queue.qsize()), ['printer'])
+metrics.callback('printserver_queue_bytes', 'Bytes de datos en la cola de cada impresora',
+                 worker_metric(lambda w: w.queue.qbytes()), ['printer'])
+metrics.callback('printserver_spooler_depth', 'Documentos estimados en el spooler de cada impresora',
+                 worker_metric(lambda w: w.flow.stats()['spooler_depth']), ['printer'])
+metrics.callback('printserver_queue_rejected_total', 'Trabajos rechazados por cola llena',
+                 lambda: {(name, reason): n for name, w in list(print_workers.items())
+                          for reason, n in w.queue.stats()['rejected'].items()},
+                 ['printer', 'reason'], kind='counter')
+metrics.callback('printserver_rate_limited_total', 'Peticiones rechazadas por el límite por cliente',
+                 lambda: {(): rate_limiter.limited}, kind='counter')
+metrics.callback('printserver_raster_cache_hits_total', 'Aciertos de la caché de rasters',
+                 lambda: {(): raster_cache.hits}, kind='counter')
+metrics.callback('printserver_jobs_by_state', 'Trabajos recientes por estado',
+                 lambda: {(state,): n for state, n in job_tracker.counts().items()}, ['state'])
+
+
+@app.route('/graphics/reset', methods=['POST'])
+def reset_graphics_endpoint():
+    """Olvidar los logos guardados en la memoria NV de una impresora (o de
+    todas) para volver a subirlos, p. ej. tras cambiar o reiniciar la impresora."""
+    try:
+        if nv_graphics is None:
+            return jsonify({'status': 'error', 'message': 'Memoria NV de logos desactivada'}), 400
+        data = request.get_json(silent=True) or {}
+        nv_graphics.forget(resolve_printer(data['printer']) if data.get('printer') else None)
+        return jsonify({'status': 'success', 'message': 'Los logos se volverán a subir en el próximo ticket'}), 200
+    except UnknownPrinterError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
 @app.route('/clear_queue', methods=['POST'])
 def clear_queue_endpoint():
     try:
-        success = clear_print_queue()
+        data = request.get_json(silent=True) or {}
+        names = [resolve_printer(data['printer'])] if data.get('printer') else list(PRINTER_SPECS)
+        success = all([clear_print_queue(name) for name in names])
         if success:
             return jsonify({'status': 'success', 'message': 'Cola de impresión limpiada'}), 200
         else:
             return jsonify({'status': 'error', 'message': 'Error al limpiar cola'}), 500
+    except UnknownPrinterError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -557,18 +1395,25 @@ TOTAL                               16.50
 """
     
     try:
-        job_success = add_print_job({
+        data = request.get_json(silent=True) or {}
+        job_id = add_print_job({
             'type': 'text',
             'text': test_text,
-            'cut_after': True
+            'cut_after': True,
+            'printer': data.get('printer'),
+            'idempotency_key': request_idempotency_key(data)
         })
 
-        if job_success:
-            return jsonify({'status': 'success', 'message': 'Ticket de prueba añadido a cola'}), 200
+        if job_id:
+            return jsonify({'status': 'success', 'message': 'Ticket de prueba añadido a cola', 'job_id': job_id}), 200
         else:
             return jsonify({'status': 'error', 'message': 'Error al añadir ticket de prueba'}), 500
+    except UnknownPrinterError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except JobRejectedError as e:
+        return rejected_response(e)
     except Exception as e:
-        print(f"Error en /test_print: {e}")
+        logger.error("Error en /test_print: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
@@ -584,131 +1429,348 @@ def internal_error(error):
 
 # --- Cola de impresión y worker ---
 
-def clear_print_queue():
-    try:
-        default_printer = get_default_printer_name()
-        print(f"Limpiando cola de impresión de: {default_printer}")
-
-        hPrinter = win32print.OpenPrinter(default_printer)
+def clear_print_queue(printer=None):
+    return get_printer_backend(printer).clear()
+
+
+def execute_print_job(job, printer) -> bool:
+    """Ejecutar un trabajo de la cola en la impresora indicada."""
+    job_type = job.get('type')
+    if job_type == 'pdf':
+        source = job['pdf_bytes'] if job.get('pdf_bytes') is not None else job['path']
+        return print_pdf_file(source, printer)
+    if job_type == 'text':
+        return print_text_ticket(
+            job['text'],
+            job.get('cut_after', True),
+            job.get('qr_data', ''),
+            printer,
+            job.get('qr_text', ''),
+            job.get('logo_data', '')
+        )
+    if job_type == 'order':
+        return print_order_ticket(job, printer)
+    if job_type == 'drawer':
+        return open_drawer(printer)
+    if job_type == 'cut':
+        return cut_paper(printer)
+    return False
+
+
+def build_job_payload(job) -> bytes:
+    """Bytes ESC/POS de un trabajo agrupable (texto, pedido, cajón o corte)."""
+    job_type = job.get('type')
+    if job_type == 'text':
+        return build_escpos_from_text(
+            job['text'],
+            cut_after=job.get('cut_after', True),
+            qr_base64=job.get('qr_data', ''),
+            qr_text=job.get('qr_text', ''),
+            logo_base64=job.get('logo_data', ''),
+            printer=job.get('printer')
+        )
+    if job_type == 'order':
+        return build_order_payload(job)
+    if job_type == 'drawer':
+        return OPEN_DRAWER_COMMAND
+    if job_type == 'cut':
+        return CUT_PAPER_COMMAND
+    raise ValueError(f"Trabajo no agrupable: {job_type}")
+
+
+def execute_print_batch(jobs, printer):
+    """Ejecutar varios trabajos pequeños con una sola escritura en la impresora.
+    Devuelve el resultado de cada trabajo, en el mismo orden."""
+    if len(jobs) == 1:
+        return [execute_print_job(jobs[0], printer)]
+
+    results = [False] * len(jobs)
+    payload = bytearray()
+    included = []
+    for i, job in enumerate(jobs):
         try:
-            jobs = win32print.EnumJobs(hPrinter, 0, -1, 1)
-
-            if jobs:
-                print(f"Encontrados {len(jobs)} trabajos en cola")
-                for job in jobs:
-                    try:
-                        win32print.SetJob(hPrinter, job['JobId'], 0, None, win32print.JOB_CONTROL_DELETE)
-                        print(f"✓ Trabajo {job['JobId']} cancelado")
-                    except Exception as e:
-                        print(f"✗ Error al cancelar trabajo {job['JobId']}: {e}")
-
-                time.sleep(2)
-                print("✓ Cola de impresión limpiada")
-            else:
-                print("Cola de impresión ya está vacía")
-
-        finally:
-            win32print.ClosePrinter(hPrinter)
-        return True
-    except Exception as e:
-        print(f"✗ Error al limpiar cola de impresión: {e}")
-        return False
-
+            payload += build_job_payload(job)
+            included.append(i)
+        except Exception as e:
+            logger.error("✗ Error preparando trabajo %s: %s", job.get('type'), e)
+
+    if included:
+        logger.debug("📦 Agrupando %s trabajos en un único envío de %s bytes", len(included), len(payload))
+        ok = print_raw(bytes(payload), printer)
+        for i in included:
+            results[i] = ok
+    return results
+
+
+def execute_print_sequence(jobs, printer):
+    """Ejecutar trabajos en el orden dado (lote contiguo): los agrupables
+    consecutivos van en un solo envío y los PDF se imprimen entre ellos.
+    Devuelve el resultado de cada trabajo, en el mismo orden."""
+    results, run = [], []
+    for job in jobs:
+        if job.get('type') in COALESCABLE_JOB_TYPES:
+            run.append(job)
+            continue
+        if run:
+            results += execute_print_batch(run, printer)
+            run = []
+        results.append(execute_print_job(job, printer))
+    if run:
+        results += execute_print_batch(run, printer)
+    return results
+
+
+class PrintWorker:
+    """Cola e hilo de impresión de una impresora. Cada impresora tiene el suyo,
+    así un PDF largo en una no bloquea los tickets de cocina o barra."""
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.queue = PriorityJobQueue(PRIORITY_AGING, MAX_QUEUE_JOBS, MAX_QUEUE_BYTES,
+                                      on_wait=lambda job, waited: stage_latency.observe(waited, stage='queue_wait'))
+        self.flow = FlowController(get_printer_backend(printer), MAX_SPOOLER_JOBS, SPOOLER_STATUS_TTL)
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self._held = None
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name=f"print-{self.printer}", daemon=True)
+            self.thread.start()
+            logger.info("✓ Hilo de impresión iniciado para '%s'", self.printer)
+
+    def stop(self):
+        self.running = False
+
+    def put(self, job_data, timeout=0, force=False):
+        self.queue.put(job_data, timeout=timeout, force=force)
+
+    def retry_after(self) -> float:
+        """Segundos estimados hasta que la cola tenga sitio: lo que tarda la
+        impresora en vaciar lo encolado (o 5 s si aún no se ha medido)."""
+        drain_rate = self.flow.drain_rate
+        if not drain_rate:
+            return 5
+        return min(60, self.queue.qbytes() / drain_rate)
+
+    def next_job(self, timeout):
+        """Siguiente trabajo: primero el que quedó apartado al agrupar."""
+        if self._held is not None:
+            job, self._held = self._held, None
+            return job
+        return self.queue.get(timeout=timeout)
+
+    def collect_batch(self, first):
+        """Reunir los trabajos agrupables que llegan dentro de la ventana."""
+        batch = [first]
+        if first.get('group'):
+            return self.collect_group(first)
+        if COALESCE_WINDOW <= 0 or first.get('type') not in COALESCABLE_JOB_TYPES:
+            return batch
+
+        deadline = time.monotonic() + COALESCE_WINDOW
+        while len(batch) < COALESCE_MAX_JOBS:
+            remaining = deadline - time.monotonic()
+            try:
+                job = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job.get('type') not in COALESCABLE_JOB_TYPES or job.get('group'):
+                self._held = job  # Se procesará justo después, sin perder el orden
+                break
+            batch.append(job)
+        return batch
+
+    def collect_group(self, first):
+        """Reunir el resto de un lote contiguo (entró entero en la cola) en el
+        orden en que se envió, sea cual sea la prioridad de cada trabajo."""
+        group = first['group']
+        batch = [first] + self.queue.take_matching(lambda job: job.get('group') == group)
+        batch.sort(key=lambda job: job.get('group_index', 0))
+        return batch
+
+    def run(self):
+        while self.running:
+            try:
+                job = self.next_job(timeout=1)
+
+                # Esperar a que la impresora pueda absorber más (spooler, ritmo
+                # de vaciado, backoff tras fallos); mientras, se acumulan trabajos
+                self.flow.wait_ready(should_stop=lambda: not self.running)
+
+                batch = self.collect_batch(job)
+                _current_jobs.ids = [j['id'] for j in batch if j.get('id')]
+                _current_jobs.worker = self
+                # Un lote contiguo no admite cajones de otros clientes en medio
+                _current_jobs.preempt = not job.get('group')
+                mark_current_jobs('rendering')
+                try:
+                    with self.lock:
+                        if job.get('group'):
+                            results = execute_print_sequence(batch, self.printer)
+                        else:
+                            results = execute_print_batch(batch, self.printer)
+                finally:
+                    _current_jobs.ids = ()
+                    _current_jobs.worker = None
+
+                for job, success in zip(batch, results):
+                    record_job_result(job, success)
+                    job_type = job.get('type')
+                    if success:
+                        logger.info("✓ Trabajo %s completado exitosamente en '%s'", job_type, self.printer,
+                                    extra={'job_id': job.get('id')})
+                    else:
+                        logger.error("✗ Trabajo %s falló en '%s'", job_type, self.printer,
+                                     extra={'job_id': job.get('id')})
+                    self.queue.task_done()
 
-def get_print_queue_status():
-    try:
-        default_printer = get_default_printer_name()
-        hPrinter = win32print.OpenPrinter(default_printer)
-        try:
-            jobs = win32print.EnumJobs(hPrinter, 0, -1, 1)
-            return len(jobs) if jobs else 0
-        finally:
-            win32print.ClosePrinter(hPrinter)
-    except Exception as e:
-        print(f"Error al obtener estado de cola: {e}")
-        return -1
+                self.flow.record_result(all(results))
+                if nv_graphics is not None and any(not ok and job.get('logo_data') for job, ok in zip(batch, results)):
+                    # No se sabe si el logo llegó a guardarse: subirlo de nuevo
+                    nv_graphics.forget(self.printer)
+                if not all(results):
+                    logger.warning("✗ Envío a '%s' con fallos (reintento del siguiente en %.1fs)",
+                                   self.printer, self.flow.backoff_delay())
 
+            except queue.Empty:
+                continue
+            except Exception as e:
+                logger.exception("Error procesando cola de impresión de '%s': %s", self.printer, e)
+                self.flow.record_result(False)
 
-def process_print_queue():
-    global print_thread_running
-    print_thread_running = True
-    failed_attempts = 0
-    max_failed_attempts = 3
 
-    while print_thread_running:
-        try:
-            job = print_queue.get(timeout=1)
-
-            queue_count = get_print_queue_status()
-            if queue_count > 5:
-                print(f"⚠️ Cola saturada ({queue_count} trabajos). Limpiando...")
-                clear_print_queue()
-                time.sleep(2)
-
-            success = False
-            job_type = job.get('type')
-
-            with print_lock:
-                if job_type == 'pdf':
-                    success = print_pdf_file(job['path'])
-                elif job_type == 'text':
-                    success = print_text_ticket(
-                        job['text'], 
-                        job.get('cut_after', True),
-                        job.get('qr_data', '')
-                    )
-                elif job_type == 'drawer':
-                    success = open_drawer()
-                elif job_type == 'cut':
-                    success = cut_paper()
-
-            if success:
-                failed_attempts = 0
-                print(f"✓ Trabajo {job_type} completado exitosamente")
-            else:
-                failed_attempts += 1
-                print(f"✗ Trabajo {job_type} falló (intento {failed_attempts})")
-
-                if failed_attempts >= max_failed_attempts:
-                    print(f"⚠️ {max_failed_attempts} fallos consecutivos. Limpiando cola...")
-                    clear_print_queue()
-                    failed_attempts = 0
-                    time.sleep(3)
-
-            print_queue.task_done()
-            time.sleep(0.2)
-
-        except queue.Empty:
-            continue
-        except Exception as e:
-            print(f"Error procesando cola de impresión: {e}")
-            failed_attempts += 1
-            if failed_attempts >= max_failed_attempts:
-                clear_print_queue()
-                failed_attempts = 0
+def get_print_worker(printer=None):
+    name = resolve_printer(printer)
+    worker = print_workers.get(name)
+    if worker is None:
+        worker = print_workers[name] = PrintWorker(name)
+    return worker
 
 
 def start_print_worker():
-    global print_thread_running
-    if not print_thread_running:
-        thread = threading.Thread(target=process_print_queue, daemon=True)
-        thread.start()
-        print("✓ Hilo de procesamiento de impresión iniciado")
+    """Arrancar un hilo de impresión por cada impresora configurada."""
+    for name in PRINTER_SPECS:
+        get_print_worker(name).start()
 
 
 def add_print_job(job_data):
-    try:
-        print_queue.put(job_data, timeout=5)
-        return True
-    except queue.Full:
-        print("⚠️ Cola de impresión llena. Limpiando...")
-        clear_print_queue()
+    """Encolar un trabajo en la cola de su impresora (campo 'printer').
+    Se registra en el diario antes de encolarlo. Devuelve el id del trabajo.
+    Lanza UnknownPrinterError si la impresora no está configurada y
+    JobRejectedError si su cola está llena."""
+    return add_print_jobs([job_data])[0]
+
+
+def add_print_jobs(jobs, contiguous=False):
+    """Encolar varios trabajos de forma atómica: o se admiten todos o ninguno
+    (JobRejectedError si no caben en la cola de alguna de sus impresoras).
+    Con ``contiguous`` los de cada impresora se imprimen seguidos y en orden,
+    sin trabajos de otros clientes entre ellos. Devuelve los ids, en orden."""
+    workers = [get_print_worker(job.get('printer')) for job in jobs]
+    group = uuid.uuid4().hex if contiguous and len(jobs) > 1 else None
+    ids, new_jobs = [], []
+    for index, (job, worker) in enumerate(zip(jobs, workers)):
+        job['printer'] = worker.printer
+        job['id'] = uuid.uuid4().hex
+        job['created'] = time.time()
+        if group:
+            job['group'], job['group_index'] = group, index
+
+        key = job.get('idempotency_key')
+        if key:
+            existing = idempotency_keys.reserve(key, job['id'])
+            if existing:
+                logger.info("↩️ Trabajo repetido (clave %s), ya registrado como %s", key, existing)
+                ids.append(existing)
+                continue
+        ids.append(job['id'])
+        new_jobs.append((job, worker))
+
+    by_worker = {}
+    for job, worker in new_jobs:
+        by_worker.setdefault(worker, []).append(job)
+
+    # Comprobar la admisión antes del diario: un trabajo que no cabe no se
+    # registra (ni cuesta un fsync) y su clave queda libre para reintentar
+    for worker, worker_jobs in by_worker.items():
         try:
-            print_queue.put(job_data, timeout=5)
-            return True
-        except queue.Full:
-            print("✗ No se pudo añadir trabajo a la cola")
-            return False
+            worker.queue.check_many(worker_jobs)
+        except queue.Full as e:
+            reject_jobs(new_jobs, worker, e, journaled=False)
+
+    if job_journal is not None:
+        try:
+            job_journal.append([job for job, _ in new_jobs])
+        except JournalError:
+            for job, _ in new_jobs:
+                job_journal.finish(job['id'], False, rejected=True)  # Por si parte del lote llegó a disco
+                if job.get('idempotency_key'):
+                    idempotency_keys.release(job['idempotency_key'], job['id'])
+            raise
+    for job, _ in new_jobs:
+        job_tracker.create(job)
+
+    enqueued = []
+    try:
+        for worker, worker_jobs in by_worker.items():
+            worker.queue.put_many(worker_jobs)
+            enqueued.append((worker, {job['id'] for job in worker_jobs}))
+    except queue.Full as e:
+        # Otro cliente ocupó el sitio entre la comprobación y el encolado.
+        # Retirar lo ya encolado en otras impresoras: el lote entra entero o no entra
+        for other, other_ids in enqueued:
+            other.queue.discard(lambda queued: queued.get('id') in other_ids)
+        reject_jobs(new_jobs, worker, e, journaled=True)
+    return ids
+
+
+def reject_jobs(new_jobs, worker, error, journaled):
+    """Rechazar un lote que no cabe en la cola de ``worker``: anotarlo (en el
+    diario como 'rejected' si ya se había registrado), liberar sus claves de
+    idempotencia y lanzar JobRejectedError."""
+    rejected = [job['id'] for job, _ in new_jobs]
+    logger.warning("⚠️ Cola de '%s' llena (%s): %s trabajo(s) rechazado(s)", worker.printer, error, len(rejected),
+                   extra={'job_id': rejected[0] if len(rejected) == 1 else rejected})
+    for job, _ in new_jobs:
+        if journaled:
+            record_job_result(job, False, 'Cola de impresión llena', outcome='rejected')
+        else:
+            job_outcomes.inc(type=job.get('type'), outcome='rejected')
+        if job.get('idempotency_key'):
+            idempotency_keys.release(job['idempotency_key'], job['id'])
+    raise JobRejectedError(f"Cola de impresión de '{worker.printer}' llena", worker.retry_after())
+
+
+def record_job_result(job, success, error=None, outcome=None):
+    """Anotar el resultado final de un trabajo en el diario, en su estado y en
+    las métricas (``outcome`` distingue p. ej. los rechazados de los fallidos)."""
+    job_outcomes.inc(type=job.get('type'), outcome=outcome or ('done' if success else 'failed'))
+    if not job.get('id'):
+        return
+    if job_journal is not None:
+        job_journal.finish(job['id'], success, rejected=outcome == 'rejected')
+    job_tracker.update(job['id'], 'done' if success else 'failed',
+                       None if success else (error or 'Error enviando a la impresora'))
+
+
+def recover_print_jobs():
+    """Volver a encolar los trabajos del diario que no llegaron a imprimirse
+    (p. ej. por un reinicio del servicio)."""
+    if job_journal is None:
+        return 0
+    jobs = job_journal.recover()
+    for job in jobs:
+        if job.get('printer') not in PRINTER_SPECS:
+            logger.warning("⚠️ Impresora '%s' ya no existe: trabajo %s a '%s'", job.get('printer'), job['id'], DEFAULT_PRINTER)
+            job['printer'] = DEFAULT_PRINTER
+        job_tracker.create(job)
+        get_print_worker(job['printer']).put(job, force=True)
+    if jobs:
+        logger.info("↻ Recuperados %s trabajos pendientes del diario", len(jobs))
+    return len(jobs)
 
 
 def parse_arguments():
@@ -726,6 +1788,162 @@ def parse_arguments():
                         type=str,
                         default='0.0.0.0',
                         help='Host del servidor (default: 0.0.0.0)')
+    parser.add_argument('--printer',
+                        type=str,
+                        action='append',
+                        metavar='[NOMBRE=]SPEC',
+                        help="Impresora con nombre opcional; repetir para varias (la primera es la de por defecto). "
+                             "SPEC: win32, win32:Nombre, tcp://host:9100, file:ruta o loopback (default: win32)")
+    parser.add_argument('--pdf-band-height',
+                        type=int,
+                        default=PDF_BAND_HEIGHT,
+                        help=f'Altura en puntos de cada banda raster al imprimir PDFs; 0 = página completa (default: {PDF_BAND_HEIGHT})')
+    parser.add_argument('--pdf-render',
+                        choices=['zoom', 'fit'],
+                        default=PDF_RENDER_MODE,
+                        help="Renderizado de PDFs: 'zoom' (2.5x RGB) o 'fit' (ancho del cabezal en grises) (default: %(default)s)")
+    parser.add_argument('--paper-width-mm',
+                        type=float,
+                        default=PAPER_WIDTH_MM,
+                        help='Ancho imprimible del papel en mm para --pdf-render fit (default: %(default)s)')
+    parser.add_argument('--dots-per-mm',
+                        type=float,
+                        default=DOTS_PER_MM,
+                        help='Densidad del cabezal en puntos por mm (default: %(default)s)')
+    parser.add_argument('--pdf-crop',
+                        action='store_true',
+                        help='Recortar márgenes y espacio en blanco de las páginas PDF (modo fit)')
+    parser.add_argument('--pdf-processes',
+                        type=int,
+                        default=PDF_RENDER_PROCESSES,
+                        help='Procesos para rasterizar en paralelo las páginas de PDFs largos; 0 = sin pool (default: %(default)s)')
+    parser.add_argument('--pdf-parallel-min-pages',
+                        type=int,
+                        default=PDF_PARALLEL_MIN_PAGES,
+                        help='Páginas a partir de las cuales un PDF se rasteriza en paralelo (default: %(default)s)')
+    parser.add_argument('--raster-blank-rows',
+                        type=int,
+                        default=PDF_RASTER_MIN_BLANK_ROWS,
+                        help='Filas en blanco seguidas de un PDF que se sustituyen por avance de papel; 0 = enviar el raster completo (default: %(default)s)')
+    parser.add_argument('--raster-feed-dpi',
+                        type=float,
+                        default=RASTER_FEED_DPI,
+                        help='Unidades por pulgada del avance ESC J de la impresora '
+                             '(default: la resolución del cabezal, 1 unidad por punto)')
+    parser.add_argument('--codepage',
+                        choices=sorted(CODE_PAGES),
+                        default=CODE_PAGE,
+                        help='Página de códigos de la impresora para imprimir acentos (ESC t n). Sin indicar: se eliminan los acentos')
+    parser.add_argument('--qr-mode',
+                        choices=['native', 'raster'],
+                        default=QR_MODE,
+                        help="QR desde texto: 'native' (GS ( k en la impresora) o 'raster' (generado aquí, requiere qrcode) (default: %(default)s)")
+    parser.add_argument('--qr-module-size',
+                        type=int,
+                        default=QR_MODULE_SIZE,
+                        help='Tamaño de módulo del QR nativo en puntos, 1-16 (default: %(default)s)')
+    parser.add_argument('--nv-logos',
+                        action='store_true',
+                        help='Guardar los logos en la memoria NV de la impresora (GS ( L) y enviar solo la orden de imprimirlos')
+    parser.add_argument('--nv-graphics-file',
+                        type=str,
+                        default=NV_GRAPHICS_PATH,
+                        help='Fichero con los logos subidos a cada impresora (default: %(default)s)')
+    parser.add_argument('--nv-refresh-hours',
+                        type=float,
+                        default=24,
+                        help='Horas tras las que un logo se vuelve a subir por si la impresora se cambió (default: %(default)s)')
+    parser.add_argument('--templates-dir',
+                        type=str,
+                        default=TEMPLATES_DIR,
+                        help='Directorio con las plantillas de ticket (<nombre>.json) para /print_order (default: %(default)s)')
+    parser.add_argument('--pdf-archive-dir',
+                        type=str,
+                        default=PDF_ARCHIVE_DIR,
+                        help="Directorio donde archivar copias de los PDFs recibidos; '' = no archivar (default: %(default)s)")
+    parser.add_argument('--pdf-archive-days',
+                        type=float,
+                        default=PDF_ARCHIVE_MAX_AGE_DAYS,
+                        help='Días que se conservan los PDFs archivados; 0 = sin límite (default: %(default)s)')
+    parser.add_argument('--pdf-archive-max-files',
+                        type=int,
+                        default=PDF_ARCHIVE_MAX_FILES,
+                        help='Máximo de PDFs archivados; 0 = sin límite (default: %(default)s)')
+    parser.add_argument('--log-level',
+                        type=str.upper,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        default=LOG_LEVEL,
+                        help='Nivel de los logs; DEBUG muestra el detalle de cada trabajo (default: %(default)s)')
+    parser.add_argument('--log-file',
+                        type=str,
+                        default=LOG_FILE,
+                        help="Fichero de logs rotativo en JSON; '' = solo consola (default: %(default)s)")
+    parser.add_argument('--ws-port',
+                        type=int,
+                        default=WS_PORT,
+                        help='Puerto del canal WebSocket para enviar trabajos y recibir su resultado; 0 = desactivado (default: %(default)s)')
+    parser.add_argument('--ws-token',
+                        type=str,
+                        default=None,
+                        help='Token que deben presentar los clientes del canal WebSocket (?token= o mensaje auth); '
+                             'sin token solo se comprueba el Origin')
+    parser.add_argument('--server',
+                        choices=['waitress', 'asgi'],
+                        default=SERVER_MODE,
+                        help="Servidor HTTP: 'waitress' (un hilo por petición) o 'asgi' (uvicorn, para cientos de "
+                             "conexiones simultáneas) (default: %(default)s)")
+    parser.add_argument('--asgi-workers',
+                        type=int,
+                        default=ASGI_WORKERS,
+                        help='Modo asgi: hilos que ejecutan las peticiones (default: %(default)s)')
+    parser.add_argument('--max-pending-requests',
+                        type=int,
+                        default=ASGI_MAX_PENDING,
+                        help='Modo asgi: peticiones en curso o en espera antes de responder 503 (default: %(default)s)')
+    parser.add_argument('--journal',
+                        type=str,
+                        default=JOURNAL_PATH,
+                        help="Fichero SQLite del diario de trabajos; '' = sin diario (default: %(default)s)")
+    parser.add_argument('--clear-spooler-on-start',
+                        action='store_true',
+                        help='Cancelar los trabajos del spooler de Windows al arrancar (comportamiento anterior)')
+    parser.add_argument('--priority-aging',
+                        type=float,
+                        default=PRIORITY_AGING,
+                        help='Segundos de espera que suben un nivel de prioridad a un trabajo (evita inanición de PDFs) (default: %(default)s)')
+    parser.add_argument('--max-job-watchers',
+                        type=int,
+                        default=MAX_JOB_WATCHERS,
+                        help='Clientes esperando a la vez en /jobs/<id> (long-poll o SSE); cada uno ocupa '
+                             'un hilo de waitress (default: %(default)s)')
+    parser.add_argument('--max-queue-jobs',
+                        type=int,
+                        default=MAX_QUEUE_JOBS,
+                        help='Máximo de trabajos en la cola de cada impresora; 0 = sin límite (default: %(default)s)')
+    parser.add_argument('--max-queue-mb',
+                        type=float,
+                        default=MAX_QUEUE_BYTES / (1024 * 1024),
+                        help='Máximo de datos encolados por impresora en MB; 0 = sin límite (default: %(default)s)')
+    parser.add_argument('--rate-limit',
+                        type=float,
+                        default=rate_limiter.rate,
+                        help='Trabajos por segundo permitidos a cada cliente; 0 = sin límite (default: %(default)s)')
+    parser.add_argument('--rate-burst',
+                        type=int,
+                        default=rate_limiter.burst,
+                        help='Ráfaga de trabajos permitida a cada cliente (default: %(default)s)')
+    parser.add_argument('--max-spooler-jobs',
+                        type=int,
+                        default=MAX_SPOOLER_JOBS,
+                        help='Documentos en el spooler a partir de los cuales se retienen envíos; 0 = sin límite (default: %(default)s)')
+    parser.add_argument('--spooler-status-interval',
+                        type=float,
+                        default=SPOOLER_STATUS_TTL,
+                        help='Segundos entre consultas del estado del spooler (default: %(default)s)')
+    parser.add_argument('--coalesce-ms',
+                        type=float,
+                        default=COALESCE_WINDOW * 1000,
+                        help='Ventana (ms) para agrupar tickets, cajón y cortes seguidos en un solo envío; 0 = desactivado (default: %(default)s)')
     
     return parser.parse_args()
 
@@ -734,7 +1952,268 @@ def set_allowed_origin(origin_url):
     """Establecer la URL permitida para CORS."""
     global ALLOWED_ORIGIN
     ALLOWED_ORIGIN = origin_url
-    print(f"✓ Access-Control-Allow-Origin configurado a: {ALLOWED_ORIGIN}")
+    logger.info("✓ Access-Control-Allow-Origin configurado a: %s", ALLOWED_ORIGIN)
+
+
+def parse_printer_entry(entry):
+    """Separar 'nombre=spec' en (nombre, spec); sin nombre se usa 'default'."""
+    name, sep, spec = entry.partition('=')
+    if sep and name and not any(c in name for c in ':/\\'):
+        return name.strip(), spec.strip()
+    return 'default', entry.strip()
+
+
+def configure_printers(entries):
+    """Configurar las impresoras con nombre. La primera es la de por defecto."""
+    global PRINTER_SPECS, DEFAULT_PRINTER
+    specs = {}
+    for entry in entries or ['win32']:
+        name, spec = parse_printer_entry(entry)
+        create_backend(spec)  # Validar la especificación antes de aplicarla
+        specs[name] = spec
+
+    for backend in printer_backends.values():
+        backend.close()
+    printer_backends.clear()
+    for worker in print_workers.values():
+        worker.stop()
+    print_workers.clear()
+
+    PRINTER_SPECS = specs
+    DEFAULT_PRINTER = next(iter(specs))
+    for name in specs:
+        logger.info("✓ Impresora '%s': %s (%s)", name, get_printer_name(name), get_printer_backend(name).kind)
+    logger.info("✓ Impresora por defecto: '%s'", DEFAULT_PRINTER)
+
+
+def set_code_page(code_page):
+    """Establecer la página de códigos usada para codificar los tickets."""
+    global CODE_PAGE, text_encoder
+    text_encoder = TextEncoder(code_page)
+    CODE_PAGE = code_page
+    if code_page:
+        logger.info("✓ Texto codificado en %s con acentos nativos", code_page)
+    else:
+        logger.info("✓ Texto codificado sin acentos (modo clásico)")
+
+
+def set_qr_options(mode, module_size):
+    """Establecer cómo se generan los QR recibidos como texto."""
+    global QR_MODE, QR_MODULE_SIZE
+    if mode == 'raster' and qrcode is None:
+        logger.warning("⚠️ Paquete 'qrcode' no instalado: se usará el QR nativo de la impresora")
+        mode = 'native'
+    QR_MODE = mode
+    QR_MODULE_SIZE = min(16, max(1, module_size))
+    logger.info("✓ QR desde texto en modo %s", QR_MODE)
+
+
+def set_nv_graphics(enabled, path, refresh_hours):
+    """Activar los logos guardados en la memoria NV de las impresoras."""
+    global NV_GRAPHICS_PATH, nv_graphics
+    NV_GRAPHICS_PATH = path or None
+    nv_graphics = NvGraphicsRegistry(NV_GRAPHICS_PATH, refresh_seconds=refresh_hours * 3600) if enabled else None
+    if nv_graphics:
+        logger.info("✓ Logos en memoria NV de la impresora (registro %s, resubida cada %g h)",
+                    NV_GRAPHICS_PATH or 'en memoria', refresh_hours)
+    else:
+        logger.info("✓ Logos enviados como raster en cada ticket")
+
+
+def set_templates_dir(directory):
+    """Establecer el directorio de plantillas de ticket."""
+    global TEMPLATES_DIR, template_library
+    TEMPLATES_DIR = directory or None
+    template_library = TemplateLibrary(TEMPLATES_DIR)
+    logger.info("✓ Plantillas de ticket: %s", ', '.join(template_library.names()))
+
+
+def set_pdf_archive(directory, max_age_days, max_files):
+    """Configurar el archivo en disco de los PDFs recibidos."""
+    global PDF_ARCHIVE_DIR, PDF_ARCHIVE_MAX_AGE_DAYS, PDF_ARCHIVE_MAX_FILES, pdf_archiver
+    PDF_ARCHIVE_DIR = directory or None
+    PDF_ARCHIVE_MAX_AGE_DAYS = max_age_days
+    PDF_ARCHIVE_MAX_FILES = max_files
+    pdf_archiver = None
+    if PDF_ARCHIVE_DIR:
+        pdf_archiver = PdfArchiver(PDF_ARCHIVE_DIR, max_age_days, max_files)
+        pdf_archiver.start()
+        logger.info("✓ PDFs archivados en %s (%g días, máx. %s ficheros)", PDF_ARCHIVE_DIR, max_age_days, max_files)
+    else:
+        logger.info("✓ Archivo de PDFs desactivado")
+
+
+def current_job_ids():
+    """Ids de los trabajos que procesa el hilo actual (para los logs)."""
+    return getattr(_current_jobs, 'ids', ())
+
+
+def set_server_mode(mode, workers=ASGI_WORKERS, max_pending=ASGI_MAX_PENDING):
+    """Elegir el servidor HTTP; sin uvicorn instalado se usa waitress."""
+    global SERVER_MODE, ASGI_WORKERS, ASGI_MAX_PENDING
+    ASGI_WORKERS, ASGI_MAX_PENDING = max(1, workers), max(1, max_pending)
+    if mode == 'asgi' and not ASGI_AVAILABLE:
+        logger.warning("⚠️ Paquete 'uvicorn' no instalado: se usa waitress")
+        mode = 'waitress'
+    SERVER_MODE = mode
+    if SERVER_MODE == 'asgi':
+        logger.info("✓ Servidor asyncio (uvicorn): %s hilos, hasta %s peticiones en curso",
+                    ASGI_WORKERS, ASGI_MAX_PENDING)
+
+
+def create_asgi_app():
+    """Aplicación ASGI con la configuración actual. Un cuerpo mayor que la
+    cola entera no se admitiría, así que MAX_QUEUE_BYTES limita cada petición."""
+    global asgi_app
+    max_body = MAX_QUEUE_BYTES or 64 * 1024 * 1024
+    asgi_app = AsgiApp(app, job_tracker, ASGI_WORKERS, ASGI_MAX_PENDING,
+                       max_body_bytes=max_body, max_inflight_bytes=max_body * 2, extra_headers=cors_headers)
+    return asgi_app
+
+
+def set_websocket_channel(port, token, host='0.0.0.0'):
+    """Arrancar (o detener, con puerto 0) el canal WebSocket de trabajos."""
+    global WS_PORT, WS_TOKEN, ws_channel
+    if ws_channel is not None:
+        ws_channel.stop()
+        ws_channel = None
+    WS_PORT, WS_TOKEN = port, token or None
+    if not WS_PORT:
+        return
+    if not WEBSOCKETS_AVAILABLE:
+        logger.warning("⚠️ Paquete 'websockets' no instalado: canal WebSocket desactivado")
+        return
+    if not WS_TOKEN:
+        logger.warning("⚠️ Canal WebSocket sin token: solo se comprueba el Origin (%s)", ALLOWED_ORIGIN)
+    channel = WebSocketChannel(handle_channel_message, job_tracker, host, WS_PORT, ALLOWED_ORIGIN, WS_TOKEN)
+    try:
+        channel.start()
+    except OSError as e:
+        logger.error("✗ No se pudo abrir el canal WebSocket en el puerto %s: %s", WS_PORT, e)
+        return
+    ws_channel = channel
+
+
+def set_logging(level, log_file):
+    """Configurar los logs: escritura en segundo plano a consola y fichero."""
+    global LOG_LEVEL, LOG_FILE
+    LOG_LEVEL = level
+    LOG_FILE = log_file or None
+    setup_logging(LOG_LEVEL, LOG_FILE, get_job_ids=current_job_ids)
+    logging.getLogger('waitress').setLevel(max(logging.INFO, logging.getLogger().level))
+    logger.info("✓ Logs en nivel %s%s", LOG_LEVEL, f" (fichero {LOG_FILE})" if LOG_FILE else "")
+
+
+def set_job_journal(path):
+    """Abrir el diario persistente de trabajos."""
+    global JOURNAL_PATH, job_journal
+    JOURNAL_PATH = path or None
+    job_journal = JobJournal(path) if path else None
+    if job_journal:
+        idempotency_keys.load(job_journal.recent_keys(idempotency_keys.key_ttl))
+        logger.info("✓ Diario de trabajos: %s", JOURNAL_PATH)
+    else:
+        logger.warning("⚠️ Diario de trabajos desactivado: la cola se pierde si el servicio se reinicia")
+
+
+def set_priority_aging(seconds):
+    """Establecer el envejecimiento de prioridades de las colas de impresión."""
+    global PRIORITY_AGING
+    PRIORITY_AGING = max(0.0, seconds)
+    for worker in print_workers.values():
+        worker.queue.aging_seconds = PRIORITY_AGING
+    logger.info("✓ Prioridades: cajón > ticket > PDF (envejecimiento %g s)", PRIORITY_AGING)
+
+
+def set_admission_limits(max_jobs, max_mb, rate, burst):
+    """Configurar los límites de las colas y de peticiones por cliente."""
+    global MAX_QUEUE_JOBS, MAX_QUEUE_BYTES, rate_limiter
+    MAX_QUEUE_JOBS = max(0, max_jobs)
+    MAX_QUEUE_BYTES = max(0, int(max_mb * 1024 * 1024))
+    for worker in print_workers.values():
+        worker.queue.max_jobs = MAX_QUEUE_JOBS
+        worker.queue.max_bytes = MAX_QUEUE_BYTES
+    rate_limiter = RateLimiter(rate, burst)
+    client_limit = f"{rate:g} trabajos/s (ráfaga {burst})" if rate > 0 else "sin límite"
+    logger.info("✓ Admisión: colas de %s trabajos / %s MB, por cliente %s", MAX_QUEUE_JOBS or '∞', max_mb or '∞', client_limit)
+
+
+def set_job_watch_limit(max_watchers):
+    """Configurar las esperas simultáneas en /jobs/<id>."""
+    global MAX_JOB_WATCHERS, job_watch_slots
+    MAX_JOB_WATCHERS = max(0, max_watchers)
+    job_watch_slots = threading.BoundedSemaphore(MAX_JOB_WATCHERS)
+    logger.info("✓ Hasta %s clientes esperando trabajos en /jobs/<id>", MAX_JOB_WATCHERS)
+
+
+def set_flow_control(max_spooler_jobs, status_interval):
+    """Configurar el control de flujo hacia las impresoras."""
+    global MAX_SPOOLER_JOBS, SPOOLER_STATUS_TTL
+    MAX_SPOOLER_JOBS = max_spooler_jobs
+    SPOOLER_STATUS_TTL = max(0.1, status_interval)
+    for worker in print_workers.values():
+        worker.flow.max_spooler_jobs = MAX_SPOOLER_JOBS
+        worker.flow.status_ttl = SPOOLER_STATUS_TTL
+    logger.info("✓ Control de flujo: máx. %s documentos en spooler, estado cada %gs", MAX_SPOOLER_JOBS, SPOOLER_STATUS_TTL)
+
+
+def set_coalesce_window(window_ms):
+    """Establecer la ventana de agrupación de trabajos pequeños."""
+    global COALESCE_WINDOW
+    COALESCE_WINDOW = max(0.0, window_ms / 1000)
+    if COALESCE_WINDOW:
+        logger.info("✓ Agrupación de trabajos pequeños en ventanas de %g ms", window_ms)
+    else:
+        logger.info("✓ Agrupación de trabajos desactivada")
+
+
+def set_pdf_band_height(band_height):
+    """Establecer la altura de banda para la impresión de PDFs en streaming."""
+    global PDF_BAND_HEIGHT
+    PDF_BAND_HEIGHT = max(0, band_height)
+    if PDF_BAND_HEIGHT:
+        logger.info("✓ PDFs en streaming por bandas de %s puntos", PDF_BAND_HEIGHT)
+    else:
+        logger.info("✓ PDFs enviados página a página (sin bandas)")
+
+
+def set_raster_optimization(min_blank_rows, feed_dpi):
+    """Configurar la eliminación de filas en blanco del raster de los PDFs."""
+    global PDF_RASTER_MIN_BLANK_ROWS, RASTER_FEED_DPI
+    PDF_RASTER_MIN_BLANK_ROWS = max(0, min_blank_rows)
+    RASTER_FEED_DPI = feed_dpi or None
+    if PDF_RASTER_MIN_BLANK_ROWS:
+        logger.info("✓ Raster de PDFs optimizado: blancos de %s+ filas como avance ESC J (%g unidades/punto)",
+                    PDF_RASTER_MIN_BLANK_ROWS, raster_feed_units_per_dot())
+    else:
+        logger.info("✓ Raster de PDFs sin optimizar (se envían todas las filas)")
+
+
+def set_pdf_render_options(mode, paper_width_mm, dots_per_mm, crop):
+    """Establecer el modo de renderizado de PDFs y la geometría del cabezal."""
+    global PDF_RENDER_MODE, PAPER_WIDTH_MM, DOTS_PER_MM, PDF_CROP_MARGINS
+    PDF_RENDER_MODE = mode
+    PAPER_WIDTH_MM = paper_width_mm
+    DOTS_PER_MM = dots_per_mm
+    PDF_CROP_MARGINS = crop
+    if mode == 'fit':
+        recorte = ", recortando márgenes" if crop else ""
+        logger.info("✓ PDFs renderizados en grises a %s puntos de ancho%s", printer_width_dots(), recorte)
+
+
+def set_pdf_processes(processes, min_pages):
+    """Configurar el pool de procesos para rasterizar PDFs largos."""
+    global PDF_RENDER_PROCESSES, PDF_PARALLEL_MIN_PAGES, pdf_render_pool
+    PDF_RENDER_PROCESSES = max(0, processes)
+    PDF_PARALLEL_MIN_PAGES = max(2, min_pages)
+    if pdf_render_pool is not None:
+        pdf_render_pool.shutdown()
+        pdf_render_pool = None
+    if PDF_RENDER_PROCESSES > 1:
+        logger.info("✓ PDFs de %s o más páginas rasterizados en paralelo con %s procesos",
+                    PDF_PARALLEL_MIN_PAGES, PDF_RENDER_PROCESSES)
+    else:
+        logger.info("✓ PDFs rasterizados en el hilo de impresión (sin pool de procesos)")
 
 
 from waitress import serve
@@ -746,33 +2225,57 @@ if __name__ == "__main__":
     
     # Parsear argumentos de línea de comandos
     args = parse_arguments()
+    set_logging(args.log_level, args.log_file)
     
     # Configurar la URL permitida para CORS
     set_allowed_origin(args.origin)
+    configure_printers(args.printer)
+    set_pdf_band_height(args.pdf_band_height)
+    set_coalesce_window(args.coalesce_ms)
+    set_priority_aging(args.priority_aging)
+    set_flow_control(args.max_spooler_jobs, args.spooler_status_interval)
+    set_admission_limits(args.max_queue_jobs, args.max_queue_mb, args.rate_limit, args.rate_burst)
+    set_job_watch_limit(args.max_job_watchers)
+    set_job_journal(args.journal)
+    set_pdf_archive(args.pdf_archive_dir, args.pdf_archive_days, args.pdf_archive_max_files)
+    set_nv_graphics(args.nv_logos, args.nv_graphics_file, args.nv_refresh_hours)
+    set_templates_dir(args.templates_dir)
+    set_code_page(args.codepage)
+    set_qr_options(args.qr_mode, args.qr_module_size)
+    set_pdf_render_options(args.pdf_render, args.paper_width_mm, args.dots_per_mm, args.pdf_crop)
+    set_pdf_processes(args.pdf_processes, args.pdf_parallel_min_pages)
+    set_raster_optimization(args.raster_blank_rows, args.raster_feed_dpi)
+    set_server_mode(args.server, args.asgi_workers, args.max_pending_requests)
     
-    print(f"🌐 Origen permitido (CORS): {ALLOWED_ORIGIN}")
-    print(f"🖥️  Host: {args.host}")
-    print(f"🔌 Puerto: {args.port}")
-    print()
+    logger.info("🌐 Origen permitido (CORS): %s", ALLOWED_ORIGIN)
+    logger.info("🖥️  Host: %s", args.host)
+    logger.info("🔌 Puerto: %s", args.port)
     
-    print("Iniciando servidor de impresión en modo RAW para tickets...")
-    clear_print_queue()
+    logger.info("Iniciando servidor de impresión en modo RAW para tickets...")
+    if args.clear_spooler_on_start:
+        for name in PRINTER_SPECS:
+            clear_print_queue(name)
+    recover_print_jobs()
     start_print_worker()
+    set_websocket_channel(args.ws_port, args.ws_token, args.host)
     
-    print("✓ Servidor iniciado correctamente")
-    print()
-    print("Ejemplos de uso:")
-    print(f"  python {sys.argv[0]} --origin https://miapp.com --port 5000")
-    print(f"  python {sys.argv[0]} -o https://localhost:3000 -p 8080")
-    print()
-    print("Presiona Ctrl+C para detener el servidor")
-    print("=" * 60)
+    logger.info("✓ Servidor iniciado correctamente")
+    logger.info("Ejemplos de uso:")
+    logger.info("  python %s --origin https://miapp.com --port 5000", sys.argv[0])
+    logger.info("  python %s -o https://localhost:3000 -p 8080", sys.argv[0])
+    logger.info("Presiona Ctrl+C para detener el servidor")
     
     try:
-        serve(app, host=args.host, port=args.port)
+        if SERVER_MODE == 'asgi':
+            serve_asgi(create_asgi_app(), args.host, args.port)
+        else:
+            serve(app, host=args.host, port=args.port, threads=WAITRESS_THREADS + MAX_JOB_WATCHERS)
     except KeyboardInterrupt:
-        print("\n🛑 Servidor detenido por el usuario")
-        print("¡Hasta luego!")
+        logger.info("🛑 Servidor detenido por el usuario. ¡Hasta luego!")
     except Exception as e:
-        print(f"\n❌ Error al iniciar el servidor: {e}")
-        sys.exit(1)
\ No newline at end of file
+        logger.error("❌ Error al iniciar el servidor: %s", e)
+        sys.exit(1)
+    finally:
+        if ws_channel is not None:
+            ws_channel.stop()
+        stop_logging()
@@ -0,0 +1,290 @@
+"""Cola de trabajos con prioridades por tipo y envejecimiento.
+
+Sustituye a la cola FIFO de cada impresora: un cajón no espera detrás de un
+PDF largo. Para evitar inanición, la prioridad de un trabajo mejora con el
+tiempo que lleva esperando (``aging_seconds`` de espera equivalen a subir
+un nivel). Tiene la misma interfaz básica que ``queue.Queue``.
+
+La cola está acotada por número de trabajos y por bytes de datos encolados:
+``put`` lanza ``queue.Full`` en lugar de dejar crecer la memoria, y
+``put_many`` admite un grupo de trabajos entero o ninguno.
+
+Los trabajos urgentes (prioridad 0: cajón, corte; salvo los de un lote
+contiguo, que se imprimen con él) tienen un cupo propio de
+``urgent_headroom`` plazas, aparte de ``max_jobs``/``max_bytes``: un aluvión
+de PDFs no impide abrir el cajón, y un aluvión de cajones tampoco llena la
+cola de los tickets.
+"""
+import queue
+import threading
+import time
+from collections import deque
+
+# Menor número = más prioritario
+JOB_PRIORITIES = {
+    'drawer': 0,
+    'cut': 0,
+    'text': 1,
+    'order': 1,
+    'pdf': 2,
+}
+DEFAULT_PRIORITY = 1
+URGENT_PRIORITY = 0
+
+
+def is_urgent(job) -> bool:
+    """Trabajo del cupo urgente: prioridad 0 y fuera de un lote contiguo."""
+    return JOB_PRIORITIES.get(job.get('type'), DEFAULT_PRIORITY) == URGENT_PRIORITY and not job.get('group')
+
+
+def job_size(job) -> int:
+    """Bytes de datos que ocupa un trabajo (PDF, texto, imágenes en base64)."""
+    return sum(len(value) for value in job.values() if isinstance(value, (bytes, str)))
+
+
+class PriorityJobQueue:
+    """Cola por clases de prioridad con envejecimiento, límites de admisión
+    (``max_jobs`` trabajos y ``max_bytes`` bytes, 0 = sin límite, más
+    ``urgent_headroom`` trabajos urgentes) y estadísticas de espera.
+
+    ``on_wait(job, segundos)`` se llama al sacar cada trabajo con lo que ha
+    esperado en la cola."""
+
+    def __init__(self, aging_seconds: float = 10.0, max_jobs: int = 0, max_bytes: int = 0,
+                 on_wait=None, urgent_headroom: int = 16):
+        self.aging_seconds = aging_seconds
+        self.on_wait = on_wait
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.urgent_headroom = urgent_headroom
+        self._classes = {}  # prioridad -> deque de (instante de llegada, trabajo, bytes)
+        self._size = 0
+        self._bytes = 0
+        self._urgent = 0  # trabajos urgentes en cola (y sus bytes), fuera de los límites normales
+        self._urgent_bytes = 0
+        self._unfinished = 0
+        self._cond = threading.Condition()
+        self._all_done = threading.Condition(self._cond)
+        self._not_full = threading.Condition(self._cond)
+        self._waits = {}  # tipo de trabajo -> [n, total, máximo]
+        self.rejected = {}  # motivo -> trabajos rechazados
+
+    # --- Interfaz compatible con queue.Queue ---
+
+    def put(self, job, timeout=0, force=False):
+        """Encolar ``job``. Si no cabe, espera hasta ``timeout`` segundos a que
+        haya sitio y si no lanza ``queue.Full``. ``force`` ignora los límites
+        (trabajos recuperados del diario, que ya se habían aceptado)."""
+        priority = JOB_PRIORITIES.get(job.get('type'), DEFAULT_PRIORITY)
+        size = job_size(job)
+        deadline = time.monotonic() + (timeout or 0)
+        with self._cond:
+            if not force:
+                while True:
+                    reason = self._admission_problem(size, urgent=is_urgent(job))
+                    if reason is None:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+                        raise queue.Full(reason)
+                    self._not_full.wait(remaining)
+            self._add(priority, job, size, time.monotonic())
+            self._cond.notify()
+
+    def put_many(self, jobs, force=False):
+        """Encolar varios trabajos de una vez: o caben todos o se lanza
+        ``queue.Full`` sin encolar ninguno (no espera a que haya sitio)."""
+        items = [(JOB_PRIORITIES.get(job.get('type'), DEFAULT_PRIORITY), job, job_size(job)) for job in jobs]
+        with self._cond:
+            if not force:
+                self._check_admission(items)
+            now = time.monotonic()
+            for priority, job, size in items:
+                self._add(priority, job, size, now)
+            self._cond.notify(len(items))
+
+    def check_many(self, jobs):
+        """Comprobar, sin encolarlos, si ``jobs`` caben ahora en la cola; si no,
+        lanza ``queue.Full`` como ``put_many`` (que aún puede fallar si entre
+        medias llegan otros trabajos)."""
+        items = [(None, job, job_size(job)) for job in jobs]
+        with self._cond:
+            self._check_admission(items)
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._size:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
+            return self._pop(self._select())
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def qsize(self) -> int:
+        with self._cond:
+            return self._size
+
+    def qbytes(self) -> int:
+        with self._cond:
+            return self._bytes
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._unfinished = 0
+                self._all_done.notify_all()
+
+    def join(self):
+        with self._all_done:
+            while self._unfinished:
+                self._all_done.wait()
+
+    # --- Extras ---
+
+    def take_matching(self, predicate):
+        """Sacar ya (sin esperar) todos los trabajos que cumplen ``predicate``,
+        en orden de llegada: cajones que se cuelan entre las bandas de un PDF
+        o el resto de un lote que debe imprimirse seguido."""
+        with self._cond:
+            jobs = []
+            for enqueued, job, size in self._remove(predicate):
+                self._record_wait(job, enqueued)
+                jobs.append(job)
+            return jobs
+
+    def discard(self, predicate) -> int:
+        """Retirar sin procesarlos los trabajos que cumplen ``predicate``
+        (lote rechazado en otra cola). Devuelve cuántos se retiraron."""
+        with self._cond:
+            removed = self._remove(predicate)
+            self._unfinished = max(0, self._unfinished - len(removed))
+            if not self._unfinished:
+                self._all_done.notify_all()
+            return len(removed)
+
+    def stats(self) -> dict:
+        """Espera en cola por tipo de trabajo, trabajos pendientes por tipo,
+        ocupación frente a los límites y trabajos rechazados por motivo."""
+        with self._cond:
+            queued = {}
+            for items in self._classes.values():
+                for _, job, _ in items:
+                    job_type = job.get('type')
+                    queued[job_type] = queued.get(job_type, 0) + 1
+            waits = {
+                job_type: {
+                    'count': n,
+                    'avg_wait_ms': round(total / n * 1000, 1) if n else 0.0,
+                    'max_wait_ms': round(maximum * 1000, 1),
+                }
+                for job_type, (n, total, maximum) in self._waits.items()
+            }
+            return {
+                'queued': queued,
+                'wait': waits,
+                'depth': self._size,
+                'bytes': self._bytes,
+                'max_jobs': self.max_jobs,
+                'max_bytes': self.max_bytes,
+                'urgent': self._urgent,
+                'urgent_headroom': self.urgent_headroom,
+                'rejected': dict(self.rejected),
+            }
+
+    # --- Implementación ---
+
+    def _admission_problem(self, size, count=1, urgent=False):
+        """Motivo por el que no caben ``count`` trabajos de ``size`` bytes en
+        total (en el cupo urgente si ``urgent``), o None."""
+        if urgent:
+            return 'urgent_headroom' if self._urgent + count > self.urgent_headroom else None
+        jobs, queued_bytes = self._size - self._urgent, self._bytes - self._urgent_bytes
+        if self.max_jobs and jobs + count > self.max_jobs:
+            return 'max_jobs'
+        if self.max_bytes and jobs and queued_bytes + size > self.max_bytes:
+            return 'max_bytes'
+        return None
+
+    def _check_admission(self, items):
+        """Lanzar ``queue.Full`` si los elementos (prioridad, trabajo, bytes)
+        no caben todos, contando cada cupo por separado."""
+        for urgent in (False, True):
+            sizes = [size for _, job, size in items if is_urgent(job) == urgent]
+            reason = self._admission_problem(sum(sizes), len(sizes), urgent) if sizes else None
+            if reason is not None:
+                self.rejected[reason] = self.rejected.get(reason, 0) + len(items)
+                raise queue.Full(reason)
+
+    def _add(self, priority, job, size, enqueued):
+        self._classes.setdefault(priority, deque()).append((enqueued, job, size))
+        self._size += 1
+        self._bytes += size
+        if is_urgent(job):
+            self._urgent += 1
+            self._urgent_bytes += size
+        self._unfinished += 1
+
+    def _forget(self, job, size):
+        """Descontar un elemento que sale de la cola."""
+        self._size -= 1
+        self._bytes -= size
+        if is_urgent(job):
+            self._urgent -= 1
+            self._urgent_bytes -= size
+
+    def _remove(self, predicate):
+        """Quitar de la cola (con el lock tomado) los elementos cuyo trabajo
+        cumple ``predicate``; los devuelve en orden de llegada."""
+        removed = []
+        for priority, items in self._classes.items():
+            if any(predicate(item[1]) for item in items):
+                keep = deque()
+                for item in items:
+                    if predicate(item[1]):
+                        removed.append(item)
+                        self._forget(item[1], item[2])
+                    else:
+                        keep.append(item)
+                self._classes[priority] = keep
+        removed.sort(key=lambda item: item[0])
+        if removed:
+            self._not_full.notify_all()
+        return removed
+
+    def _select(self):
+        now = time.monotonic()
+        best, best_score = None, None
+        for priority, items in self._classes.items():
+            if not items:
+                continue
+            enqueued = items[0][0]
+            aging = (now - enqueued) / self.aging_seconds if self.aging_seconds else 0
+            score = (priority - aging, priority)
+            if best_score is None or score < best_score:
+                best, best_score = priority, score
+        return best
+
+    def _pop(self, priority):
+        enqueued, job, size = self._classes[priority].popleft()
+        self._forget(job, size)
+        self._not_full.notify()
+        self._record_wait(job, enqueued)
+        return job
+
+    def _record_wait(self, job, enqueued):
+        waited = time.monotonic() - enqueued
+        stats = self._waits.setdefault(job.get('type'), [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        if self.on_wait is not None:
+            self.on_wait(job, waited)
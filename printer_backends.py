@@ -0,0 +1,375 @@
+"""Backends de impresora para el envío de bytes RAW (ESC/POS).
+
+Cada backend mantiene abierta su conexión (handle del spooler, socket TCP o
+fichero) entre trabajos y la vuelve a abrir si falla. Se crean a partir de
+una especificación en texto:
+
+    win32                 Impresora por defecto de Windows (spooler)
+    win32:Nombre          Impresora de Windows con ese nombre
+    tcp://host[:9100]     Impresora de red en modo RAW (JetDirect)
+    file:ruta             Añadir los bytes a un fichero (pruebas, Linux)
+    loopback              Descartar los bytes contando lo enviado (pruebas)
+"""
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+try:
+    import win32print
+except ImportError:  # Fuera de Windows solo están disponibles tcp/file/loopback
+    win32print = None
+
+logger = logging.getLogger(__name__)
+
+
+class PrinterBackend:
+    """Interfaz común de los backends.
+
+    Las subclases implementan ``_connect``, ``_disconnect``, ``_write`` y,
+    si el medio lo necesita, ``_begin_document``/``_end_document``.
+    """
+
+    kind = 'base'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.connected = False
+        self.connections = 0  # Conexiones abiertas desde el arranque
+
+    # --- API pública ---
+
+    def write(self, data: bytes) -> int:
+        """Enviar un documento completo. Se reintenta una vez reconectando si
+        la conexión guardada estaba caída antes de escribir nada."""
+        return self.write_stream([data], retry=True)
+
+    def write_stream(self, chunks, retry: bool = False) -> int:
+        """Enviar varios bloques como un único documento, según van llegando."""
+        with self._lock:
+            for attempt in (1, 2):
+                self._open_document(reconnect=attempt > 1)
+                written = 0
+                try:
+                    for chunk in chunks:
+                        self._write(chunk)
+                        written += len(chunk)
+                    self._end_document()
+                    return written
+                except Exception as e:
+                    self.reset()
+                    if not retry or written or attempt == 2:
+                        raise
+                    logger.warning("⚠️ Conexión con %s perdida (%s). Reconectando...", self.describe(), e)
+
+    def pending_jobs(self) -> int:
+        """Trabajos pendientes en el dispositivo/spooler (0 si no aplica)."""
+        return 0
+
+    def clear(self) -> bool:
+        """Cancelar los trabajos pendientes (si el medio lo permite)."""
+        return True
+
+    def reset(self):
+        """Cerrar la conexión; se reabrirá en el siguiente envío."""
+        with self._lock:
+            if self.connected:
+                try:
+                    self._disconnect()
+                except Exception as e:
+                    logger.error("Error cerrando conexión con %s: %s", self.describe(), e)
+            self.connected = False
+
+    close = reset
+
+    def describe(self) -> str:
+        return self.kind
+
+    # --- Implementación ---
+
+    def _open_document(self, reconnect: bool = False):
+        if reconnect:
+            self.reset()
+        if not self.connected or not self._is_alive():
+            self.reset()
+            self._connect()
+            self.connected = True
+            self.connections += 1
+        try:
+            self._begin_document()
+        except Exception:
+            # El handle/socket guardado puede estar caído: reabrir una vez
+            self.reset()
+            self._connect()
+            self.connected = True
+            self.connections += 1
+            self._begin_document()
+
+    def _is_alive(self) -> bool:
+        return True
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _disconnect(self):
+        raise NotImplementedError
+
+    def _write(self, chunk: bytes):
+        raise NotImplementedError
+
+    def _begin_document(self):
+        pass
+
+    def _end_document(self):
+        pass
+
+
+class Win32SpoolerBackend(PrinterBackend):
+    """Spooler de Windows en modo RAW, reutilizando el handle de la impresora.
+
+    Cada envío sigue siendo un documento del spooler (StartDoc/EndDoc), pero
+    se evitan GetDefaultPrinter/OpenPrinter/ClosePrinter por trabajo.
+    """
+
+    kind = 'win32'
+
+    def __init__(self, printer_name: str = None):
+        super().__init__()
+        self.printer_name = printer_name or None
+        self._resolved_name = None
+        self._handle = None
+
+    def resolve_name(self):
+        if self.printer_name:
+            return self.printer_name
+        if win32print is None:
+            return None
+        try:
+            return win32print.GetDefaultPrinter()
+        except Exception as e:
+            logger.error("Error obteniendo impresora por defecto: %s", e)
+            return None
+
+    def describe(self) -> str:
+        return self._resolved_name or self.resolve_name() or 'win32 (sin impresora)'
+
+    def _connect(self):
+        if win32print is None:
+            raise RuntimeError("win32print no está disponible en este sistema")
+        name = self.resolve_name()
+        if not name:
+            raise RuntimeError("No hay impresora por defecto configurada")
+        self._handle = win32print.OpenPrinter(name)
+        self._resolved_name = name
+
+    def _disconnect(self):
+        handle, self._handle = self._handle, None
+        self._resolved_name = None
+        if handle is not None:
+            win32print.ClosePrinter(handle)
+
+    def _begin_document(self):
+        # El tercer parámetro especifica que enviaremos datos en RAW
+        win32print.StartDocPrinter(self._handle, 1, ("Python RAW Print", None, "RAW"))
+        try:
+            win32print.StartPagePrinter(self._handle)
+        except Exception:
+            win32print.EndDocPrinter(self._handle)
+            raise
+
+    def _write(self, chunk: bytes):
+        win32print.WritePrinter(self._handle, chunk)
+
+    def _end_document(self):
+        win32print.EndPagePrinter(self._handle)
+        win32print.EndDocPrinter(self._handle)
+
+    def _enum_jobs(self):
+        with self._lock:
+            if not self.connected:
+                self._connect()
+                self.connected = True
+                self.connections += 1
+            return win32print.EnumJobs(self._handle, 0, -1, 1) or []
+
+    def pending_jobs(self) -> int:
+        try:
+            return len(self._enum_jobs())
+        except Exception as e:
+            logger.error("Error al obtener estado de cola: %s", e)
+            self.reset()
+            return -1
+
+    def clear(self) -> bool:
+        try:
+            with self._lock:
+                jobs = self._enum_jobs()
+                logger.info("Limpiando cola de impresión de: %s", self.describe())
+                if not jobs:
+                    logger.info("Cola de impresión ya está vacía")
+                    return True
+
+                logger.info("Encontrados %s trabajos en cola", len(jobs))
+                for job in jobs:
+                    try:
+                        win32print.SetJob(self._handle, job['JobId'], 0, None, win32print.JOB_CONTROL_DELETE)
+                        logger.info("✓ Trabajo %s cancelado", job['JobId'])
+                    except Exception as e:
+                        logger.error("✗ Error al cancelar trabajo %s: %s", job['JobId'], e)
+            time.sleep(2)
+            logger.info("✓ Cola de impresión limpiada")
+            return True
+        except Exception as e:
+            logger.error("✗ Error al limpiar cola de impresión: %s", e)
+            self.reset()
+            return False
+
+
+class NetworkBackend(PrinterBackend):
+    """Impresora de red en el puerto RAW (9100) con socket persistente.
+
+    Muchas impresoras solo aceptan una conexión a la vez, así que el socket
+    se cierra tras ``idle_timeout`` segundos sin uso.
+    """
+
+    kind = 'tcp'
+
+    def __init__(self, host: str, port: int = 9100, timeout: float = 10, idle_timeout: float = 30):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._sock = None
+        self._last_used = 0.0
+
+    def describe(self) -> str:
+        return f"tcp://{self.host}:{self.port}"
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._sock = sock
+        self._last_used = time.monotonic()
+
+    def _disconnect(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+
+    def _is_alive(self) -> bool:
+        if self._sock is None:
+            return False
+        if self.idle_timeout and time.monotonic() - self._last_used > self.idle_timeout:
+            return False
+        try:
+            # Si el socket es legible, la impresora ha cerrado (b'') o ha
+            # enviado bytes de estado, que descartamos
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            if readable:
+                self._sock.setblocking(False)
+                try:
+                    if not self._sock.recv(4096):
+                        return False
+                finally:
+                    self._sock.settimeout(self.timeout)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def _write(self, chunk: bytes):
+        self._sock.sendall(chunk)
+        self._last_used = time.monotonic()
+
+
+class FileBackend(PrinterBackend):
+    """Añade los bytes a un fichero abierto de forma persistente."""
+
+    kind = 'file'
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._file = None
+
+    def describe(self) -> str:
+        return f"file:{self.path}"
+
+    def _connect(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'ab')
+
+    def _disconnect(self):
+        f, self._file = self._file, None
+        if f is not None:
+            f.close()
+
+    def _is_alive(self) -> bool:
+        return self._file is not None and not self._file.closed
+
+    def _write(self, chunk: bytes):
+        self._file.write(chunk)
+
+    def _end_document(self):
+        self._file.flush()
+
+
+class LoopbackBackend(PrinterBackend):
+    """Descarta los bytes y cuenta lo enviado. Opcionalmente guarda los
+    últimos documentos para inspeccionarlos en pruebas."""
+
+    kind = 'loopback'
+
+    def __init__(self, keep_documents: int = 0):
+        super().__init__()
+        self.keep_documents = keep_documents
+        self.documents = []
+        self.bytes_written = 0
+        self.documents_written = 0
+        self._current = None
+
+    def _connect(self):
+        pass
+
+    def _disconnect(self):
+        self._current = None
+
+    def _begin_document(self):
+        self._current = bytearray() if self.keep_documents else None
+
+    def _write(self, chunk: bytes):
+        self.bytes_written += len(chunk)
+        if self._current is not None:
+            self._current += chunk
+
+    def _end_document(self):
+        self.documents_written += 1
+        if self._current is not None:
+            self.documents.append(bytes(self._current))
+            del self.documents[:-self.keep_documents]
+            self._current = None
+
+
+def create_backend(spec: str) -> PrinterBackend:
+    """Crear un backend a partir de su especificación en texto."""
+    spec = (spec or 'win32').strip()
+    if spec == 'win32' or spec.startswith('win32:'):
+        return Win32SpoolerBackend(spec[len('win32:'):] if ':' in spec else None)
+    if spec.startswith('tcp://'):
+        address = spec[len('tcp://'):].rstrip('/')
+        host, _, port = address.rpartition(':')
+        if not host or not port.isdigit():
+            host, port = address, '9100'
+        return NetworkBackend(host, int(port))
+    if spec.startswith('file:'):
+        path = spec[len('file:'):]
+        if path.startswith('//'):
+            path = path[2:]
+        return FileBackend(path)
+    if spec in ('loopback', 'null'):
+        return LoopbackBackend()
+    raise ValueError(f"Backend de impresora desconocido: {spec}")
@@ -0,0 +1,58 @@
+"""Límite de peticiones por cliente (token bucket).
+
+Cada cliente (dirección IP de la conexión) tiene un cubo de ``burst`` fichas
+que se rellena a ``rate`` fichas por segundo; cada trabajo consume una. Si el
+cubo está vacío, la petición se rechaza indicando cuántos segundos faltan para
+la siguiente ficha (cabecera Retry-After).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """Token bucket por cliente. ``rate`` <= 0 desactiva el límite. Se
+    recuerdan como mucho ``max_clients`` clientes (los más inactivos se olvidan)."""
+
+    def __init__(self, rate: float = 20.0, burst: int = 40, max_clients: int = 1024):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # cliente -> [fichas, última actualización]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def acquire(self, client: str, cost: float = 1.0) -> float:
+        """Consumir ``cost`` fichas del cliente. Devuelve 0 si se permite la
+        petición, o los segundos que debe esperar si se rechaza."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                bucket = [float(self.burst), now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            self._buckets[client] = bucket
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0.0
+            self.limited += 1
+            return (cost - bucket[0]) / self.rate
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'clients': len(self._buckets),
+                'allowed': self.allowed,
+                'limited': self.limited,
+            }
@@ -0,0 +1,103 @@
+"""Configuración de logs del servidor.
+
+Los hilos de petición e impresión nunca escriben directamente en la consola
+ni en disco: el ``QueueHandler`` deja cada registro en una cola y un
+``QueueListener`` en su propio hilo lo escribe en la consola (texto legible)
+y en un fichero rotativo (una línea JSON por registro, con los ids de los
+trabajos en curso). El detalle por línea/etapa va en nivel DEBUG, apagado
+por defecto.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+CONSOLE_FORMAT = '%(asctime)s %(message)s'
+CONSOLE_DATE_FORMAT = '%H:%M:%S'
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por línea: hora, nivel, logger, mensaje, hilo, ids de
+    trabajo y campos extra (``extra={...}``) del registro."""
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class JobContextFilter(logging.Filter):
+    """Añadir a cada registro los ids de los trabajos que procesa el hilo que
+    lo emite (``get_job_ids`` se llama en ese hilo, antes de encolarlo)."""
+
+    def __init__(self, get_job_ids):
+        super().__init__()
+        self.get_job_ids = get_job_ids
+
+    def filter(self, record):
+        if not hasattr(record, 'job_ids'):
+            job_ids = self.get_job_ids()
+            if job_ids:
+                record.job_ids = list(job_ids)
+        return True
+
+
+def setup_logging(level='INFO', log_file=None, max_bytes=5 * 1024 * 1024, backups=5,
+                  get_job_ids=None):
+    """Configurar el logger raíz con un handler en cola. Devuelve el
+    ``QueueListener`` (ya arrancado); se puede volver a llamar para cambiar
+    la configuración."""
+    global _listener
+    stop_logging()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT, CONSOLE_DATE_FORMAT))
+    handlers = [console]
+    if log_file:
+        os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+        rotating = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        rotating.setFormatter(JsonFormatter())
+        handlers.append(rotating)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    if get_job_ids is not None:
+        queue_handler.addFilter(JobContextFilter(get_job_ids))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Vaciar la cola de logs y detener el hilo escritor."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,70 @@
+"""El empaquetado en bloque de escpos_raster produce exactamente los mismos
+bytes que el bucle píxel a píxel original (printServer.create_qr_raster_data)."""
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from escpos_raster import image_to_raster, pack_image, raster_header
+
+THRESHOLD = 128
+SIZES = [(1, 1), (7, 3), (8, 5), (13, 9), (280, 280), (385, 17)]
+
+
+def reference_raster(gray, threshold=THRESHOLD):
+    """Bucle original: binarizar con point() y recorrer los píxeles."""
+    bw = gray.point(lambda x: 0 if x < threshold else 255, '1')
+    w, h = bw.size
+    width_bytes = (w + 7) // 8
+    pixels = bw.load()
+    raster_data = bytearray()
+    for y in range(h):
+        for xb in range(width_bytes):
+            byte = 0
+            for bit in range(8):
+                x = xb * 8 + bit
+                bit_val = (1 if pixels[x, y] == 0 else 0) if x < w else 0
+                byte = (byte << 1) | bit_val
+            raster_data.append(byte)
+    return raster_header(width_bytes, h) + bytes(raster_data)
+
+
+def random_gray(width, height, seed):
+    rng = random.Random(seed)
+    img = Image.new('L', (width, height))
+    img.putdata([rng.randrange(256) for _ in range(width * height)])
+    return img
+
+
+@pytest.mark.parametrize('width,height', SIZES)
+def test_pil_gray_matches_reference(width, height):
+    img = random_gray(width, height, seed=width * 1000 + height)
+    assert image_to_raster(img, THRESHOLD) == reference_raster(img)
+
+
+@pytest.mark.parametrize('width,height', SIZES)
+def test_pil_rgb_matches_reference(width, height):
+    img = random_gray(width, height, seed=height).convert('RGB')
+    assert image_to_raster(img, THRESHOLD) == reference_raster(img.convert('L'))
+
+
+@pytest.mark.parametrize('width,height', SIZES)
+def test_numpy_gray_matches_reference(width, height):
+    img = random_gray(width, height, seed=width)
+    array = np.asarray(img, dtype=np.uint8)
+    assert image_to_raster(array, THRESHOLD) == reference_raster(img)
+
+
+@pytest.mark.parametrize('width,height', SIZES)
+def test_numpy_bool_matches_reference(width, height):
+    dots = np.random.default_rng(width + height).random((height, width)) < 0.5  # True = negro
+    img = Image.fromarray(np.where(dots, 0, 255).astype(np.uint8), 'L')
+    assert image_to_raster(dots, THRESHOLD) == reference_raster(img)
+
+
+def test_pack_image_pads_rows_with_white():
+    img = Image.new('L', (13, 2), 0)  # todo negro
+    width_bytes, height, data = pack_image(img)
+    assert (width_bytes, height) == (2, 2)
+    assert data == b'\xff\xf8' * 2
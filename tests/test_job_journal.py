@@ -0,0 +1,150 @@
+"""Diario de trabajos (JobJournal) y claves de idempotencia."""
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from job_journal import IdempotencyKeys, JobJournal, JournalError
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'journal' / 'jobs.db')
+
+
+@pytest.fixture
+def journal(db_path):
+    return JobJournal(db_path, retention_days=1)
+
+
+def make_job(job_id, created=None, **extra):
+    return {'id': job_id, 'type': 'text', 'printer': 'default',
+            'created': time.time() if created is None else created, **extra}
+
+
+def rows(db_path, query="SELECT id, state FROM jobs ORDER BY created"):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(query).fetchall()
+
+
+def test_append_is_on_disk_when_it_returns(journal, db_path):
+    journal.append([make_job('a'), make_job('b')])
+    assert sorted(rows(db_path)) == [('a', 'queued'), ('b', 'queued')]
+
+
+def test_append_empty_returns_immediately(journal):
+    journal.append([])
+    assert journal.commits == 0
+
+
+def test_concurrent_appends_share_commits(db_path):
+    journal = JobJournal(db_path, commit_interval=0.05)
+    threads = [threading.Thread(target=journal.append, args=([make_job(f'j{i}')],)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(rows(db_path)) == 20
+    assert journal.batched_ops == 20
+    assert journal.commits < 20
+
+
+def test_append_raises_when_commit_fails(journal, monkeypatch):
+    def broken(batch):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(journal, '_commit_locked', broken)
+    with pytest.raises(JournalError, match='disk I/O error'):
+        journal.append([make_job('a')])
+
+
+def test_append_raises_on_timeout(db_path, monkeypatch):
+    journal = JobJournal(db_path, commit_timeout=0.05)
+    release = threading.Event()
+    commit = journal._commit_locked
+    monkeypatch.setattr(journal, '_commit_locked', lambda batch: (release.wait(), commit(batch)))
+    with pytest.raises(JournalError, match='no confirmó'):
+        journal.append([make_job('a')])
+    release.set()
+
+
+def test_recover_returns_unfinished_jobs_in_order(journal, db_path):
+    now = time.time()
+    journal.append([make_job('second', now + 1), make_job('first', now), make_job('third', now + 2)])
+    journal.finish('third', True)
+    assert journal.flush()
+    assert [job['id'] for job in JobJournal(db_path).recover()] == ['first', 'second']
+
+
+def test_recover_round_trips_job_and_payload(journal, db_path):
+    job = make_job('pdf', type='pdf', copies=2, options={'dither': True}, pdf_bytes=b'%PDF-\x00\xff')
+    journal.append([job])
+    recovered, = JobJournal(db_path).recover()
+    assert recovered == job
+    assert isinstance(recovered['pdf_bytes'], bytes)
+
+
+def test_finish_records_state_and_drops_payload(journal, db_path):
+    journal.append([make_job('ok', pdf_bytes=b'x'), make_job('ko'), make_job('no')])
+    journal.finish('ok', True)
+    journal.finish('ko', False)
+    journal.finish('no', False, rejected=True)
+    assert journal.flush()
+    assert dict(rows(db_path, "SELECT id, state FROM jobs")) == {'ok': 'done', 'ko': 'failed', 'no': 'rejected'}
+    assert rows(db_path, "SELECT payload FROM jobs WHERE id = 'ok'") == [(None,)]
+
+
+def test_recent_keys_skips_old_and_rejected_jobs(journal):
+    now = time.time()
+    journal.append([
+        make_job('a', now, idempotency_key='A'),
+        make_job('b', now - 7200, idempotency_key='B'),
+        make_job('c', now, idempotency_key='C'),
+        make_job('d', now),
+    ])
+    journal.finish('c', False, rejected=True)
+    assert journal.flush()
+    assert journal.recent_keys(3600) == [('A', 'a', now)]
+
+
+def test_prune_keeps_queued_jobs(journal, db_path):
+    old = time.time() - 3 * 86400
+    journal.append([make_job('old-done', old), make_job('old-queued', old), make_job('new-done')])
+    journal.finish('old-done', True)
+    journal.finish('new-done', True)
+    assert journal.flush()
+    journal._prune()
+    assert sorted(rows(db_path)) == [('new-done', 'done'), ('old-queued', 'queued')]
+
+
+def test_idempotency_reserve_returns_existing_job():
+    keys = IdempotencyKeys()
+    assert keys.reserve('k', 'job1') is None
+    assert keys.reserve('k', 'job2') == 'job1'
+    assert len(keys) == 1
+
+
+def test_idempotency_release_only_own_reservation():
+    keys = IdempotencyKeys()
+    keys.reserve('k', 'job1')
+    keys.release('k', 'other')
+    assert keys.reserve('k', 'job2') == 'job1'
+    keys.release('k', 'job1')
+    assert keys.reserve('k', 'job2') is None
+
+
+def test_idempotency_keys_expire():
+    keys = IdempotencyKeys(key_ttl=60, max_keys=1)
+    keys.load([('old', 'job0', time.time() - 120)])
+    assert keys.reserve('old', 'job1') is None  # Caducada: se reasigna
+    keys.load([('stale', 'job2', time.time() - 120)])
+    keys.reserve('new', 'job3')  # Supera max_keys: se purgan las caducadas
+    assert len(keys) == 2
+
+
+def test_idempotency_load_from_journal(journal):
+    journal.append([make_job('a', idempotency_key='A')])
+    keys = IdempotencyKeys()
+    keys.load(journal.recent_keys(keys.key_ttl))
+    assert keys.reserve('A', 'b') == 'a'
@@ -0,0 +1,158 @@
+"""Límites de admisión, cupo urgente y orden de PriorityJobQueue."""
+import queue
+import time
+
+import pytest
+
+from print_scheduler import PriorityJobQueue, is_urgent
+
+
+def job(job_type, data='', **extra):
+    return {'type': job_type, 'text': data, **extra}
+
+
+def drain(q):
+    jobs = []
+    while not q.empty():
+        jobs.append(q.get_nowait())
+    return jobs
+
+
+def test_put_rejects_over_max_jobs():
+    q = PriorityJobQueue(max_jobs=2)
+    q.put(job('text'))
+    q.put(job('pdf'))
+    with pytest.raises(queue.Full, match='max_jobs'):
+        q.put(job('text'))
+    assert q.qsize() == 2
+    assert q.stats()['rejected'] == {'max_jobs': 1}
+
+
+def test_put_rejects_over_max_bytes_but_admits_first_job():
+    q = PriorityJobQueue(max_bytes=100)
+    q.put(job('text', 'x' * 500))  # Con la cola vacía entra aunque sea grande
+    with pytest.raises(queue.Full, match='max_bytes'):
+        q.put(job('text', 'x'))
+
+
+def test_put_waits_for_room_until_timeout():
+    q = PriorityJobQueue(max_jobs=1)
+    q.put(job('text'))
+    start = time.monotonic()
+    with pytest.raises(queue.Full):
+        q.put(job('text'), timeout=0.05)
+    assert time.monotonic() - start >= 0.05
+
+
+def test_put_many_is_all_or_nothing():
+    q = PriorityJobQueue(max_jobs=3)
+    q.put(job('text'))
+    with pytest.raises(queue.Full, match='max_jobs'):
+        q.put_many([job('text'), job('text'), job('pdf')])
+    assert q.qsize() == 1
+    assert q.stats()['rejected'] == {'max_jobs': 3}
+    q.put_many([job('text'), job('pdf')])
+    assert q.qsize() == 3
+
+
+def test_put_many_respects_max_bytes():
+    q = PriorityJobQueue(max_bytes=100)
+    q.put(job('text', 'x' * 60))
+    with pytest.raises(queue.Full, match='max_bytes'):
+        q.put_many([job('text', 'x' * 30), job('text', 'x' * 30)])
+    assert q.qsize() == 1
+
+
+def test_force_ignores_limits():
+    q = PriorityJobQueue(max_jobs=1)
+    q.put(job('text'))
+    q.put(job('text'), force=True)
+    q.put_many([job('text')], force=True)
+    assert q.qsize() == 3
+
+
+def test_check_many_does_not_enqueue():
+    q = PriorityJobQueue(max_jobs=1)
+    q.check_many([job('text')])
+    assert q.qsize() == 0
+    q.put(job('text'))
+    with pytest.raises(queue.Full, match='max_jobs'):
+        q.check_many([job('text')])
+
+
+def test_urgent_jobs_bypass_full_queue():
+    q = PriorityJobQueue(max_jobs=1, max_bytes=10, urgent_headroom=2)
+    q.put(job('pdf', 'x' * 50))
+    q.put(job('drawer'))
+    q.put(job('cut'))
+    assert q.stats()['urgent'] == 2
+    with pytest.raises(queue.Full, match='urgent_headroom'):
+        q.put(job('drawer'))
+
+
+def test_urgent_jobs_do_not_fill_normal_quota():
+    q = PriorityJobQueue(max_jobs=1, urgent_headroom=4)
+    for _ in range(4):
+        q.put(job('drawer'))
+    q.put(job('text'))
+    with pytest.raises(queue.Full, match='max_jobs'):
+        q.put(job('text'))
+
+
+def test_urgent_headroom_frees_when_taken():
+    q = PriorityJobQueue(urgent_headroom=1)
+    q.put(job('drawer'))
+    assert q.get_nowait()['type'] == 'drawer'
+    q.put(job('drawer'))
+    assert q.stats()['urgent'] == 1
+
+
+def test_put_many_checks_urgent_quota_separately():
+    q = PriorityJobQueue(max_jobs=1, urgent_headroom=1)
+    with pytest.raises(queue.Full, match='urgent_headroom'):
+        q.put_many([job('text'), job('drawer'), job('cut')])
+    assert q.qsize() == 0
+    q.put_many([job('text'), job('drawer')])
+    assert q.stats()['urgent'] == 1
+
+
+def test_grouped_urgent_jobs_count_as_normal():
+    grouped = job('drawer', group='g1', group_index=1)
+    assert is_urgent(job('drawer'))
+    assert not is_urgent(grouped)
+
+    q = PriorityJobQueue(max_jobs=2, urgent_headroom=1)
+    q.put_many([job('text', group='g1', group_index=0), grouped])
+    stats = q.stats()
+    assert stats['urgent'] == 0
+    assert stats['depth'] == 2
+    q.put(job('drawer'))  # El cupo urgente sigue libre
+    with pytest.raises(queue.Full, match='max_jobs'):
+        q.put(job('cut', group='g2', group_index=0))
+
+
+def test_priority_order_without_aging():
+    q = PriorityJobQueue(aging_seconds=0)
+    q.put(job('pdf', 'p'))
+    q.put(job('text', 't'))
+    q.put(job('drawer'))
+    q.put(job('text', 'u'))
+    assert [j['type'] for j in drain(q)] == ['drawer', 'text', 'text', 'pdf']
+
+
+def test_aging_lets_old_jobs_overtake():
+    q = PriorityJobQueue(aging_seconds=0.01)
+    q.put(job('pdf', 'old'))
+    time.sleep(0.05)  # Más de un nivel de envejecimiento
+    q.put(job('text', 'new'))
+    assert [j['text'] for j in drain(q)] == ['old', 'new']
+
+
+def test_take_matching_and_discard_release_room():
+    q = PriorityJobQueue(max_jobs=3)
+    q.put_many([job('text', 'a', group='g'), job('text', 'b'), job('pdf', 'c', group='g')])
+    taken = q.take_matching(lambda j: j.get('group') == 'g')
+    assert [j['text'] for j in taken] == ['a', 'c']
+    assert q.discard(lambda j: j['text'] == 'b') == 1
+    assert q.qsize() == 0
+    q.put_many([job('text'), job('text'), job('text')])
@@ -0,0 +1,71 @@
+"""Token bucket por cliente de RateLimiter."""
+import pytest
+
+import rate_limit
+from rate_limit import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limit.time, 'monotonic', fake)
+    return fake
+
+
+def test_burst_then_retry_after(clock):
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.acquire('a') for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire('a') == pytest.approx(0.5)
+    clock.now += 0.25
+    assert limiter.acquire('a') == pytest.approx(0.25)
+    assert limiter.stats()['allowed'] == 3
+    assert limiter.stats()['limited'] == 2
+
+
+def test_refill_is_capped_at_burst(clock):
+    limiter = RateLimiter(rate=2, burst=3)
+    for _ in range(3):
+        limiter.acquire('a')
+    clock.now += 0.5
+    assert limiter.acquire('a') == 0.0
+    assert limiter.acquire('a') > 0
+    clock.now += 60
+    assert [limiter.acquire('a') for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire('a') > 0
+
+
+def test_clients_have_separate_buckets(clock):
+    limiter = RateLimiter(rate=1, burst=1)
+    assert limiter.acquire('a') == 0.0
+    assert limiter.acquire('a') > 0
+    assert limiter.acquire('b') == 0.0
+
+
+def test_cost_consumes_several_tokens(clock):
+    limiter = RateLimiter(rate=1, burst=5)
+    assert limiter.acquire('a', cost=4) == 0.0
+    assert limiter.acquire('a', cost=4) == pytest.approx(3.0)
+
+
+def test_max_clients_evicts_least_recently_seen(clock):
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    limiter.acquire('a')
+    limiter.acquire('b')
+    limiter.acquire('a')  # 'a' vuelve a ser el más reciente
+    limiter.acquire('c')  # Se olvida 'b'
+    assert limiter.stats()['clients'] == 2
+    assert limiter.acquire('a') > 0  # 'a' sigue con el cubo vacío
+    assert limiter.acquire('b') == 0.0  # Cubo nuevo y lleno
+
+
+def test_zero_rate_disables_limit(clock):
+    limiter = RateLimiter(rate=0, burst=1)
+    assert all(limiter.acquire('a') == 0.0 for _ in range(100))
@@ -0,0 +1,82 @@
+"""Codificación de texto para impresoras térmicas ESC/POS.
+
+Todas las sustituciones de caracteres se compilan una vez en una tabla de
+``str.translate``, de modo que codificar un ticket es una sola pasada lineal.
+Con una página de códigos nativa se emite ``ESC t n`` para seleccionarla y
+los acentos y la ñ se imprimen tal cual en lugar de eliminarse.
+"""
+import functools
+
+ESC = b'\x1B'
+
+# Páginas de códigos soportadas: nombre -> (codec de Python, n para ESC t n).
+# Los valores de n son los de la tabla de Epson, que siguen la mayoría de
+# impresoras ESC/POS compatibles.
+CODE_PAGES = {
+    'cp437': ('cp437', 0),
+    'cp850': ('cp850', 2),
+    'cp858': ('cp858', 19),  # cp850 con el símbolo €
+    'cp1252': ('cp1252', 16),
+}
+
+# Codificación del modo clásico (sin ESC t): la página por defecto de la
+# impresora solo garantiza ASCII, así que se eliminan los acentos.
+LEGACY_CODEC = 'cp850'
+
+# Signos tipográficos que no existen en ninguna página de códigos
+TYPOGRAPHIC_REPLACEMENTS = {
+    '“': '"', '”': '"',  # Comillas dobles curvas
+    '‘': "'", '’': "'",  # Comillas simples curvas
+    '–': '-', '—': '-',
+    '…': '...',
+}
+
+# Equivalentes sin acentos para cuando la página de códigos no los tiene
+ASCII_REPLACEMENTS = {
+    'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
+    'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
+    'ñ': 'n', 'Ñ': 'N',
+    'ü': 'u', 'Ü': 'U',
+    '€': 'EUR',
+    '°': 'º',
+    '¿': '?',
+    '¡': '!',
+}
+
+
+class TextEncoder:
+    """Codificador precompilado para una página de códigos.
+
+    ``code_page=None`` reproduce el comportamiento clásico: se quitan acentos
+    y no se cambia la página de códigos de la impresora.
+    """
+
+    def __init__(self, code_page: str = None):
+        if code_page is not None and code_page not in CODE_PAGES:
+            raise ValueError(f"Página de códigos no soportada: {code_page}")
+        self.code_page = code_page
+
+        replacements = dict(TYPOGRAPHIC_REPLACEMENTS)
+        if code_page is None:
+            self.codec = LEGACY_CODEC
+            self.select_command = b''
+            replacements.update(ASCII_REPLACEMENTS)
+        else:
+            self.codec, n = CODE_PAGES[code_page]
+            self.select_command = ESC + b't' + bytes([n])
+            # Solo sustituir lo que esta página de códigos no puede imprimir
+            for char, replacement in ASCII_REPLACEMENTS.items():
+                try:
+                    char.encode(self.codec)
+                except UnicodeEncodeError:
+                    replacements[char] = replacement
+
+        self.table = str.maketrans(replacements)
+        # Textos fijos ("QR Tributario", pies...) se codifican una sola vez
+        self.encode_constant = functools.lru_cache(maxsize=256)(self.encode)
+
+    def encode(self, text: str) -> bytes:
+        """Codificar texto en una sola pasada; lo no representable pasa a '?'."""
+        if text is None:
+            text = ""
+        return text.translate(self.table).encode(self.codec, errors='replace')
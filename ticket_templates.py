@@ -0,0 +1,463 @@
+"""Plantillas de ticket ESC/POS precompiladas.
+
+El cliente envía solo los datos del pedido (líneas, precios, IVA) y el
+servidor compone el ticket con una plantilla con nombre. Cada plantilla se
+compila una vez por página de códigos: las partes fijas (cabecera, títulos de
+columna, separadores, pie, cambios de estilo) quedan como bytes ESC/POS ya
+codificados y las filas de artículos usan un formato de columnas precompilado.
+Rellenar un ticket es concatenar fragmentos y formatear las partes variables.
+
+Formato de una plantilla (fichero ``<nombre>.json`` en el directorio de
+plantillas; ``default`` viene incluida)::
+
+    {
+      "width": 42,
+      "header": [{"text": "Mi Bar", "align": "center", "size": "double", "bold": true},
+                 "=", "Ticket: {number}   Mesa: {table}", "-"],
+      "columns": [{"field": "name", "title": "DESCRIPCION", "width": 20, "wrap": true},
+                  {"field": "qty", "title": "CANT", "width": 5, "align": "right"},
+                  ...],
+      "totals": {"vat_breakdown": true, "size": "tall", "bold": true},
+      "footer": ["=", {"text": "Gracias por su visita", "align": "center"}],
+      "decimal_separator": ".", "vat": 10, "prices_include_vat": true, "feed": 16
+    }
+
+Una línea es un texto (``"-"`` o ``"="`` dibujan un separador) o un objeto con
+``text``, ``align`` (left/center/right), ``size`` (normal/tall/wide/double)
+y ``bold``. Los textos admiten campos ``{number}``, ``{date}``, ``{total}``...
+del pedido; una línea cuyos campos no vienen en el pedido se omite.
+"""
+import copy
+import json
+import logging
+import os
+import re
+import textwrap
+import threading
+import time
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from string import Formatter
+
+logger = logging.getLogger(__name__)
+
+ESC = b'\x1B'
+GS = b'\x1D'
+
+ALIGNMENTS = {'left': 0, 'center': 1, 'right': 2}
+# GS ! n: nibble alto = ancho x2, nibble bajo = alto x2
+SIZES = {'normal': 0x00, 'tall': 0x01, 'wide': 0x10, 'double': 0x11}
+COLUMN_FIELDS = ('name', 'qty', 'price', 'total', 'vat')
+CENT = Decimal('0.01')
+# Límites de cantidades/importes y del tipo de IVA: fuera de ellos los
+# cálculos no tienen sentido (y un '1e30' desbordaría el redondeo a céntimos)
+MAX_NUMBER = Decimal('1e9')
+MAX_VAT_RATE = Decimal(100)
+TEMPLATE_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+DEFAULT_TEMPLATE = {
+    'width': 42,
+    'header': [
+        {'text': '{business}', 'align': 'center', 'size': 'double', 'bold': True},
+        {'text': '{address}', 'align': 'center'},
+        {'text': 'CIF: {tax_id}', 'align': 'center'},
+        '-',
+        'Fecha: {date}   Hora: {time}',
+        'Ticket: {number}',
+        'Mesa: {table}',
+        '-',
+    ],
+    'columns': [
+        {'field': 'name', 'title': 'DESCRIPCION', 'width': 20, 'wrap': True},
+        {'field': 'qty', 'title': 'CANT', 'width': 5, 'align': 'right', 'prefix': 'x'},
+        {'field': 'price', 'title': 'PRECIO', 'width': 8, 'align': 'right'},
+        {'field': 'total', 'title': 'TOTAL', 'width': 9, 'align': 'right'},
+    ],
+    'totals': {'vat_breakdown': True, 'size': 'tall', 'bold': True},
+    'footer': [
+        '=',
+        '',
+        {'text': 'Gracias por su visita', 'align': 'center'},
+        {'text': '{footer}', 'align': 'center'},
+    ],
+    'labels': {'base': 'Base Imponible', 'vat': 'IVA', 'total': 'TOTAL'},
+    'decimal_separator': '.',
+    'vat': 10,
+    'prices_include_vat': True,
+    'feed': 16,
+}
+
+
+class TemplateError(ValueError):
+    """Plantilla desconocida o mal definida, o datos del pedido no válidos."""
+
+
+def style_command(align: str = 'left', size: str = 'normal', bold: bool = False) -> bytes:
+    """ESC a (alineación) + GS ! (tamaño) + ESC E (negrita)."""
+    return (ESC + b'a' + bytes([ALIGNMENTS[align]])
+            + GS + b'!' + bytes([SIZES[size]])
+            + ESC + b'E' + bytes([1 if bold else 0]))
+
+
+RESET_STYLE = style_command()
+
+
+def to_decimal(value, what: str, maximum: Decimal = MAX_NUMBER) -> Decimal:
+    """Número del pedido como Decimal; TemplateError si no es un número
+    finito o su valor absoluto supera ``maximum``."""
+    if isinstance(value, float):
+        value = repr(value)  # 8.5 -> '8.5', sin arrastrar el error binario
+    try:
+        number = Decimal(str(value).strip().replace(',', '.'))
+    except (InvalidOperation, ValueError):
+        raise TemplateError(f"Valor numérico no válido en '{what}': {value!r}") from None
+    if not number.is_finite():
+        raise TemplateError(f"Valor numérico no válido en '{what}': {value!r}")
+    if abs(number) > maximum:
+        raise TemplateError(f"Valor fuera de rango en '{what}': {value!r}")
+    return number
+
+
+def parse_order(order, default_vat=10, prices_include_vat=True):
+    """Validar el pedido y calcular importes. Devuelve (líneas, totales):
+    cada línea con name, qty, price, total, vat, notes (Decimal en los
+    importes) y los totales con 'base', 'vat', 'total' y el desglose de IVA
+    por tipo ``{tipo: (base, cuota)}``. Con ``prices_include_vat`` los precios
+    son con IVA incluido (lo habitual en hostelería)."""
+    if not isinstance(order, dict):
+        raise TemplateError("El pedido debe ser un objeto JSON")
+    items = order.get('items')
+    if not isinstance(items, list) or not items:
+        raise TemplateError("El pedido no tiene líneas ('items')")
+    default_vat = to_decimal(order.get('vat', default_vat), 'vat', MAX_VAT_RATE)
+    prices_include_vat = bool(order.get('prices_include_vat', prices_include_vat))
+
+    lines = []
+    gross_by_rate = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not str(item.get('name', '')).strip():
+            raise TemplateError(f"Línea {i + 1} sin nombre")
+        qty = to_decimal(item.get('qty', 1), f'items[{i}].qty')
+        price = to_decimal(item.get('price', 0), f'items[{i}].price')
+        if 'total' in item:
+            total = to_decimal(item['total'], f'items[{i}].total')
+        else:
+            total = qty * price
+        total = total.quantize(CENT, ROUND_HALF_UP)
+        rate = to_decimal(item.get('vat', default_vat), f'items[{i}].vat', MAX_VAT_RATE)
+        if rate < 0:
+            raise TemplateError(f"Tipo de IVA negativo en 'items[{i}].vat': {rate}")
+        notes = item.get('notes') or []
+        if isinstance(notes, str):
+            notes = [notes]
+        lines.append({'name': str(item['name']).strip(), 'qty': qty, 'price': price,
+                      'total': total, 'vat': rate, 'notes': [str(note) for note in notes]})
+        gross_by_rate[rate] = gross_by_rate.get(rate, Decimal(0)) + total
+
+    breakdown = {}
+    for rate, amount in sorted(gross_by_rate.items()):
+        if prices_include_vat:
+            # La base se redondea y la cuota es la diferencia: base + cuota
+            # coincide siempre con la suma de las líneas
+            base = (amount * 100 / (100 + rate)).quantize(CENT, ROUND_HALF_UP)
+            breakdown[rate] = (base, amount - base)
+        else:
+            breakdown[rate] = (amount, (amount * rate / 100).quantize(CENT, ROUND_HALF_UP))
+    base = sum((b for b, _ in breakdown.values()), Decimal(0))
+    vat = sum((v for _, v in breakdown.values()), Decimal(0))
+    return lines, {'base': base, 'vat': vat, 'total': base + vat, 'breakdown': breakdown}
+
+
+def format_quantity(qty: Decimal) -> str:
+    """Cantidad sin decimales superfluos: 2 -> '2', 0.500 -> '0.5'."""
+    if qty == qty.to_integral_value():
+        return str(qty.quantize(Decimal(1)))
+    return format(qty.normalize(), 'f')
+
+
+def format_rate(rate: Decimal) -> str:
+    return format_quantity(rate) + '%'
+
+
+class _Field:
+    """Línea con campos del pedido: se formatea y codifica al rellenar."""
+    __slots__ = ('prefix', 'text', 'fields', 'suffix')
+
+    def __init__(self, prefix, text, fields, suffix):
+        self.prefix, self.text, self.fields, self.suffix = prefix, text, fields, suffix
+
+
+class CompiledTemplate:
+    """Plantilla compilada para un codificador de texto concreto."""
+
+    def __init__(self, name: str, spec: dict, encoder):
+        self.name = name
+        self.encoder = encoder
+        try:
+            self._compile(spec)
+        except TemplateError:
+            raise
+        except (KeyError, TypeError, ValueError) as e:
+            raise TemplateError(f"Plantilla '{name}' mal definida: {e}") from None
+
+    def render(self, order: dict, logo: bytes = b'', qr: bytes = b'') -> bytes:
+        """Bytes ESC/POS del ticket, sin el corte final. ``logo`` y ``qr`` son
+        bloques ya generados que se imprimen centrados al principio."""
+        lines, totals = parse_order(order, self.vat, self.prices_include_vat)
+        values = self._values(order, lines, totals)
+        encode = self.encoder.encode
+
+        out = bytearray(self.prologue)
+        if logo:
+            out += self.center + logo + self.left
+        if qr:
+            out += self.qr_prefix + qr + self.qr_suffix
+        self._render_lines(out, self.header, values)
+        out += self.column_titles
+
+        # Las partes variables consecutivas se codifican de una vez
+        rows = []
+        for line in lines:
+            name_chunks = self._name_chunks(line['name'])
+            rows.append(self.row_format.format(*[self._cell(line, field, name_chunks[0])
+                                                 for field in self.column_fields]))
+            rows.extend(self.name_indent + chunk + '\n' for chunk in name_chunks[1:])
+            rows.extend(('   + ' + note)[:self.width] + '\n' for note in line['notes'])
+        out += encode(''.join(rows))
+
+        out += self.totals_separator
+        if self.vat_breakdown:
+            rows = []
+            for rate, (base, vat) in totals['breakdown'].items():
+                rows.append(self._amount_line(f"{self.labels['base']} ({format_rate(rate)})", base))
+                rows.append(self._amount_line(f"{self.labels['vat']} ({format_rate(rate)})", vat))
+            out += encode(''.join(rows))
+            out += self.totals_separator
+        out += self.total_style
+        out += encode(self._amount_line(self.labels['total'], totals['total'], self.total_width))
+        out += RESET_STYLE
+        self._render_lines(out, self.footer, values)
+        out += self.epilogue
+        return bytes(out)
+
+    def validate(self, order: dict):
+        """Comprobar el pedido sin componer el ticket (lanza TemplateError)."""
+        parse_order(order, self.vat, self.prices_include_vat)
+
+    # --- Compilación ---
+
+    def _compile(self, spec):
+        encode = self.encoder.encode
+        self.width = int(spec.get('width', 42))
+        if not 16 <= self.width <= 128:
+            raise TemplateError(f"Ancho no válido en la plantilla '{self.name}': {self.width}")
+        self.vat = spec.get('vat', 10)
+        self.prices_include_vat = bool(spec.get('prices_include_vat', True))
+        self.decimal_separator = str(spec.get('decimal_separator', '.'))
+        self.labels = dict(DEFAULT_TEMPLATE['labels'], **spec.get('labels', {}))
+
+        self.center = ESC + b'a\x01'
+        self.left = ESC + b'a\x00'
+        # ESC @ restablece la página de códigos, por eso se selecciona después
+        self.prologue = ESC + b'@' + ESC + b'3' + bytes([24]) + self.encoder.select_command
+        qr_caption = spec.get('qr_caption', ['QR Tributario:', 'VERI*FACTU'])
+        self.qr_prefix = self.center + encode(qr_caption[0] + '\n') + ESC + b'd\x01'
+        self.qr_suffix = encode('\n' + qr_caption[1] + '\n') + ESC + b'd\x03' + self.left
+        self.epilogue = ESC + b'd' + bytes([min(255, max(0, int(spec.get('feed', 16))))])
+
+        self.header = self._compile_lines(spec.get('header', []))
+        self.footer = self._compile_lines(spec.get('footer', []))
+
+        columns = spec.get('columns') or DEFAULT_TEMPLATE['columns']
+        formats, titles = [], []
+        self.column_fields, self.column_prefixes = [], {}
+        self.name_wrapper, self.name_indent = None, ''
+        offset = 0
+        for column in columns:
+            field = column['field']
+            if field not in COLUMN_FIELDS:
+                raise TemplateError(f"Columna desconocida en la plantilla '{self.name}': {field}")
+            width = int(column['width'])
+            align = '>' if column.get('align', 'left') == 'right' else '<'
+            formats.append(f'{{{len(formats)}:{align}{width}.{width}}}')
+            titles.append(format(column.get('title', ''), f'{align}{width}.{width}'))
+            self.column_fields.append(field)
+            self.column_prefixes[field] = column.get('prefix', '')
+            if field == 'name' and column.get('wrap'):
+                # Nombres largos: se parten por palabras en líneas de continuación
+                self.name_wrapper = textwrap.TextWrapper(width)
+                self.name_indent = ' ' * offset
+            offset += width
+        if offset > self.width:
+            raise TemplateError(f"Las columnas de la plantilla '{self.name}' ocupan {offset} caracteres "
+                                f"(ancho {self.width})")
+        self.row_format = ''.join(formats) + '\n'
+        separator = encode('-' * self.width + '\n')
+        titles = ''.join(titles).rstrip()
+        self.column_titles = (encode(titles + '\n') + separator) if titles else b''
+
+        totals = spec.get('totals', DEFAULT_TEMPLATE['totals'])
+        self.vat_breakdown = bool(totals.get('vat_breakdown', True))
+        size = totals.get('size', 'tall')
+        self.total_style = style_command('left', size, bool(totals.get('bold', True)))
+        # En ancho doble caben la mitad de caracteres por línea
+        self.total_width = self.width // 2 if SIZES[size] & 0x10 else self.width
+        self.totals_separator = separator
+
+    def _compile_lines(self, lines):
+        """Lista de bytes fijos y ``_Field`` (líneas con campos), con los
+        fragmentos fijos consecutivos ya unidos."""
+        compiled = []
+        for line in lines:
+            if isinstance(line, str):
+                line = {'text': line}
+            text = str(line.get('text', ''))
+            if text in ('-', '='):
+                text = text * self.width
+            style = style_command(line.get('align', 'left'), line.get('size', 'normal'), bool(line.get('bold')))
+            fields = [name for _, name, _, _ in Formatter().parse(text) if name]
+            if fields:
+                styled = style != RESET_STYLE
+                compiled.append(_Field(style if styled else b'', text, fields, RESET_STYLE if styled else b''))
+            else:
+                fixed = self.encoder.encode(text + '\n')
+                if style != RESET_STYLE:
+                    fixed = style + fixed + RESET_STYLE
+                if compiled and isinstance(compiled[-1], bytes):
+                    compiled[-1] += fixed
+                else:
+                    compiled.append(fixed)
+        return compiled
+
+    # --- Relleno ---
+
+    def _render_lines(self, out, compiled, values):
+        for part in compiled:
+            if isinstance(part, bytes):
+                out += part
+            elif all(values.get(name) not in (None, '') for name in part.fields):
+                out += part.prefix + self.encoder.encode(part.text.format_map(values) + '\n') + part.suffix
+
+    def _values(self, order, lines, totals):
+        now = time.localtime()
+        values = {'date': time.strftime('%d/%m/%Y', now), 'time': time.strftime('%H:%M', now)}
+        values.update((key, str(value)) for key, value in order.items()
+                      if isinstance(value, (str, int, float)) and not isinstance(value, bool))
+        values.update(total=self.money(totals['total']), base=self.money(totals['base']),
+                      vat_total=self.money(totals['vat']), item_count=str(len(lines)))
+        return values
+
+    def money(self, amount: Decimal) -> str:
+        text = format(amount, '.2f')
+        return text.replace('.', self.decimal_separator) if self.decimal_separator != '.' else text
+
+    def _cell(self, line, field, name):
+        if field == 'name':
+            return name
+        value = line[field]
+        if field == 'qty':
+            text = format_quantity(value)
+        elif field == 'vat':
+            text = format_rate(value)
+        else:
+            text = self.money(value)
+        return self.column_prefixes[field] + text
+
+    def _name_chunks(self, name):
+        if self.name_wrapper is None or len(name) <= self.name_wrapper.width:
+            return [name]
+        return self.name_wrapper.wrap(name)
+
+    def _amount_line(self, label, amount, width=None):
+        width = width or self.width
+        amount = self.money(amount)
+        return label[:max(0, width - len(amount) - 1)].ljust(width - len(amount)) + amount + '\n'
+
+
+class TemplateLibrary:
+    """Plantillas con nombre: ``default`` y los ficheros ``<nombre>.json`` de
+    ``directory``. Se compilan en el primer uso con cada codificador y se
+    vuelven a compilar si el fichero cambia (se comprueba como mucho cada
+    ``check_interval`` segundos)."""
+
+    def __init__(self, directory: str = None, check_interval: float = 5.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._compiled = {}  # nombre -> (plantilla compilada, mtime, última comprobación)
+        self.compilations = 0
+        self.renders = 0
+
+    def get(self, name: str, encoder) -> CompiledTemplate:
+        name = name or 'default'
+        now = time.monotonic()
+        with self._lock:
+            entry = self._compiled.get(name)
+            if entry and entry[0].encoder is encoder and now - entry[2] < self.check_interval:
+                return entry[0]
+
+        path = self._path(name)
+        mtime = self._mtime(path)
+        if entry and entry[0].encoder is encoder and entry[1] == mtime:
+            with self._lock:
+                self._compiled[name] = (entry[0], mtime, now)
+            return entry[0]
+
+        template = CompiledTemplate(name, self._load(name, path, mtime), encoder)
+        with self._lock:
+            self._compiled[name] = (template, mtime, now)
+            self.compilations += 1
+        logger.info("🧾 Plantilla de ticket '%s' compilada", name)
+        return template
+
+    def render(self, name: str, order: dict, encoder, logo: bytes = b'', qr: bytes = b'') -> bytes:
+        data = self.get(name, encoder).render(order, logo, qr)
+        self.renders += 1
+        return data
+
+    def names(self) -> list:
+        names = {'default'}
+        if self.directory and os.path.isdir(self.directory):
+            names.update(os.path.splitext(f)[0] for f in os.listdir(self.directory)
+                         if f.endswith('.json') and TEMPLATE_NAME.match(os.path.splitext(f)[0]))
+        return sorted(names)
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'compiled': sorted(self._compiled),
+                'compilations': self.compilations,
+                'renders': self.renders,
+            }
+
+    # --- Implementación ---
+
+    def _path(self, name):
+        if not TEMPLATE_NAME.match(name):
+            raise TemplateError(f"Nombre de plantilla no válido: {name!r}")
+        return os.path.join(self.directory, name + '.json') if self.directory else None
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime if path else None
+        except OSError:
+            return None
+
+    def _load(self, name, path, mtime):
+        if mtime is None:
+            if name == 'default':
+                return copy.deepcopy(DEFAULT_TEMPLATE)
+            raise TemplateError(f"Plantilla desconocida: '{name}'")
+        try:
+            with open(path, encoding='utf-8') as f:
+                spec = json.load(f)
+        except (OSError, ValueError) as e:
+            raise TemplateError(f"No se pudo leer la plantilla '{name}': {e}") from None
+        if not isinstance(spec, dict):
+            raise TemplateError(f"La plantilla '{name}' debe ser un objeto JSON")
+        return spec
@@ -0,0 +1,255 @@
+"""Canal WebSocket para los clientes del TPV.
+
+Cada petición HTTP del navegador al servidor va precedida de un preflight
+CORS (OPTIONS), así que un trabajo cuesta dos idas y vueltas. Por este canal
+la aplicación abre una conexión persistente (autenticada) y envía los
+trabajos como mensajes JSON; la respuesta y el resultado final de cada
+trabajo llegan por la misma conexión.
+
+Protocolo (un objeto JSON por mensaje; ``ref`` es opcional y se devuelve tal
+cual en las respuestas y eventos)::
+
+    -> {"op": "auth", "token": "..."}               (si hay token y no va en ?token=)
+    <- {"op": "ready"}
+    -> {"op": "print", "ref": "r1", "job": {"type": "text", "text": "..."}}
+    -> {"op": "batch", "ref": "r2", "jobs": [...], "contiguous": true}
+    <- {"op": "accepted", "ref": "r1", "job_ids": ["..."]}
+    <- {"op": "rejected", "ref": "r1", "message": "...", "retry_after": 5}
+    <- {"op": "error", "ref": "r1", "message": "..."}
+    <- {"op": "job", "ref": "r1", "job_id": "...", "state": "done", "error": null}
+    -> {"op": "watch", "job_ids": ["..."]}          (p. ej. tras reconectar)
+    -> {"op": "ping"}  <- {"op": "pong"}
+
+El servidor corre en su propio hilo con un bucle asyncio (paquete opcional
+``websockets``). Los mensajes de cada conexión se atienden en orden en un
+pool de hilos, porque encolar un trabajo puede bloquear (diario en disco).
+"""
+import asyncio
+import hmac
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from job_tracker import FINAL_STATES
+
+try:
+    # Opcional: canal WebSocket (pip install websockets, versión 13 o posterior)
+    from websockets.asyncio.server import serve
+    from websockets.exceptions import ConnectionClosed
+except ImportError:
+    serve = None
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKETS_AVAILABLE = serve is not None
+POLICY_VIOLATION = 1008  # Código de cierre WebSocket: no autorizado
+
+
+class WebSocketChannel:
+    """Servidor WebSocket de trabajos de impresión.
+
+    ``handler(mensaje, cliente)`` procesa una operación de trabajos ('print',
+    'batch') en un hilo del pool y devuelve la respuesta (``cliente`` es la
+    dirección IP de la conexión); si incluye 'job_ids', el resultado final de
+    esos trabajos se envía a la conexión cuando ``tracker`` (JobTracker) los
+    da por terminados.
+    """
+
+    def __init__(self, handler, tracker, host: str = '0.0.0.0', port: int = 5001,
+                 allowed_origin: str = None, token: str = None, auth_timeout: float = 10.0,
+                 max_message_bytes: int = 16 * 1024 * 1024, workers: int = 4):
+        self.handler = handler
+        self.tracker = tracker
+        self.host = host
+        self.port = port
+        self.allowed_origin = allowed_origin
+        self.token = token
+        self.auth_timeout = auth_timeout
+        self.max_message_bytes = max_message_bytes
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='ws-job')
+        self._thread = None
+        self._loop = None
+        self._stop = None
+        self._error = None
+        self._watchers = {}  # id de trabajo -> {conexión: ref}
+        self._connections = set()
+        self.messages = 0
+        self.events = 0
+        self.auth_failures = 0
+
+    def start(self):
+        """Arrancar el servidor en su hilo. Lanza la excepción si no puede
+        escuchar en el puerto."""
+        if not WEBSOCKETS_AVAILABLE:
+            raise RuntimeError("Paquete 'websockets' no instalado (pip install websockets)")
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name='ws-channel', daemon=True)
+        self._thread.start()
+        ready.wait(10)
+        if self._error is not None:
+            raise self._error
+        self.tracker.add_listener(self._on_job_finished)
+        logger.info("✓ Canal WebSocket escuchando en %s:%s%s", self.host, self.port,
+                    ' (con token)' if self.token else '')
+
+    def stop(self):
+        self.tracker.remove_listener(self._on_job_finished)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        if self._thread is not None:
+            self._thread.join(5)
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            'port': self.port,
+            'auth': 'token' if self.token else 'origin',
+            'connections': len(self._connections),
+            'messages': self.messages,
+            'events': self.events,
+            'watching': sum(len(watchers) for watchers in self._watchers.values()),
+            'auth_failures': self.auth_failures,
+        }
+
+    # --- Bucle asyncio ---
+
+    def _run(self, ready):
+        try:
+            asyncio.run(self._serve(ready))
+        except Exception as e:
+            self._error = e
+            ready.set()
+            logger.error("✗ Canal WebSocket detenido: %s", e)
+
+    async def _serve(self, ready):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        # Los navegadores no aplican CORS a WebSocket: se comprueba el Origin.
+        # Sin cabecera Origin (clientes que no son navegador) se admite, igual
+        # que en la API HTTP.
+        origins = None if self.allowed_origin in (None, '', '*') else [self.allowed_origin, None]
+        async with serve(self._connection, self.host, self.port, origins=origins,
+                         max_size=self.max_message_bytes) as server:
+            self.port = server.sockets[0].getsockname()[1]
+            ready.set()
+            await self._stop.wait()
+
+    async def _connection(self, connection):
+        client = connection.remote_address[0]
+        label = f"{client} ({connection.request.headers.get('Origin', '-')})"
+        try:
+            if not await self._authenticate(connection):
+                self.auth_failures += 1
+                logger.warning("⚠️ Conexión WebSocket rechazada (token no válido) desde %s", label)
+                await connection.close(POLICY_VIOLATION, 'No autorizado')
+                return
+            self._connections.add(connection)
+            logger.debug("🔗 Cliente WebSocket conectado: %s", label)
+            await connection.send(json.dumps({'op': 'ready'}))
+            async for raw in connection:
+                self.messages += 1
+                await self._on_message(connection, client, raw)
+        except ConnectionClosed:
+            pass
+        finally:
+            self._connections.discard(connection)
+            for job_id in [job_id for job_id, watchers in self._watchers.items() if connection in watchers]:
+                self._unwatch(job_id, connection)
+            logger.debug("🔌 Cliente WebSocket desconectado: %s", label)
+
+    async def _authenticate(self, connection) -> bool:
+        """Token en la query string (?token=) o en un primer mensaje 'auth'."""
+        if not self.token:
+            return True
+        query = parse_qs(urlsplit(connection.request.path).query)
+        if 'token' in query:
+            return self._valid_token(query['token'][0])
+        try:
+            raw = await asyncio.wait_for(connection.recv(), self.auth_timeout)
+            message = json.loads(raw)
+        except (asyncio.TimeoutError, ValueError):
+            return False
+        return isinstance(message, dict) and message.get('op') == 'auth' and self._valid_token(message.get('token'))
+
+    def _valid_token(self, token) -> bool:
+        return isinstance(token, str) and hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+    async def _on_message(self, connection, client, raw):
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            await self._send(connection, {'op': 'error', 'message': 'Mensaje JSON no válido'})
+            return
+        ref = message.get('ref')
+        op = message.get('op')
+        if op == 'ping':
+            await self._send(connection, {'op': 'pong', 'ref': ref})
+        elif op == 'auth':
+            await self._send(connection, {'op': 'ready', 'ref': ref})
+        elif op == 'watch':
+            job_ids = message.get('job_ids')
+            if not isinstance(job_ids, list):
+                await self._send(connection, {'op': 'error', 'ref': ref, 'message': "Falta la lista 'job_ids'"})
+                return
+            self._watch(connection, [str(job_id) for job_id in job_ids], ref)
+        else:
+            try:
+                reply = await self._loop.run_in_executor(self._executor, self.handler, message, client)
+            except Exception as e:
+                logger.error("Error en mensaje WebSocket %s: %s", op, e)
+                reply = {'op': 'error', 'message': str(e)}
+            reply['ref'] = ref
+            await self._send(connection, reply)
+            if reply.get('job_ids'):
+                self._watch(connection, reply['job_ids'], ref)
+
+    async def _send(self, connection, payload):
+        try:
+            await connection.send(json.dumps(payload, ensure_ascii=False))
+        except ConnectionClosed:
+            pass
+
+    # --- Eventos de fin de trabajo ---
+
+    def _watch(self, connection, job_ids, ref):
+        """Anotar que la conexión espera estos trabajos (varias conexiones
+        pueden esperar el mismo). Los que ya terminaron (incluso justo antes
+        de anotarlos) se envían en el momento."""
+        for job_id in job_ids:
+            self._watchers.setdefault(job_id, {})[connection] = ref
+            status = self.tracker.get(job_id)
+            if status is None:
+                self._unwatch(job_id, connection)
+                self._loop.create_task(self._send(connection, {'op': 'job', 'ref': ref, 'job_id': job_id,
+                                                               'state': 'unknown', 'error': None}))
+            elif status['state'] in FINAL_STATES:
+                self._dispatch(status)
+
+    def _unwatch(self, job_id, connection):
+        watchers = self._watchers[job_id]
+        del watchers[connection]
+        if not watchers:
+            del self._watchers[job_id]
+
+    def _on_job_finished(self, status):
+        # Llamado desde el hilo de impresión: pasar al bucle del canal
+        if status['state'] in FINAL_STATES and self._watchers and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._dispatch, status)
+
+    def _dispatch(self, status):
+        watchers = self._watchers.pop(status['job_id'], None)
+        for connection, ref in (watchers or {}).items():
+            self.events += 1
+            self._loop.create_task(self._send(connection, {
+                'op': 'job',
+                'ref': ref,
+                'job_id': status['job_id'],
+                'type': status.get('type'),
+                'printer': status.get('printer'),
+                'state': status['state'],
+                'error': status.get('error'),
+            }))